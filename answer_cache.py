@@ -0,0 +1,117 @@
+# answer_cache.py
+
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+import numpy as np
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+class SemanticAnswerCache:
+    """
+    Caches LLM answers for repeated and near-duplicate questions.
+    A cached answer is reused only when the new question's embedding is within the similarity
+    threshold, exactly the same chunks were retrieved, and the indexed documents are unchanged.
+    Entries expire after a TTL and are evicted least-recently-used beyond max_entries.
+    """
+    def __init__(
+        self,
+        similarity_threshold: float = settings.ANSWER_CACHE_SIMILARITY,
+        ttl_seconds: float = settings.ANSWER_CACHE_TTL_SECONDS,
+        max_entries: int = settings.ANSWER_CACHE_SIZE,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._clock = clock  # seconds; replaceable so expiry can be tested without waiting
+        self._entries: OrderedDict[int, dict] = OrderedDict()
+        self._next_key = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalize(query_emb: np.ndarray) -> np.ndarray:
+        vector = np.asarray(query_emb, dtype='float32').reshape(-1)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def _expire(self, now: float):
+        expired = [key for key, entry in self._entries.items() if now - entry['created_at'] > self.ttl_seconds]
+        for key in expired:
+            del self._entries[key]
+
+    def lookup(self, query_emb: np.ndarray, chunk_ids: list[int], corpus_key, model_name: str = settings.LLM_MODEL) -> str | None:
+        """Returns the cached answer for a near-identical question over the same chunks, or None."""
+        vector = self._normalize(query_emb)
+        retrieved = frozenset(chunk_ids)
+        with self._lock:
+            self._expire(self._clock())
+            best_key, best_similarity = None, self.similarity_threshold
+            for key, entry in self._entries.items():
+                if entry['chunk_ids'] != retrieved or entry['corpus_key'] != corpus_key or entry['model_name'] != model_name:
+                    continue
+                similarity = float(np.dot(entry['query_emb'], vector))
+                if similarity >= best_similarity:
+                    best_key, best_similarity = key, similarity
+
+            if best_key is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_key)
+            self.hits += 1
+            logger.info(f"Answer cache hit (similarity {best_similarity:.3f}). Hits: {self.hits}, misses: {self.misses}.")
+            return self._entries[best_key]['answer']
+
+    def store(self, query_emb: np.ndarray, chunk_ids: list[int], corpus_key, answer: str, model_name: str = settings.LLM_MODEL):
+        """Caches a complete answer for the question embedding, retrieved chunks and corpus state."""
+        if not answer:
+            return
+        with self._lock:
+            self._entries[self._next_key] = {
+                'query_emb': self._normalize(query_emb),
+                'chunk_ids': frozenset(chunk_ids),
+                'corpus_key': corpus_key,
+                'model_name': model_name,
+                'answer': answer,
+                'created_at': self._clock(),
+            }
+            self._next_key += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, corpus_key=None):
+        """Drops the entries cached for corpus_key (the state before a document change), or all entries."""
+        with self._lock:
+            if corpus_key is None:
+                self._entries.clear()
+                return
+            stale = [key for key, entry in self._entries.items() if entry['corpus_key'] == corpus_key]
+            for key in stale:
+                del self._entries[key]
+            if stale:
+                logger.info(f"Invalidated {len(stale)} cached answers after a document change.")
+
+    def stats(self) -> dict:
+        """Returns hit/miss counts and the number of cached answers."""
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
+
+def replay_stream(answer: str):
+    """Yields a cached answer in small pieces so it renders like a live completion stream."""
+    for piece in re.findall(r'\S+\s*|\s+', answer):
+        yield piece
+
+_cache_lock = threading.Lock()
+_answer_cache: SemanticAnswerCache | None = None
+
+def get_answer_cache() -> SemanticAnswerCache:
+    """Returns the process-wide answer cache, shared by every session."""
+    global _answer_cache
+    with _cache_lock:
+        if _answer_cache is None:
+            _answer_cache = SemanticAnswerCache()
+        return _answer_cache
@@ -1,16 +1,20 @@
 # app.py
 
+import time
+_RUN_START = time.perf_counter()  # start of this script run, for the time-to-first-paint metric
+
 import streamlit as st
-import os
 import uuid
 from config import settings
-from pdf_utils import extract_text_from_pdf, PDFParsingError
-from llm_utils import get_rag_response_stream, LLMAnalysisError
-from rag_utils import RAGVectorStore
-from preloaded_data import preload_data_to_store
-from chunking import SemanticChunker
+from answer_cache import get_answer_cache, replay_stream
+from context_packing import pack_context
+from knowledge_base import get_knowledge_base
+from metrics import VALUE_METRICS, get_metrics, span
+from session_manager import get_session_manager
 import logging
-import time
+
+# Only light modules are imported above. torch, sentence-transformers, faiss and scipy are imported
+# by the knowledge base warm-up thread, and the modules that need them are imported where used.
 
 # --- Setup & Initialization ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -18,27 +22,48 @@ logger = logging.getLogger(__name__)
 
 st.set_page_config(page_title=settings.PROJECT_NAME, layout="wide")
 
+def invalidate_session_answers(old_corpus_key: tuple):
+    """Drops cached answers for a corpus state this session has left, unless other sessions share it."""
+    if old_corpus_key != get_knowledge_base().base_store.corpus_key():
+        get_answer_cache().invalidate(old_corpus_key)
+
 # --- Session State Initialization ---
 def initialize_session_state():
-    """Initializes session state variables if they don't exist."""
-    if 'rag_store' not in st.session_state:
-        st.session_state.rag_store = RAGVectorStore()
-        st.session_state.processed_files = set()
-        logger.info("Initialized RAGVectorStore and processed_files in session state.")
-
-        with st.spinner("Loading initial knowledge base..."):
-            processed_filenames = preload_data_to_store(st.session_state.rag_store)
-            for name in processed_filenames:
-                st.session_state.processed_files.add(name)
-    
+    """Initializes session state variables if they don't exist. The document store waits for the embedding model."""
     if 'chat_history' not in st.session_state:
         st.session_state.chat_history = []
+        st.session_state.session_id = uuid.uuid4().hex
         logger.info("Initialized chat_history in session state.")
-    
-    if 'semantic_chunker' not in st.session_state:
-        st.session_state.semantic_chunker = SemanticChunker(st.session_state.rag_store.embedding_model)
+
+    knowledge_base = get_knowledge_base()
+    if 'rag_store' not in st.session_state and knowledge_base.base_store is not None:
+        from chunking import SemanticChunker
+        from rag_utils import LayeredVectorStore
+        st.session_state.rag_store = LayeredVectorStore(knowledge_base.base_store)
+        st.session_state.removed_uploads = set()  # content hashes of uploads removed via the sidebar
+        st.session_state.semantic_chunker = SemanticChunker(knowledge_base.embedding_model)
+        logger.info("Initialized session overlay on the shared knowledge base.")
+
+def touch_session():
+    """Marks this session as active: reloads its uploads if they were spilled, and accounts their memory."""
+    if 'rag_store' in st.session_state:
+        get_session_manager().touch(st.session_state.session_id, st.session_state.rag_store)
 
 initialize_session_state()
+touch_session()
+
+@st.fragment(run_every=1.0)
+def warmup_status():
+    """Shows knowledge base warm-up progress, polling until it is done without rerunning the whole page."""
+    knowledge_base = get_knowledge_base()
+    if knowledge_base.error:
+        st.error(f"❌ Could not load the knowledge base: {knowledge_base.error}")
+        return
+    if knowledge_base.ready or ('rag_store' not in st.session_state and knowledge_base.base_store is not None):
+        st.rerun()  # the model is loaded or indexing finished: redraw the page with the new state
+    st.progress(knowledge_base.progress(), text=knowledge_base.stage)
+    if knowledge_base.base_store is not None:
+        st.caption("You can ask questions now; answers use the documents indexed so far.")
 
 # --- UI Styles ---
 st.markdown("""
@@ -58,41 +83,116 @@ st.markdown("""
 # --- Sidebar ---
 with st.sidebar:
     st.header("📚 Document Management")
-    uploaded_files = st.file_uploader("Upload PDF files", type="pdf", accept_multiple_files=True)
+    knowledge_base = get_knowledge_base()
+    if not knowledge_base.ready:
+        warmup_status()
+    if not settings.GROQ_API_KEY:
+        st.warning("GROQ_API_KEY is not set. Add it to your .env file or environment to get answers.")
+    session_ready = 'rag_store' in st.session_state
+    uploaded_files = st.file_uploader("Upload PDF files", type="pdf", accept_multiple_files=True, disabled=not session_ready)
+
+    if uploaded_files and session_ready:
+        from ingestion import IngestJob, ingest_files
+        from rag_utils import content_hash
+
+        # Uploads removed from the index stay in the uploader widget; forget them once they leave it.
+        upload_hashes = {content_hash(f.getvalue()) for f in uploaded_files}
+        st.session_state.removed_uploads &= upload_hashes
 
-    if uploaded_files:
+        jobs = []
         for uploaded_file in uploaded_files:
-            if uploaded_file.name not in st.session_state.processed_files:
-                with st.spinner(f"Processing {uploaded_file.name}..."):
-                    try:
-                        temp_path = os.path.join(settings.UPLOAD_DIR, uploaded_file.name)
-                        with open(temp_path, "wb") as f:
-                            f.write(uploaded_file.getvalue())
-                        
-                        text = extract_text_from_pdf(temp_path)
-                        chunks = st.session_state.semantic_chunker.chunk(text)
-                        st.session_state.rag_store.add_texts(chunks, source=uploaded_file.name)
-                        
-                        st.session_state.processed_files.add(uploaded_file.name)
-                        st.success(f"✅ Indexed {uploaded_file.name}")
-                        os.remove(temp_path)
-                    except Exception as e:
-                        st.error(f"❌ Error processing {uploaded_file.name}: {e}")
+            file_bytes = uploaded_file.getvalue()
+            file_hash = content_hash(file_bytes)
+            if file_hash in st.session_state.removed_uploads:
+                continue
+            # Deduplicate by content, so a renamed copy of an indexed PDF is not encoded again.
+            if st.session_state.rag_store.has_content(file_hash) or any(job.source_hash == file_hash for job in jobs):
+                continue
+            # Extracted straight from memory; nothing is written to disk.
+            jobs.append(IngestJob(source=uploaded_file.name, data=file_bytes, source_hash=file_hash))
+
+        if jobs:
+            with st.spinner(f"Processing {len(jobs)} file(s)..."):
+                errors = {}
+                old_corpus_key = st.session_state.rag_store.corpus_key()
+                try:
+                    # Held in use so the session cannot be spilled while the writer is adding to it.
+                    with st.session_state.rag_store.in_use():
+                        indexed = ingest_files(st.session_state.rag_store, jobs, chunker=st.session_state.semantic_chunker, errors=errors)
+                finally:
+                    invalidate_session_answers(old_corpus_key)
+                    touch_session()  # the uploads may push the sessions over the memory budget
+            for job in jobs:
+                if job.source in indexed:
+                    st.success(f"✅ Indexed {job.source}")
+                elif job.source in errors:
+                    st.error(f"❌ Error processing {job.source}: {errors[job.source]}")
+                else:
+                    st.warning(f"⚠️ No text could be indexed from {job.source}.")
 
     st.subheader("Indexed Documents")
-    if not st.session_state.processed_files:
+    indexed_files = st.session_state.rag_store.sources() if session_ready else []
+    if not session_ready:
+        st.info("Loading the knowledge base...")
+    elif not indexed_files:
         st.info("Knowledge base is empty. Upload a PDF or add files to the 'data' folder.")
     else:
-        for file_name in sorted(list(st.session_state.processed_files)):
-            st.markdown(f"- `{file_name}`")
+        for file_name in indexed_files:
+            name_col, remove_col = st.columns([5, 1])
+            name_col.markdown(f"- `{file_name}`")
+            if remove_col.button("🗑️", key=f"remove_{file_name}", help=f"Remove {file_name} from the index"):
+                rag_store = st.session_state.rag_store
+                upload_hash = rag_store.upload_hash(file_name)
+                if upload_hash:
+                    st.session_state.removed_uploads.add(upload_hash)
+                old_corpus_key = rag_store.corpus_key()
+                rag_store.remove_source(file_name)
+                invalidate_session_answers(old_corpus_key)
+                st.rerun()
 
-    if st.button("Clear All Data & Chats"):
-        # Clear specific session state keys instead of wiping the whole state
-        st.session_state.rag_store.clear()
+    if st.button("Clear Uploads & Chats"):
+        # Clear specific session state keys instead of wiping the whole state.
+        # The shared knowledge base is read-only, so only this session's uploads are dropped.
+        if session_ready:
+            old_corpus_key = st.session_state.rag_store.corpus_key()
+            st.session_state.rag_store.clear()
+            invalidate_session_answers(old_corpus_key)
+            st.session_state.removed_uploads = set()
         st.session_state.chat_history = []
-        st.session_state.processed_files = set()
         st.rerun()
 
+    cache_stats = get_answer_cache().stats()
+    st.caption(f"Answer cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['entries']} cached")
+    if knowledge_base.embedding_model is not None:
+        encoder_stats = knowledge_base.embedding_model.stats()
+        st.caption(f"Encoder: {encoder_stats['sentences_per_second']:.0f} sentences/s, {encoder_stats['mean_batch_size']:.1f} per batch, {encoder_stats['coalesced_requests']} requests coalesced")
+    session_stats = get_session_manager().stats()
+    st.caption(
+        f"Session memory: {session_stats['resident_bytes'] / 2**20:.1f} of {session_stats['budget_bytes'] / 2**20:.0f} MB "
+        f"({session_stats['resident']} sessions in memory, {session_stats['spilled']} spilled to disk)"
+    )
+
+    metrics = get_metrics()
+    if metrics.enabled:
+        with st.expander("⏱️ Pipeline Latency"):
+            snapshot = metrics.snapshot()
+            if not snapshot:
+                st.caption("No measurements yet.")
+            else:
+                rows = []
+                for name, summary in snapshot.items():
+                    scale, unit = (1, VALUE_METRICS[name][3]) if name in VALUE_METRICS else (1000, " ms")
+                    rows.append({
+                        "stage": name,
+                        "count": summary['count'],
+                        "p50": f"{scale * summary['p50']:.1f}{unit}",
+                        "p95": f"{scale * summary['p95']:.1f}{unit}",
+                        "mean": f"{scale * summary['mean']:.1f}{unit}",
+                    })
+                st.dataframe(rows, hide_index=True, use_container_width=True)
+                st.download_button("Export Prometheus", metrics.to_prometheus(), file_name="rag_metrics.prom", mime="text/plain")
+                st.download_button("Export JSON", metrics.to_json(), file_name="rag_metrics.json", mime="application/json")
+
 # --- Main Chat Interface ---
 st.title("🌊 FlowChat: AquaQuery Oceanographic Assistant")
 st.markdown("Your assistant for understanding oceanographic research. Ask questions and get cited answers.")
@@ -101,6 +201,8 @@ st.markdown("Your assistant for understanding oceanographic research. Ask questi
 for message in st.session_state.chat_history:
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
+        if "context_tokens" in message:
+            st.caption(f"Context: ~{message['context_tokens']['used']} tokens (~{max(0, message['context_tokens']['saved'])} saved by packing)")
         if "sources" in message and message["sources"]:
             with st.expander("View Sources"):
                 for source in message["sources"]:
@@ -108,32 +210,71 @@ for message in st.session_state.chat_history:
                     st.info(f"**Source Document:** `{source['source']}`\n\n**Content:**\n\n> {source['text'].replace('$', '//$')}")
 
 # Handle new chat input
-if prompt := st.chat_input("Ask AquaQuery about your documents..."):
+prompt = st.chat_input("Ask AquaQuery about your documents...")
+
+# The page shell is on screen from here on; record how long this session's first render took.
+if 'first_paint_recorded' not in st.session_state:
+    st.session_state.first_paint_recorded = True
+    first_paint = time.perf_counter() - _RUN_START
+    get_metrics().observe("app.first_paint", first_paint)
+    logger.info(f"Time to first paint: {first_paint:.3f} seconds.")
+
+if prompt:
     st.session_state.chat_history.append({"role": "user", "content": prompt})
     with st.chat_message("user"):
         st.markdown(prompt)
 
     with st.chat_message("assistant"):
         try:
-            if st.session_state.rag_store.index.ntotal == 0:
+            initialize_session_state()  # the embedding model may have finished loading since the page was drawn
+            if 'rag_store' not in st.session_state:
+                st.info("The knowledge base is still loading. Please ask again in a moment.")
+                st.session_state.chat_history.append({"role": "assistant", "content": "The knowledge base is still loading. Please ask again in a moment."})
+            elif st.session_state.rag_store.ntotal == 0 and not get_knowledge_base().ready:
+                st.info("No documents are indexed yet. Please ask again in a moment.")
+                st.session_state.chat_history.append({"role": "assistant", "content": "No documents are indexed yet. Please ask again in a moment."})
+            elif st.session_state.rag_store.ntotal == 0:
                 st.warning("The knowledge base is empty. Please upload documents before asking questions.")
                 st.session_state.chat_history.append({"role": "assistant", "content": "The knowledge base is empty."})
             else:
                 with st.spinner("Searching documents..."):
-                    retrieved_docs = st.session_state.rag_store.query(prompt, top_k=settings.TOP_K)
-                    context_parts = [f"--- Excerpt from {doc['source']} ---\n{doc['text']}" for doc in retrieved_docs]
-                    context = "\n\n".join(context_parts)
+                    rag_store = st.session_state.rag_store
+                    with span("query.encode"):
+                        query_emb = rag_store.encode_query(prompt)
+                    with span("query.search"):
+                        candidates = rag_store.query(prompt, top_k=max(settings.CONTEXT_CANDIDATES, settings.TOP_K), query_emb=query_emb)
+                    # Drop near-duplicate excerpts and fit the rest into the prompt's token budget.
+                    with span("query.pack"):
+                        packed = pack_context(query_emb, candidates, rag_store.get_vectors([doc['id'] for doc in candidates]))
+                    retrieved_docs = packed.docs
+                    context = packed.context
 
                 if not retrieved_docs:
                     st.warning("I couldn't find relevant information in the documents for your query.")
                     st.session_state.chat_history.append({"role": "assistant", "content": "I couldn't find relevant information in the documents for your query."})
                 else:
-                    response_generator = get_rag_response_stream(query=prompt, context=context)
-                    full_response = st.write_stream(response_generator)
+                    # Near-duplicate questions over the same chunks replay the cached answer instead of calling the LLM.
+                    answer_cache = get_answer_cache()
+                    corpus_key = rag_store.corpus_key()
+                    chunk_ids = [doc['id'] for doc in retrieved_docs]
+                    with span("query.cache_lookup"):
+                        cached_answer = answer_cache.lookup(query_emb, chunk_ids, corpus_key)
+                    if cached_answer is not None:
+                        response_generator = replay_stream(cached_answer)
+                    else:
+                        from llm_utils import get_rag_response_stream
+                        response_generator = get_rag_response_stream(query=prompt, context=context)
+                    with span("query.answer"):
+                        full_response = st.write_stream(response_generator)
+                    if cached_answer is None:
+                        answer_cache.store(query_emb, chunk_ids, corpus_key, full_response)
+                    if settings.METRICS_TEXTFILE:
+                        get_metrics().write_textfile(settings.METRICS_TEXTFILE)
                     
                     bot_message = {"role": "assistant", "content": full_response}
                     if retrieved_docs:
                         bot_message["sources"] = retrieved_docs
+                    bot_message["context_tokens"] = {"used": packed.tokens_used, "saved": packed.tokens_saved}
                     
                     if full_response:
                         st.session_state.chat_history.append(bot_message)
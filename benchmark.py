@@ -0,0 +1,247 @@
+# benchmark.py
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import re
+import shutil
+import statistics
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+STUB_MODEL_NAME = "benchmark-stub"
+
+class StubEmbeddingModel:
+    """
+    Deterministic stand-in for SentenceTransformer: hashes words into a fixed-size bag-of-words
+    vector. Sentences sharing vocabulary get similar vectors, so chunking still finds topic
+    boundaries, and results never depend on downloaded weights.
+    """
+    def __init__(self, dimension: int = 384):
+        self.dimension = dimension
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dimension
+
+    def encode(self, sentences, convert_to_numpy: bool = True, **kwargs) -> np.ndarray:
+        if isinstance(sentences, str):
+            sentences = [sentences]
+        vectors = np.zeros((len(sentences), self.dimension), dtype='float32')
+        for row, text in enumerate(sentences):
+            # The whole-text bucket keeps every vector non-zero, even for text without words.
+            vectors[row, zlib.crc32(text.encode('utf-8')) % self.dimension] += 0.1
+            for word in re.findall(r"\w+", text.lower()):
+                bucket = zlib.crc32(word.encode('utf-8'))
+                vectors[row, bucket % self.dimension] += 1.0 if bucket & 0x80000000 else -1.0
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors
+
+def make_sentences(count: int, seed: int, topics: int = 8, sentences_per_topic: int = 12) -> list[str]:
+    """Generates pseudo-English sentences that switch topic (vocabulary) every few sentences."""
+    rng = random.Random(seed)
+    syllables = ["ka", "lo", "mer", "ta", "sil", "no", "vi", "ra", "den", "ul", "pho", "tes", "ma", "ri", "so"]
+    vocabularies = [
+        ["".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))) for _ in range(60)]
+        for _ in range(topics)
+    ]
+    sentences = []
+    for i in range(count):
+        vocabulary = vocabularies[(i // sentences_per_topic) % topics]
+        words = [rng.choice(vocabulary) for _ in range(rng.randint(8, 20))]
+        sentences.append(" ".join(words).capitalize() + ".")
+    return sentences
+
+def write_pdf(path: str, sentences: list[str], chars_per_page: int = 2500):
+    """Writes the sentences to a text PDF, about chars_per_page characters per page."""
+    import fitz  # PyMuPDF
+
+    pages, current = [], ""
+    for sentence in sentences:
+        if current and len(current) + len(sentence) > chars_per_page:
+            pages.append(current)
+            current = ""
+        current += sentence + " "
+    pages.append(current)
+
+    doc = fitz.open()
+    for page_text in pages:
+        page = doc.new_page()
+        page.insert_textbox(fitz.Rect(50, 50, page.rect.width - 50, page.rect.height - 50), page_text, fontsize=9)
+    doc.save(path)
+    doc.close()
+
+def measure(fn, repeats: int, setup=None) -> dict:
+    """
+    Runs setup (untimed) and fn `repeats` times; returns the median and best wall time. One untimed
+    warm-up run comes first, so one-off costs such as lazy imports are not measured.
+    """
+    if setup is not None:
+        setup()
+    fn()
+    timings = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return {'median_s': statistics.median(timings), 'min_s': min(timings), 'repeats': repeats}
+
+def run_benchmarks(work_dir: str, documents: int = 4, sentences: int = 600, queries: int = 200, repeats: int = 3, dimension: int = 384, seed: int = 0) -> dict:
+    """Runs every benchmark on synthetic data under work_dir and returns the results by name."""
+    from chunking import SemanticChunker
+    from embedding_cache import get_embedding_cache
+    from encoder_service import BatchingEncoder
+    from pdf_utils import extract_text_from_pdf, get_page_cache
+    from preloaded_data import preload_data_to_store
+    from rag_utils import RAGVectorStore
+
+    model = StubEmbeddingModel(dimension)
+    cache = get_embedding_cache()
+    page_cache = get_page_cache()
+    chunker = SemanticChunker(model, cache)
+    results = {}
+
+    # --- Synthetic corpus: alternating PDF and text documents ---
+    data_dir = os.path.join(work_dir, "data")
+    os.makedirs(data_dir, exist_ok=True)
+    corpus = [make_sentences(sentences, seed + i) for i in range(documents)]
+    for i, doc_sentences in enumerate(corpus):
+        if i % 2 == 0:
+            write_pdf(os.path.join(data_dir, f"doc{i}.pdf"), doc_sentences)
+        else:
+            with open(os.path.join(data_dir, f"doc{i}.txt"), 'w', encoding='utf-8') as f:
+                f.write(" ".join(doc_sentences))
+    pdf_path = os.path.join(data_dir, "doc0.pdf")
+    text = extract_text_from_pdf(pdf_path)
+    segmented = chunker.segmenter.segment(text)
+    sentence_vectors = model.encode(segmented)
+
+    # --- Extraction and chunking stages ---
+    results['extract_text_from_pdf'] = measure(lambda: extract_text_from_pdf(pdf_path), repeats, setup=page_cache.clear)
+    results['chunk.segment'] = measure(lambda: chunker.segmenter.segment(text), repeats)
+    results['chunk.encode'] = measure(lambda: model.encode(segmented), repeats)
+    results['chunk.distances'] = measure(lambda: chunker.find_spans(sentence_vectors), repeats)
+    results['chunk.total'] = measure(lambda: chunker.chunk(text), repeats, setup=cache.clear)
+    for name in ('chunk.segment', 'chunk.encode', 'chunk.distances', 'chunk.total'):
+        results[name]['sentences'] = len(segmented)
+
+    # --- Indexing and retrieval ---
+    chunks = [chunk for doc_sentences in corpus for chunk in chunker.chunk(" ".join(doc_sentences))]
+    stores = []
+    def new_store():
+        cache.clear()
+        stores.append(RAGVectorStore(embedding_model=model))
+    results['add_texts'] = measure(lambda: stores[-1].add_texts(chunks, source="benchmark"), repeats, setup=new_store)
+    results['add_texts']['chunks'] = len(chunks)
+
+    store = stores[-1]
+    rng = random.Random(seed)
+    query_texts = [rng.choice(doc_sentences) for doc_sentences in corpus for _ in range(max(1, queries // documents))]
+    latencies = []
+    def run_queries():
+        for query_text in query_texts:
+            start = time.perf_counter()
+            store.query(query_text)
+            latencies.append(time.perf_counter() - start)
+    results['query'] = measure(run_queries, repeats)
+    del latencies[:len(query_texts)]  # recorded by the warm-up run
+    results['query'].update({
+        'queries': len(query_texts),
+        'latency_p50_ms': 1000 * float(np.percentile(latencies, 50)),
+        'latency_p95_ms': 1000 * float(np.percentile(latencies, 95)),
+    })
+    results['query_batch'] = measure(lambda: store.query_batch(query_texts), repeats)
+    results['query_batch']['queries'] = len(query_texts)
+
+    # --- Encoder: length-bucketed batches, and single queries from many threads coalesced ---
+    encoder = BatchingEncoder(model, int8=False)
+    results['encoder.bucketed'] = measure(lambda: encoder.encode(segmented), repeats)
+    results['encoder.bucketed']['sentences'] = len(segmented)
+    encoder.reset_stats()
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results['encoder.concurrent_queries'] = measure(lambda: list(pool.map(lambda q: encoder.encode([q]), query_texts)), repeats)
+    results['encoder.concurrent_queries'].update({'queries': len(query_texts), **encoder.stats()})
+
+    # --- End to end: cold ingestion of the whole data directory ---
+    index_dir = os.path.join(work_dir, "index")
+    def reset_preload():
+        shutil.rmtree(index_dir, ignore_errors=True)
+        cache.clear()
+        page_cache.clear()
+        stores.append(RAGVectorStore(embedding_model=model))
+    results['preload_data_to_store'] = measure(
+        lambda: preload_data_to_store(stores[-1], index_dir=index_dir, data_dir=data_dir), repeats, setup=reset_preload,
+    )
+    results['preload_data_to_store']['documents'] = documents
+    return results
+
+def find_regressions(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Lists benchmarks whose median time grew by more than threshold (0.2 = 20%) over the baseline."""
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous and result['median_s'] > previous['median_s'] * (1 + threshold):
+            change = result['median_s'] / previous['median_s'] - 1
+            regressions.append(f"{name}: {1000 * previous['median_s']:.2f} ms -> {1000 * result['median_s']:.2f} ms (+{100 * change:.0f}%)")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks of extraction, chunking, indexing, retrieval and preloading.")
+    parser.add_argument("--documents", type=int, default=4, help="Synthetic documents (alternating PDF and text).")
+    parser.add_argument("--sentences", type=int, default=600, help="Sentences per document.")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--dimension", type=int, default=384, help="Dimension of the stub embeddings.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="JSON file of an earlier run to compare against.")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed slowdown against the baseline (0.2 = 20%%).")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    # Keep stub vectors out of the real embedding cache and index.
+    settings.EMBEDDING_MODEL_NAME = STUB_MODEL_NAME
+    settings.EMBEDDING_CACHE_DIR = None
+
+    work_dir = tempfile.mkdtemp(prefix="rag_benchmark_")
+    try:
+        results = run_benchmarks(work_dir, args.documents, args.sentences, args.queries, args.repeats, args.dimension, args.seed)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'index_backend': settings.INDEX_BACKEND,
+            'params': vars(args),
+        },
+        'results': results,
+    }
+    for name, result in results.items():
+        print(f"{name:<24} median {1000 * result['median_s']:10.2f} ms   best {1000 * result['min_s']:10.2f} ms")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+        regressions = find_regressions(results, baseline, args.threshold)
+        if regressions:
+            print("Regressions beyond the threshold:")
+            for line in regressions:
+                print(f"  {line}")
+            raise SystemExit(1)
+        print(f"No regressions beyond {100 * args.threshold:.0f}% against {args.baseline}.")
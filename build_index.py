@@ -0,0 +1,324 @@
+# build_index.py
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import time
+from config import settings
+
+# Heavy modules (torch, faiss) are imported by the commands that need them, so planning and
+# status reports stay instant.
+
+logger = logging.getLogger(__name__)
+
+PLAN_FILENAME = "plan.json"
+ATTEMPTED_FILENAME = "attempted.json"
+PLAN_FORMAT = 1
+SUPPORTED_EXTENSIONS = (".pdf", ".txt", ".md")
+
+def scan_corpus(corpus: str) -> list[dict]:
+    """
+    Lists the files of a corpus as {'source', 'path'}. A directory is scanned recursively and its
+    files are indexed under their path relative to it; a manifest file lists one path per line
+    (blank and '#' lines skipped), relative paths being resolved against the manifest's directory.
+    """
+    files = []
+    if os.path.isdir(corpus):
+        for root, dirs, names in os.walk(corpus):
+            dirs.sort()
+            for name in sorted(names):
+                if name.endswith(SUPPORTED_EXTENSIONS):
+                    path = os.path.join(root, name)
+                    files.append({'source': os.path.relpath(path, corpus).replace(os.sep, "/"), 'path': os.path.abspath(path)})
+        return files
+
+    base_dir = os.path.dirname(os.path.abspath(corpus))
+    with open(corpus, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                files.append({'source': line, 'path': os.path.abspath(os.path.join(base_dir, line))})
+    return files
+
+def plan_shards(files: list[dict], shards: int) -> list[list[dict]]:
+    """Splits files into shards of similar total size: largest first, each into the lightest shard."""
+    sizes = {f['path']: os.path.getsize(f['path']) if os.path.exists(f['path']) else 0 for f in files}
+    planned = [[] for _ in range(shards)]
+    totals = [0] * shards
+    for f in sorted(files, key=lambda f: (-sizes[f['path']], f['source'])):
+        lightest = totals.index(min(totals))
+        planned[lightest].append(f)
+        totals[lightest] += sizes[f['path']]
+    for shard in planned:
+        shard.sort(key=lambda f: f['source'])
+    return planned
+
+def _write_json(path: str, data):
+    """Writes JSON via a temporary file, so an interrupted build never leaves a partial file."""
+    with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+def write_plan(build_dir: str, corpus: str, shards: int, force: bool = False) -> dict:
+    """Writes the build plan: the shards, the embedding model and the backend of the merged index."""
+    from encoder_service import embedding_model_id
+
+    plan_path = os.path.join(build_dir, PLAN_FILENAME)
+    if os.path.exists(plan_path) and not force:
+        raise SystemExit(f"'{build_dir}' already has a plan; pass --force to discard it and its shards.")
+    shutil.rmtree(os.path.join(build_dir, "shards"), ignore_errors=True)
+
+    files = scan_corpus(corpus)
+    sources = [f['source'] for f in files]
+    if len(set(sources)) != len(sources):
+        raise SystemExit("The corpus lists some files more than once.")
+    plan = {
+        'format': PLAN_FORMAT,
+        'corpus': os.path.abspath(corpus),
+        'embedding_model': embedding_model_id(),
+        'backend': settings.INDEX_BACKEND,
+        # Shards keep exact vectors, so the merged index is built (and trained) once over all of them.
+        'shard_backend': "flat_ip" if settings.INDEX_BACKEND != "flat_l2" else "flat_l2",
+        'shards': plan_shards(files, shards),
+    }
+    os.makedirs(build_dir, exist_ok=True)
+    _write_json(plan_path, plan)
+    logger.info(f"Planned {len(files)} files in {shards} shards in '{build_dir}'.")
+    return plan
+
+def load_plan(build_dir: str) -> dict:
+    plan_path = os.path.join(build_dir, PLAN_FILENAME)
+    if not os.path.exists(plan_path):
+        raise SystemExit(f"No plan in '{build_dir}'. Run the 'plan' command first.")
+    with open(plan_path, 'r', encoding='utf-8') as f:
+        plan = json.load(f)
+    if plan.get('format') != PLAN_FORMAT:
+        raise SystemExit(f"The plan in '{build_dir}' was written by another version of this tool.")
+    return plan
+
+def check_model(plan: dict):
+    """Refuses to mix vectors of different embedding models in one build."""
+    from encoder_service import embedding_model_id
+    if plan['embedding_model'] != embedding_model_id():
+        raise SystemExit(f"The plan was made for embedding model '{plan['embedding_model']}', but '{embedding_model_id()}' is configured.")
+
+def shard_dir(build_dir: str, shard: int) -> str:
+    return os.path.join(build_dir, "shards", f"shard-{shard:04d}")
+
+def complete_parts(directory: str, remove_incomplete: bool = False) -> list[str]:
+    """
+    Returns a shard's checkpointed parts in order. A part is complete once RAGVectorStore.save()
+    has written its manifest; parts interrupted before that are deleted if remove_incomplete.
+    """
+    from rag_utils import MANIFEST_FILENAME
+
+    if not os.path.isdir(directory):
+        return []
+    parts = []
+    for name in sorted(os.listdir(directory)):
+        part_dir = os.path.join(directory, name)
+        if not name.startswith("part-"):
+            continue
+        if os.path.exists(os.path.join(part_dir, MANIFEST_FILENAME)):
+            parts.append(part_dir)
+        elif remove_incomplete:
+            logger.info(f"Discarding interrupted checkpoint '{part_dir}'.")
+            shutil.rmtree(part_dir, ignore_errors=True)
+    return parts
+
+def attempted_sources(parts: list[str]) -> tuple[set[str], dict[str, str]]:
+    """
+    Returns the sources the parts account for (indexed, empty or failed) and the errors of the ones
+    whose latest attempt failed.
+    """
+    attempted, errors = set(), {}
+    for part_dir in parts:
+        with open(os.path.join(part_dir, ATTEMPTED_FILENAME), 'r', encoding='utf-8') as f:
+            record = json.load(f)
+        attempted.update(record['sources'])
+        for source in record['sources']:
+            errors.pop(source, None)  # a later part retried it
+        errors.update(record['errors'])
+    return attempted, errors
+
+def build_shard(build_dir: str, plan: dict, shard: int, files_per_checkpoint: int = 50, retry_failed: bool = False):
+    """
+    Builds one shard, checkpointing every files_per_checkpoint files as a new part: a complete saved
+    store of just those files. Rerunning resumes after the last complete part; with retry_failed,
+    files that failed in earlier parts are attempted again in new parts. A shard must only be
+    built by one process at a time; different shards can be built concurrently, on any machine
+    that sees the build directory and the corpus at the same paths.
+    """
+    from encoder_service import get_encoder
+    from ingestion import IngestJob, ingest_files
+    from rag_utils import RAGVectorStore, file_content_hash
+
+    check_model(plan)
+    directory = shard_dir(build_dir, shard)
+    os.makedirs(directory, exist_ok=True)
+    parts = complete_parts(directory, remove_incomplete=True)
+    attempted, failed = attempted_sources(parts)
+    if retry_failed and failed:
+        logger.info(f"Shard {shard}: retrying {len(failed)} failed files.")
+        attempted -= failed.keys()
+    todo = [f for f in plan['shards'][shard] if f['source'] not in attempted]
+    if not todo:
+        logger.info(f"Shard {shard} is already complete.")
+        return
+    logger.info(f"Shard {shard}: {len(attempted)} files done in {len(parts)} checkpoints, {len(todo)} to go.")
+
+    encoder = get_encoder()
+    next_part = int(os.path.basename(parts[-1]).removeprefix("part-")) + 1 if parts else 0
+    for start in range(0, len(todo), files_per_checkpoint):
+        batch = todo[start:start + files_per_checkpoint]
+        batch_start = time.perf_counter()
+        errors = {}
+        jobs = []
+        for f in batch:
+            try:
+                jobs.append(IngestJob(source=f['source'], path=f['path'], source_hash=file_content_hash(f['path'])))
+            except OSError as e:
+                logger.error(f"Cannot read '{f['path']}': {e}")
+                errors[f['source']] = str(e)
+
+        store = RAGVectorStore(embedding_model=encoder, backend=plan['shard_backend'])
+        ingest_files(store, jobs, errors=errors)
+        part_dir = os.path.join(directory, f"part-{next_part:05d}")
+        next_part += 1
+        os.makedirs(part_dir, exist_ok=True)
+        # Written before save(), whose manifest marks the part complete.
+        _write_json(os.path.join(part_dir, ATTEMPTED_FILENAME), {'sources': [f['source'] for f in batch], 'errors': errors})
+        store.save(part_dir)
+        parts.append(part_dir)
+        logger.info(
+            f"Shard {shard}: checkpoint {len(parts)} with {store.ntotal} chunks from {len(batch) - len(errors)} files "
+            f"in {time.perf_counter() - batch_start:.1f} seconds ({start + len(batch)}/{len(todo)} files)."
+        )
+
+def shard_status(build_dir: str, plan: dict) -> list[dict]:
+    """Reports how many of each shard's files are done and which failed."""
+    rows = []
+    for shard, files in enumerate(plan['shards']):
+        parts = complete_parts(shard_dir(build_dir, shard))
+        attempted, errors = attempted_sources(parts)
+        rows.append({'shard': shard, 'files': len(files), 'done': len(attempted), 'failed': errors, 'checkpoints': len(parts)})
+    return rows
+
+def build_all(build_dir: str, plan: dict, processes: int, files_per_checkpoint: int, retry_failed: bool = False) -> bool:
+    """
+    Builds every incomplete shard (and, with retry_failed, every shard with failed files), `processes`
+    at a time, each in its own process. Returns True if all succeeded.
+    """
+    pending = [row['shard'] for row in shard_status(build_dir, plan) if row['done'] < row['files'] or (retry_failed and row['failed'])]
+    running: dict[int, subprocess.Popen] = {}
+    failed = []
+    while pending or running:
+        while pending and len(running) < processes:
+            shard = pending.pop(0)
+            command = [sys.executable, os.path.abspath(__file__), "build", build_dir, "--shard", str(shard), "--files-per-checkpoint", str(files_per_checkpoint)]
+            if retry_failed:
+                command.append("--retry-failed")
+            running[shard] = subprocess.Popen(command)
+        time.sleep(0.5)
+        for shard, process in list(running.items()):
+            if process.poll() is not None:
+                del running[shard]
+                if process.returncode != 0:
+                    logger.error(f"Building shard {shard} failed with exit code {process.returncode}; rerun to resume it.")
+                    failed.append(shard)
+    return not failed
+
+def merge_shards(build_dir: str, plan: dict, output_dir: str, allow_incomplete: bool = False) -> dict:
+    """
+    Merges every checkpoint of every shard into one store with the plan's backend and saves it to
+    output_dir, where RAGVectorStore.load() (and so the app, via INDEX_DIR) can read it. Chunk ids
+    are reassigned densely; files whose content is already merged under another name are skipped.
+    """
+    from rag_utils import RAGVectorStore
+
+    check_model(plan)
+    incomplete = [row for row in shard_status(build_dir, plan) if row['done'] < row['files']]
+    if incomplete and not allow_incomplete:
+        raise SystemExit(f"Shards {', '.join(str(row['shard']) for row in incomplete)} are not complete; build them or pass --allow-incomplete.")
+
+    shard_parts = [complete_parts(shard_dir(build_dir, shard)) for shard in range(len(plan['shards']))]
+    # Take checkpoints round-robin across shards so the vectors an IVF index trains on (the first
+    # ones added) come from every shard, not just the first.
+    ordered = [parts[i] for i in range(max(map(len, shard_parts), default=0)) for parts in shard_parts if i < len(parts)]
+
+    store = RAGVectorStore(backend=plan['backend'])
+    merged_hashes = set()
+    duplicates = 0
+    for part_dir in ordered:
+        part = RAGVectorStore(embedding_model=store.embedding_model, backend=plan['shard_backend'])
+        if not part.load(part_dir):
+            raise SystemExit(f"Checkpoint '{part_dir}' could not be loaded.")
+        for source, chunk_ids in part.source_ids.items():
+            source_hash = part.source_hashes.get(source)
+            if source_hash in merged_hashes:
+                duplicates += 1
+                continue
+            merged_hashes.add(source_hash)
+            chunk_ids = list(chunk_ids)
+            texts = [part.documents[chunk_id]['text'] for chunk_id in chunk_ids]
+            store.add_texts(texts, source, source_hash=source_hash, embeddings=part.get_vectors(chunk_ids))
+            store.offline_sources.add(source)
+        logger.info(f"Merged '{part_dir}': {store.ntotal} chunks so far.")
+
+    store.save(output_dir)
+    summary = {'sources': len(store.source_hashes), 'chunks': store.ntotal, 'duplicates_skipped': duplicates, 'backend': store.backend}
+    logger.info(f"Merged index saved to '{output_dir}': {summary}")
+    return summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a large knowledge base offline in shards, then merge it into one servable index.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    plan_parser = commands.add_parser("plan", help="Split a corpus into shards.")
+    plan_parser.add_argument("corpus", help="A directory scanned recursively, or a manifest file listing one path per line.")
+    plan_parser.add_argument("build_dir")
+    plan_parser.add_argument("--shards", type=int, required=True)
+    plan_parser.add_argument("--force", action="store_true", help="Replace an existing plan and discard its shards.")
+
+    build_parser = commands.add_parser("build", help="Build (or resume) shards.")
+    build_parser.add_argument("build_dir")
+    build_parser.add_argument("--shard", type=int, nargs="*", help="Shards to build in this process; all incomplete shards if omitted.")
+    build_parser.add_argument("--processes", type=int, default=1, help="Shards built at once when --shard is omitted.")
+    build_parser.add_argument("--files-per-checkpoint", type=int, default=50)
+    build_parser.add_argument("--retry-failed", action="store_true", help="Attempt the files that failed in earlier runs again.")
+
+    status_parser = commands.add_parser("status", help="Show the progress of every shard.")
+    status_parser.add_argument("build_dir")
+
+    merge_parser = commands.add_parser("merge", help="Merge the shards into one index directory.")
+    merge_parser.add_argument("build_dir")
+    merge_parser.add_argument("--output", default=settings.INDEX_DIR, help="Directory to save the merged index to.")
+    merge_parser.add_argument("--allow-incomplete", action="store_true", help="Merge whatever the shards have checkpointed so far.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    for noisy in ("rag_utils", "ingestion", "pdf_utils", "chunking", "faiss.loader"):
+        logging.getLogger(noisy).setLevel(logging.WARNING)  # they log every file and chunk batch
+
+    if args.command == "plan":
+        plan = write_plan(args.build_dir, args.corpus, args.shards, args.force)
+        for shard, files in enumerate(plan['shards']):
+            print(f"shard {shard}: {len(files)} files")
+    elif args.command == "build":
+        plan = load_plan(args.build_dir)
+        if args.shard:
+            for shard in args.shard:
+                build_shard(args.build_dir, plan, shard, args.files_per_checkpoint, args.retry_failed)
+        elif not build_all(args.build_dir, plan, args.processes, args.files_per_checkpoint, args.retry_failed):
+            raise SystemExit(1)
+    elif args.command == "status":
+        for row in shard_status(args.build_dir, load_plan(args.build_dir)):
+            print(f"shard {row['shard']}: {row['done']}/{row['files']} files, {row['checkpoints']} checkpoints, {len(row['failed'])} failed")
+            for source, error in row['failed'].items():
+                print(f"  {source}: {error}")
+    else:
+        print(json.dumps(merge_shards(args.build_dir, load_plan(args.build_dir), args.output, args.allow_incomplete), indent=2))
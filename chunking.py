@@ -1,17 +1,25 @@
 # chunking.py
 
+from __future__ import annotations
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from scipy.signal import find_peaks
+from collections import deque
+from collections.abc import Iterable, Iterator
+from typing import TYPE_CHECKING
 import pysbd  # <-- IMPORT THE NEW LIBRARY
 import logging
+from config import settings
+from embedding_cache import EmbeddingCache, get_embedding_cache
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
 
 logger = logging.getLogger(__name__)
 
 class SemanticChunker:
     """Splits text into chunks based on semantic similarity."""
-    def __init__(self, embedding_model: SentenceTransformer):
+    def __init__(self, embedding_model: SentenceTransformer, embedding_cache: EmbeddingCache | None = None):
         self.model = embedding_model
+        self.embedding_cache = embedding_cache or get_embedding_cache()
         # Initialize the sentence segmenter from pysbd
         self.segmenter = pysbd.Segmenter(language="en", clean=False)
 
@@ -19,41 +27,187 @@ class SemanticChunker:
 
     def _calculate_distances(self, embeddings: np.ndarray) -> np.ndarray:
         """Calculates the cosine distance between consecutive sentence embeddings."""
-        distances = []
-        for i in range(len(embeddings) - 1):
-            # Normalize embeddings to unit vectors for cosine similarity calculation
-            norm_embed_i = embeddings[i] / np.linalg.norm(embeddings[i])
-            norm_embed_i_plus_1 = embeddings[i+1] / np.linalg.norm(embeddings[i+1])
-            dist = 1 - np.dot(norm_embed_i, norm_embed_i_plus_1)
-            distances.append(dist)
-        return np.array(distances)
-
-    def chunk(self, text: str, percentile_threshold: int = 95) -> list[str]:
-        """Chunks the text based on semantic breakpoints."""
-        # Use the new library to split sentences
-        sentences = self.segmenter.segment(text)
-
-        if len(sentences) < 3:
-            return [text]
+        # Normalize each embedding once, then take the row-wise dot product of neighbours.
+        normed = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return 1 - np.einsum('ij,ij->i', normed[:-1], normed[1:])
 
-        embeddings = self.model.encode(sentences, convert_to_numpy=True)
+    def find_spans(self, embeddings: np.ndarray, percentile_threshold: int = 95) -> list[tuple[int, int]]:
+        """Returns the (start, end) sentence span of every chunk, given the sentence embeddings."""
         distances = self._calculate_distances(embeddings)
-        
+
         if len(distances) == 0:
-            return [text]
+            return [(0, len(embeddings))]
+
+        from scipy.signal import find_peaks  # imported on first use: scipy.signal is slow to import
 
         threshold = np.percentile(distances, percentile_threshold)
         split_points, _ = find_peaks(distances, height=threshold)
 
-        chunks = []
+        spans = []
         start_idx = 0
         for point in split_points:
             end_idx = point + 1
-            chunks.append(" ".join(sentences[start_idx:end_idx]))
+            spans.append((start_idx, end_idx))
             start_idx = end_idx
 
         # Add the final chunk
-        chunks.append(" ".join(sentences[start_idx:]))
-        
-        # Filter out very small chunks
-        return [chunk for chunk in chunks if len(chunk.split()) > 10]
\ No newline at end of file
+        spans.append((start_idx, len(embeddings)))
+        return spans
+
+    def chunk_sentences(self, sentences: list[str], embeddings: np.ndarray, percentile_threshold: int = 95, pool: bool = False) -> tuple[list[str], np.ndarray | None]:
+        """
+        Chunks already segmented and encoded sentences. With pool=True a vector per chunk is also
+        returned, built by mean-pooling the sentence embeddings; otherwise the vectors are None.
+        """
+        chunks, vectors = [], []
+        for start, end in self.find_spans(embeddings, percentile_threshold):
+            chunk = " ".join(sentences[start:end])
+            # Filter out very small chunks
+            if len(chunk.split()) > 10:
+                chunks.append(chunk)
+                if pool:
+                    vectors.append(self._pool(embeddings[start:end]))
+        if not pool or not chunks:
+            return chunks, None
+        return chunks, np.vstack(vectors)
+
+    def _chunk(self, text: str, percentile_threshold: int, pool: bool) -> tuple[list[str], np.ndarray | None]:
+        # Use the new library to split sentences
+        sentences = self.segmenter.segment(text)
+
+        if len(sentences) < 3:
+            return [text], None
+
+        embeddings = self.embedding_cache.encode(self.model, sentences)
+        return self.chunk_sentences(sentences, embeddings, percentile_threshold, pool=pool)
+
+    def chunk(self, text: str, percentile_threshold: int = 95) -> list[str]:
+        """Chunks the text based on semantic breakpoints."""
+        return self._chunk(text, percentile_threshold, pool=False)[0]
+
+    def chunk_with_embeddings(self, text: str, percentile_threshold: int = 95) -> tuple[list[str], np.ndarray | None]:
+        """
+        Chunks the text like chunk() and also returns a vector per chunk, built by mean-pooling
+        the sentence embeddings already computed for breakpoint detection.
+        The vectors are None when the text was too short to be split; encode the chunks instead.
+        """
+        return self._chunk(text, percentile_threshold, pool=True)
+
+    @staticmethod
+    def _pool(embeddings: np.ndarray) -> np.ndarray:
+        """Mean-pools sentence embeddings into one chunk vector with the scale of an encode() output."""
+        vector = embeddings.mean(axis=0).astype('float32')
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def chunk_for_index(self, text: str, percentile_threshold: int = 95) -> tuple[list[str], np.ndarray | None]:
+        """
+        Chunks text for RAGVectorStore.add_texts. Returns precomputed chunk vectors when
+        settings.REUSE_SENTENCE_EMBEDDINGS is on, otherwise None so the store encodes the chunks.
+        """
+        if settings.REUSE_SENTENCE_EMBEDDINGS:
+            return self.chunk_with_embeddings(text, percentile_threshold)
+        return self.chunk(text, percentile_threshold), None
+
+    def _stream_groups(self, pieces: Iterable[str], percentile_threshold: int, window_size: int, max_chunk_sentences: int) -> Iterator[tuple[list[str], np.ndarray]]:
+        """
+        Yields (sentences, embeddings) for each chunk as soon as its closing breakpoint is final.
+        Only the sentences of the open chunk and the last window_size distances are held in memory.
+        """
+        if max_chunk_sentences < 2:
+            raise ValueError(f"max_chunk_sentences must be at least 2, got {max_chunk_sentences}.")
+        window = deque(maxlen=window_size)  # recent distances the threshold is computed over
+        sentences: list[str] = []            # sentences of the chunk still being built
+        embeddings = np.empty((0, 0), dtype='float32')
+        normed = embeddings
+        distances = np.empty(0, dtype='float32')  # distances[j] is the gap after sentences[j]
+        checked = 0                          # gaps in `distances` already ruled out as breakpoints
+        previous_gap = None                  # gap just before sentences[0], None at document start
+        carry = ""
+        total_sentences = 0
+        emitted = False
+
+        def batches():
+            nonlocal carry
+            for piece in pieces:
+                if not piece or piece.isspace():
+                    continue
+                segments = self.segmenter.segment(f"{carry}\n\n{piece}" if carry else piece)
+                # The last sentence of a piece may continue in the next one, so it waits.
+                carry = segments.pop() if segments else ""
+                if segments:
+                    yield segments
+            if carry and not carry.isspace():
+                yield [carry]
+
+        for batch in batches():
+            total_sentences += len(batch)
+            batch_embeddings = self.embedding_cache.encode(self.model, batch)
+            batch_normed = batch_embeddings / np.linalg.norm(batch_embeddings, axis=1, keepdims=True)
+            if len(sentences):
+                joined = np.vstack([normed[-1:], batch_normed])
+                new_distances = 1 - np.einsum('ij,ij->i', joined[:-1], joined[1:])
+            else:
+                new_distances = 1 - np.einsum('ij,ij->i', batch_normed[:-1], batch_normed[1:])
+                embeddings = np.empty((0, batch_embeddings.shape[1]), dtype='float32')
+                normed = embeddings
+            sentences.extend(batch)
+            embeddings = np.vstack([embeddings, batch_embeddings])
+            normed = np.vstack([normed, batch_normed])
+            distances = np.concatenate([distances, new_distances])
+            window.extend(new_distances.tolist())
+            threshold = np.percentile(window, percentile_threshold) if window else np.inf
+
+            # A gap is a breakpoint when it is a local peak above the windowed threshold,
+            # which can only be decided once the following gap is known.
+            j = checked
+            while j < len(distances) - 1:
+                left = distances[j - 1] if j > 0 else previous_gap
+                gap = distances[j]
+                if left is not None and gap > left and gap > distances[j + 1] and gap >= threshold:
+                    yield sentences[:j + 1], embeddings[:j + 1]
+                    emitted = True
+                    previous_gap = gap
+                    sentences, embeddings, normed = sentences[j + 1:], embeddings[j + 1:], normed[j + 1:]
+                    distances = distances[j + 1:]
+                    j = 0
+                    continue
+                j += 1
+            checked = j
+
+            # Bound memory when no breakpoint shows up: cut at the strongest gap seen so far.
+            while len(sentences) > max_chunk_sentences:
+                cut = int(np.argmax(distances[:max_chunk_sentences - 1]))
+                yield sentences[:cut + 1], embeddings[:cut + 1]
+                emitted = True
+                previous_gap = distances[cut]
+                sentences, embeddings, normed = sentences[cut + 1:], embeddings[cut + 1:], normed[cut + 1:]
+                distances = distances[cut + 1:]
+                checked = 0
+
+        if sentences:
+            if not emitted and total_sentences < 3:
+                # Mirror chunk(): text too short to split is returned whole and unfiltered.
+                yield [" ".join(sentences)], embeddings[:0]
+            else:
+                yield sentences, embeddings
+
+    def chunk_stream(self, pieces: Iterable[str], percentile_threshold: int = 95, window_size: int = 256, max_chunk_sentences: int = 256) -> Iterator[str]:
+        """
+        Streaming counterpart of chunk() for very large documents. Takes text incrementally
+        (e.g. page by page) and yields chunks as soon as they are final. The breakpoint
+        threshold is the percentile over the last window_size distances instead of the whole document.
+        """
+        for sentences, embeddings in self._stream_groups(pieces, percentile_threshold, window_size, max_chunk_sentences):
+            chunk = " ".join(sentences)
+            # Filter out very small chunks (short unsplit text is passed through like chunk())
+            if len(embeddings) == 0 or len(chunk.split()) > 10:
+                yield chunk
+
+    def chunk_stream_with_embeddings(self, pieces: Iterable[str], percentile_threshold: int = 95, window_size: int = 256, max_chunk_sentences: int = 256) -> Iterator[tuple[str, np.ndarray | None]]:
+        """Like chunk_stream(), but yields (chunk, pooled vector) pairs; the vector is None for unsplit short text."""
+        for sentences, embeddings in self._stream_groups(pieces, percentile_threshold, window_size, max_chunk_sentences):
+            chunk = " ".join(sentences)
+            if len(embeddings) == 0:
+                yield chunk, None
+            elif len(chunk.split()) > 10:
+                yield chunk, self._pool(embeddings)
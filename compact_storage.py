@@ -0,0 +1,103 @@
+# compact_storage.py
+
+import sys
+from array import array
+from collections.abc import MutableMapping
+
+class ColumnarDocuments(MutableMapping):
+    """
+    Drop-in replacement for the `chunk id -> {'id', 'text', 'source'}` dict of RAGVectorStore
+    that stores chunks column-wise: all texts in one UTF-8 buffer addressed by an offsets array,
+    and sources as small integer ids into an interned name table. Document dicts are only built
+    when a chunk is read, so a search materializes just its top-k hits.
+
+    Chunk ids must be added in increasing order (RAGVectorStore assigns them sequentially);
+    the row of a chunk is its id minus first_id, so removed rows stay as empty placeholders.
+    """
+    def __init__(self, first_id: int = 0):
+        self.first_id = first_id
+        self._text = bytearray()
+        self._offsets = array('q', [0])  # row r spans _text[_offsets[r]:_offsets[r + 1]]
+        self._source_of = array('i')  # row -> index into _sources
+        self._alive = bytearray()  # row -> 1 while the chunk is indexed
+        self._sources: list[str] = []
+        self._source_index: dict[str, int] = {}
+        self._live = 0
+        self._dead_bytes = 0
+
+    def _row(self, chunk_id: int) -> int:
+        row = chunk_id - self.first_id
+        if 0 <= row < len(self._alive) and self._alive[row]:
+            return row
+        raise KeyError(chunk_id)
+
+    def _intern(self, source: str) -> int:
+        source_id = self._source_index.get(source)
+        if source_id is None:
+            source_id = self._source_index[source] = len(self._sources)
+            self._sources.append(source)
+        return source_id
+
+    def __getitem__(self, chunk_id: int) -> dict:
+        row = self._row(chunk_id)
+        text = self._text[self._offsets[row]:self._offsets[row + 1]].decode('utf-8')
+        return {'id': chunk_id, 'text': text, 'source': self._sources[self._source_of[row]]}
+
+    def __setitem__(self, chunk_id: int, doc: dict):
+        row = chunk_id - self.first_id
+        if row < len(self._alive):
+            raise ValueError(f"Chunk ids must be added in increasing order; {chunk_id} is not after the last id.")
+        while len(self._alive) < row:  # ids skipped by earlier removals
+            self._append(b"", 0, alive=False)
+        self._append(doc['text'].encode('utf-8'), self._intern(doc['source']), alive=True)
+
+    def _append(self, text: bytes, source_id: int, alive: bool):
+        self._text += text
+        self._offsets.append(len(self._text))
+        self._source_of.append(source_id)
+        self._alive.append(1 if alive else 0)
+        self._live += alive
+
+    def __delitem__(self, chunk_id: int):
+        row = self._row(chunk_id)
+        self._alive[row] = 0
+        self._live -= 1
+        self._dead_bytes += self._offsets[row + 1] - self._offsets[row]
+
+    def __contains__(self, chunk_id) -> bool:
+        row = chunk_id - self.first_id
+        return 0 <= row < len(self._alive) and bool(self._alive[row])
+
+    def __iter__(self):
+        for row, alive in enumerate(self._alive):
+            if alive:
+                yield self.first_id + row
+
+    def __len__(self) -> int:
+        return self._live
+
+    def compact(self):
+        """Rewrites the text buffer without the texts of removed chunks. Row positions are kept."""
+        if not self._dead_bytes:
+            return
+        text = bytearray()
+        offsets = array('q', [0])
+        for row, alive in enumerate(self._alive):
+            if alive:
+                text += self._text[self._offsets[row]:self._offsets[row + 1]]
+            offsets.append(len(text))
+        self._text, self._offsets, self._dead_bytes = text, offsets, 0
+
+    def nbytes(self) -> int:
+        """Approximate memory held by the stored chunks, including the interned source table."""
+        columns = len(self._text) + self._offsets.itemsize * len(self._offsets) + self._source_of.itemsize * len(self._source_of) + len(self._alive)
+        return columns + sum(sys.getsizeof(source) for source in self._sources)
+
+def dict_documents_nbytes(documents: dict) -> int:
+    """Approximate memory of a plain `chunk id -> document dict` store, for comparison with ColumnarDocuments."""
+    total = sys.getsizeof(documents)
+    sources = set()
+    for chunk_id, doc in documents.items():
+        total += sys.getsizeof(chunk_id) + sys.getsizeof(doc) + sys.getsizeof(doc['text'])
+        sources.add(doc['source'])
+    return total + sum(sys.getsizeof(source) for source in sources)
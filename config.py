@@ -8,21 +8,97 @@ class Settings:
     PROJECT_NAME: str = "FlowChat: AquaQuery Oceanographic Assistant"
 
     # --- API Keys & Models ---
-    GROQ_API_KEY: str = os.getenv("GROQ_API_KEY")
+    GROQ_API_KEY: str | None = os.getenv("GROQ_API_KEY")
     LLM_MODEL: str = os.getenv("LLM_MODEL", "llama3-70b-8192")
+    LLM_BASE_URL: str = os.getenv("LLM_BASE_URL", "https://api.groq.com/openai/v1") # Any OpenAI-compatible endpoint
+
+    # --- LLM Client ---
+    LLM_MAX_CONNECTIONS: int = 20 # Pooled HTTP connections shared by all sessions
+    LLM_TTFT_DEADLINE_SECONDS: float = float(os.getenv("LLM_TTFT_DEADLINE_SECONDS", "4.0")) # Hedge (or retry) if no token by then
+    LLM_HEDGE_REQUESTS: bool = os.getenv("LLM_HEDGE_REQUESTS", "true").lower() == "true"
+    LLM_MAX_RETRIES: int = 3
+    LLM_BACKOFF_BASE_SECONDS: float = 0.5
+    LLM_BACKOFF_MAX_SECONDS: float = 8.0
+    LLM_REQUEST_TIMEOUT_SECONDS: float = 60.0
 
     # --- File Handling ---
-    UPLOAD_DIR: str = "temp_uploaded_pdfs"
+    INDEX_DIR: str = os.getenv("INDEX_DIR", "index_store") # Persisted FAISS index + document store
 
     # --- RAG Configuration ---
     EMBEDDING_MODEL_NAME: str = "all-MiniLM-L6-v2"
     TOP_K: int = 5 # Number of relevant chunks to retrieve
 
-settings = Settings()
+    # --- Context Packing ---
+    CONTEXT_CANDIDATES: int = 20 # Chunks retrieved before de-duplication and MMR pick the TOP_K sent to the LLM
+    CONTEXT_TOKEN_BUDGET: int = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2000")) # Approximate prompt tokens spent on excerpts
+    CONTEXT_DUPLICATE_SIMILARITY: float = 0.92 # Chunks at least this similar to a more relevant one are dropped
+    CONTEXT_MMR_LAMBDA: float = 0.7 # 1.0 = pure relevance, lower values favour diverse excerpts
+
+    # --- Vector Index Backend ---
+    # flat_l2 (legacy brute force on raw vectors), flat_ip (exact cosine), flat_fp16 / flat_sq8
+    # (cosine over half-precision / int8 scalar-quantized vectors), ivf_flat, ivf_pq or hnsw
+    INDEX_BACKEND: str = os.getenv("INDEX_BACKEND", "flat_ip")
+    IVF_NLIST: int = int(os.getenv("IVF_NLIST", "1024")) # Coarse clusters; IVF trains once ~39x this many vectors exist
+    IVF_NPROBE: int = int(os.getenv("IVF_NPROBE", "16")) # Clusters scanned per query: higher = better recall, slower
+    IVF_PQ_M: int = 48 # PQ sub-quantizers; must divide the embedding dimension (384 for MiniLM)
+    IVF_PQ_NBITS: int = 8
+    HNSW_M: int = 32
+    HNSW_EF_CONSTRUCTION: int = 80
+    HNSW_EF_SEARCH: int = int(os.getenv("HNSW_EF_SEARCH", "64")) # Candidates explored per query
+    SQ8_TRAIN_SIZE: int = 1000 # Vectors flat_sq8 collects before learning its per-dimension int8 ranges
+    RECALL_SAMPLE_SIZE: int = 10000 # Stored vectors recall@k is measured over (re-encoded for flat_sq8 / ivf_pq)
+    COMPACT_DELETED_FRACTION: float = 0.2 # Removed chunks are filtered at search time until they exceed this share of the index
+    # Keep chunk texts in one contiguous buffer and sources in an interned table instead of a dict
+    # per chunk. Pair with flat_fp16 / flat_sq8 for the smallest per-session memory footprint.
+    COMPACT_STORAGE: bool = os.getenv("COMPACT_STORAGE", "false").lower() == "true"
+
+    # --- Embedding Cache ---
+    EMBEDDING_CACHE_SIZE: int = int(os.getenv("EMBEDDING_CACHE_SIZE", "20000")) # Vectors kept in memory (LRU)
+    EMBEDDING_CACHE_DIR: str | None = os.getenv("EMBEDDING_CACHE_DIR") # Optional on-disk tier; unset to disable
+    EMBEDDING_CACHE_DISK_SIZE: int = int(os.getenv("EMBEDDING_CACHE_DISK_SIZE", "1000000")) # Vectors kept on disk (LRU by last access)
+    # Build chunk vectors by mean-pooling the sentence embeddings the chunker already computed,
+    # instead of encoding each chunk again. Faster ingestion, slightly different vectors.
+    REUSE_SENTENCE_EMBEDDINGS: bool = os.getenv("REUSE_SENTENCE_EMBEDDINGS", "false").lower() == "true"
+
+    # --- Encoder ---
+    # Concurrent small requests (queries from different sessions) wait this long to be encoded
+    # together; 0 encodes every request on its caller's thread.
+    ENCODER_BATCH_WINDOW_MS: float = float(os.getenv("ENCODER_BATCH_WINDOW_MS", "5"))
+    ENCODER_MAX_BATCH_SIZE: int = 128 # Texts per model call; requests this large skip the coalescing window
+    ENCODER_MAX_BATCH_TOKENS: int = 8192 # Padded tokens (texts x longest text) per model call
+    ENCODER_INT8: bool = os.getenv("ENCODER_INT8", "false").lower() == "true" # Dynamic int8 quantization (CPU only)
+
+    # --- Answer Cache ---
+    ANSWER_CACHE_SIMILARITY: float = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95")) # Min cosine similarity between questions
+    ANSWER_CACHE_TTL_SECONDS: int = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+    ANSWER_CACHE_SIZE: int = 1000 # Cached answers kept (LRU)
 
-# --- Initial Setup ---
-if not os.path.exists(settings.UPLOAD_DIR):
-    os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
+    # --- PDF Extraction ---
+    PDF_PAGE_CACHE_SIZE: int = 5000 # Extracted pages kept (LRU) so re-uploads skip unchanged pages
+    PDF_PARALLEL_MIN_PAGES: int = 64 # Documents with at least this many pages to extract are split across processes
+    PDF_PAGES_PER_TASK: int = 16 # Pages per range handed to one extraction process
+
+    # --- Session Memory ---
+    # Uploads of all sessions together may hold this much memory; beyond it, the least recently
+    # used idle sessions' private indexes are spilled to a per-process directory under
+    # SESSION_SPILL_DIR and reloaded on use.
+    SESSION_MEMORY_BUDGET_MB: int = int(os.getenv("SESSION_MEMORY_BUDGET_MB", "1024"))
+    SESSION_SPILL_DIR: str = os.getenv("SESSION_SPILL_DIR", "session_spill")
+    SESSION_MIN_IDLE_SECONDS: float = 120.0 # Sessions used more recently than this are never spilled
+
+    # --- Metrics ---
+    METRICS_ENABLED: bool = os.getenv("METRICS_ENABLED", "true").lower() == "true" # Per-stage latency histograms; off = no-op spans
+    METRICS_TEXTFILE: str | None = os.getenv("METRICS_TEXTFILE") # Optional path rewritten in Prometheus text format after each answer
+
+    # --- Ingestion Pipeline ---
+    INGEST_WORKERS: int = int(os.getenv("INGEST_WORKERS", str(min(4, os.cpu_count() or 1)))) # Extraction/segmentation processes
+    INGEST_ENCODE_BATCH: int = 2048 # Sentences collected across files before one encoder call
+    INGEST_QUEUE_SIZE: int = 8 # Bound on files waiting between pipeline stages
+    INGEST_STREAM_MIN_PAGES: int = 200 # PDFs with at least this many pages are chunked page by page instead of whole
+    INGEST_STREAM_MAX_CHUNK_SENTENCES: int = 256 # Longest chunk a streamed PDF may hold open before it is cut
+    INGEST_STREAM_GROUP_CHUNKS: int = 64 # Chunks of a streamed PDF handed to the index writer at a time
+
+settings = Settings()
 
-if not settings.GROQ_API_KEY:
-    raise ValueError("GROQ_API_KEY not found. Please set it in your .env file or as an environment variable.")
\ No newline at end of file
+# Nothing else happens at import time: a missing GROQ_API_KEY is reported by the app and raised by
+# llm_utils when a request is made.
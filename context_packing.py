@@ -0,0 +1,108 @@
+# context_packing.py
+
+import logging
+import math
+from dataclasses import dataclass, field
+import numpy as np
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+CHARS_PER_TOKEN = 4  # rough average for English prose with Llama-family tokenizers
+MIN_TRUNCATED_TOKENS = 64  # don't bother sending a truncated excerpt smaller than this
+
+@dataclass
+class PackedContext:
+    """The excerpts chosen for a prompt, the formatted context, and what packing saved."""
+    docs: list[dict] = field(default_factory=list)
+    context: str = ""
+    tokens_used: int = 0
+    tokens_saved: int = 0
+    dropped_duplicates: int = 0
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate; the LLM tokenizer is not available locally."""
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def format_context(docs: list[dict]) -> str:
+    """Formats retrieved chunks as the context block of the RAG prompt."""
+    context_parts = [f"--- Excerpt from {doc['source']} ---\n{doc['text']}" for doc in docs]
+    return "\n\n".join(context_parts)
+
+def _truncate(doc: dict, max_tokens: int) -> dict:
+    """Shortens a chunk to roughly max_tokens, cutting at a word boundary."""
+    limit = max_tokens * CHARS_PER_TOKEN
+    text = doc['text'][:limit].rsplit(" ", 1)[0]
+    return {**doc, 'text': f"{text} …"}
+
+def pack_context(
+    query_emb: np.ndarray,
+    candidates: list[dict],
+    candidate_vectors: np.ndarray,
+    top_k: int = settings.TOP_K,
+    token_budget: int = settings.CONTEXT_TOKEN_BUDGET,
+    duplicate_similarity: float = settings.CONTEXT_DUPLICATE_SIMILARITY,
+    mmr_lambda: float = settings.CONTEXT_MMR_LAMBDA,
+) -> PackedContext:
+    """
+    Chooses up to top_k of the retrieved candidates (ordered by relevance) for the prompt:
+    near-duplicates of a more relevant chunk are dropped, the rest are picked by maximal
+    marginal relevance, and excerpts are added until the token budget is spent.
+    tokens_saved compares against the unpacked prompt, the top_k candidates as retrieved. It can be
+    negative when packing swaps a dropped short duplicate for a longer excerpt.
+    """
+    if not candidates:
+        return PackedContext()
+
+    vectors = np.asarray(candidate_vectors, dtype='float32')
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    query = np.asarray(query_emb, dtype='float32').reshape(-1)
+    query = query / max(float(np.linalg.norm(query)), 1e-12)
+    relevance = vectors @ query
+    similarity = vectors @ vectors.T
+
+    # Candidates arrive most relevant first, so each duplicate group keeps its best member.
+    kept = []
+    for i in range(len(candidates)):
+        if all(similarity[i, j] < duplicate_similarity for j in kept):
+            kept.append(i)
+    dropped_duplicates = len(candidates) - len(kept)
+
+    selected, docs = [], []
+    tokens_used = 0
+    remaining = list(kept)
+    separator_tokens = estimate_tokens("\n\n")
+    while remaining and len(selected) < top_k:
+        if selected:
+            redundancy = similarity[np.ix_(remaining, selected)].max(axis=1)
+        else:
+            redundancy = np.zeros(len(remaining), dtype='float32')
+        scores = mmr_lambda * relevance[remaining] - (1 - mmr_lambda) * redundancy
+        best = remaining.pop(int(np.argmax(scores)))
+
+        doc = candidates[best]
+        cost = estimate_tokens(format_context([doc])) + (separator_tokens if docs else 0)
+        budget_left = token_budget - tokens_used
+        if cost > budget_left:
+            if budget_left - separator_tokens < MIN_TRUNCATED_TOKENS:
+                break
+            doc = _truncate(doc, budget_left - separator_tokens - estimate_tokens(format_context([{**doc, 'text': ''}])))
+            cost = estimate_tokens(format_context([doc])) + (separator_tokens if docs else 0)
+        selected.append(best)
+        docs.append(doc)
+        tokens_used += cost
+
+    context = format_context(docs)
+    baseline = estimate_tokens(format_context(candidates[:top_k]))
+    packed = PackedContext(
+        docs=docs,
+        context=context,
+        tokens_used=estimate_tokens(context),
+        tokens_saved=baseline - estimate_tokens(context),
+        dropped_duplicates=dropped_duplicates,
+    )
+    logger.info(
+        f"Packed {len(docs)} of {len(candidates)} candidates into ~{packed.tokens_used} tokens "
+        f"(saved ~{packed.tokens_saved}, dropped {dropped_duplicates} near-duplicates)."
+    )
+    return packed
@@ -0,0 +1,165 @@
+# embedding_cache.py
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from config import settings
+from encoder_service import embedding_model_id
+
+logger = logging.getLogger(__name__)
+
+class EmbeddingCache:
+    """
+    Text-hash keyed cache of embeddings with LRU eviction in memory and an optional
+    SQLite disk tier that survives restarts. The disk tier is bounded too: beyond
+    max_disk_entries rows, the least recently accessed ones are deleted. Safe to share between threads.
+    """
+    def __init__(
+        self,
+        model_name: str,
+        max_entries: int = settings.EMBEDDING_CACHE_SIZE,
+        disk_dir: str | None = None,
+        max_disk_entries: int = settings.EMBEDDING_CACHE_DISK_SIZE,
+    ):
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self._entries: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        self._disk_rows = 0
+        self._accessed: dict[str, float] = {}  # access times not yet written to disk
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._db = sqlite3.connect(os.path.join(disk_dir, "embeddings.sqlite3"), check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, accessed REAL NOT NULL DEFAULT 0)")
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(embeddings)")]
+            if "accessed" not in columns:
+                # Caches written before the disk tier was bounded; their rows are evicted first.
+                self._db.execute("ALTER TABLE embeddings ADD COLUMN accessed REAL NOT NULL DEFAULT 0")
+            self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_accessed ON embeddings (accessed)")
+            self._db.commit()
+            self._disk_rows = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            logger.info(f"Embedding cache disk tier enabled at '{disk_dir}' ({self._disk_rows} vectors).")
+
+    def _key(self, text: str) -> str:
+        # The model name is part of the key so a model change never serves stale vectors.
+        return hashlib.sha1(f"{self.model_name}\x00{text}".encode('utf-8')).hexdigest()
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self._entries[key] = vector
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _lookup(self, keys: list[str]) -> dict[str, np.ndarray]:
+        """Returns the cached vectors for the given keys, checking memory first and then disk."""
+        found = {}
+        with self._lock:
+            for key in keys:
+                vector = self._entries.get(key)
+                if vector is not None:
+                    self._entries.move_to_end(key)
+                    found[key] = vector
+            missing = [key for key in keys if key not in found]
+            if self._db is not None and missing:
+                for start in range(0, len(missing), 500):
+                    batch = missing[start:start + 500]
+                    placeholders = ",".join("?" * len(batch))
+                    rows = self._db.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch)
+                    for key, blob in rows:
+                        vector = np.frombuffer(blob, dtype='float32')
+                        self._remember(key, vector)
+                        found[key] = vector
+            if self._db is not None and found:
+                # Hits served from memory are accesses too; their times reach disk with the next write.
+                now = time.time()
+                self._accessed.update(dict.fromkeys(found, now))
+                if len(self._accessed) >= 1000:
+                    self._write_accessed()
+                    self._db.commit()
+        return found
+
+    def _write_accessed(self):
+        """Writes the pending access times to disk. Called with the lock held."""
+        self._db.executemany("UPDATE embeddings SET accessed = ? WHERE key = ?", [(at, key) for key, at in self._accessed.items()])
+        self._accessed.clear()
+
+    def _store(self, items: dict[str, np.ndarray]):
+        with self._lock:
+            for key, vector in items.items():
+                self._remember(key, vector)
+            if self._db is not None:
+                now = time.time()
+                inserted = self._db.executemany(
+                    "INSERT OR IGNORE INTO embeddings (key, vector, accessed) VALUES (?, ?, ?)",
+                    [(key, vector.tobytes(), now) for key, vector in items.items()],
+                ).rowcount
+                self._disk_rows += max(inserted, 0)
+                self._write_accessed()
+                if self._disk_rows > self.max_disk_entries:
+                    self._evict_disk()
+                self._db.commit()
+
+    def _evict_disk(self):
+        """Deletes the least recently accessed rows, down to 90% of the cap so eviction is not run on every write."""
+        excess = self._disk_rows - int(self.max_disk_entries * 0.9)
+        deleted = self._db.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY accessed LIMIT ?)", (excess,)
+        ).rowcount
+        self._disk_rows -= deleted
+        logger.info(f"Evicted {deleted} least recently used vectors from the embedding cache disk tier.")
+
+    def encode(self, model, texts: list[str]) -> np.ndarray:
+        """Returns float32 embeddings for texts, encoding only the ones not already cached."""
+        keys = [self._key(text) for text in texts]
+        found = self._lookup(list(dict.fromkeys(keys)))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing.setdefault(key, text)
+
+        batch_hits = sum(1 for key in keys if key in found)
+        with self._lock:
+            self.hits += batch_hits
+            self.misses += len(keys) - batch_hits
+        if missing:
+            vectors = model.encode(list(missing.values()), convert_to_numpy=True, show_progress_bar=False).astype('float32')
+            new_items = {key: vector.copy() for key, vector in zip(missing.keys(), vectors)}
+            self._store(new_items)
+            found.update(new_items)
+
+        if not texts:
+            return np.empty((0, model.get_sentence_embedding_dimension()), dtype='float32')
+        return np.vstack([found[key] for key in keys])
+
+    def clear(self):
+        """Drops the in-memory vectors (the disk tier is kept) and resets the hit/miss counts."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        """Returns hit/miss counts and the number of vectors held in memory and on disk."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'disk_entries': self._disk_rows}
+
+_cache_lock = threading.Lock()
+_embedding_caches: dict[str, EmbeddingCache] = {}
+
+def get_embedding_cache(model_name: str | None = None) -> EmbeddingCache:
+    """Returns the process-wide embedding cache for model_name (the encoder's model id by default), shared by chunking and indexing."""
+    model_name = model_name or embedding_model_id()
+    with _cache_lock:
+        if model_name not in _embedding_caches:
+            _embedding_caches[model_name] = EmbeddingCache(model_name, disk_dir=settings.EMBEDDING_CACHE_DIR)
+        return _embedding_caches[model_name]
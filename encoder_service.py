@@ -0,0 +1,208 @@
+# encoder_service.py
+
+from __future__ import annotations
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import TYPE_CHECKING
+import numpy as np
+from config import settings
+from context_packing import estimate_tokens
+from metrics import get_metrics
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
+logger = logging.getLogger(__name__)
+
+def embedding_model_id(model_name: str | None = None) -> str:
+    """
+    Names the vectors the encoder produces. The int8 path gives slightly different vectors, so it
+    gets its own embedding cache entries and saved indexes are rebuilt when it is switched.
+    """
+    model_name = model_name or settings.EMBEDDING_MODEL_NAME
+    return f"{model_name}+int8" if settings.ENCODER_INT8 else model_name
+
+def quantize_int8(model: SentenceTransformer) -> SentenceTransformer:
+    """Returns a copy of a CPU model with its Linear layers dynamically quantized to int8."""
+    import torch
+    if model.device.type != 'cpu':
+        logger.warning(f"int8 encoding needs a CPU model; the model is on {model.device}. Using it unquantized.")
+        return model
+    quantized = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    logger.info("Encoder Linear layers quantized to int8.")
+    return quantized
+
+class BatchingEncoder:
+    """
+    Drop-in replacement for a SentenceTransformer's encode(), shared by ingestion and queries.
+    Inputs are sorted by token length and cut into micro-batches under a padded-token budget,
+    so short sentences run in large batches and long ones don't pad the short ones. Small
+    concurrent requests (queries from different sessions) wait up to window_ms on a dispatcher
+    thread and are encoded together. Safe to share between threads.
+    """
+    def __init__(
+        self,
+        model,
+        window_ms: float = settings.ENCODER_BATCH_WINDOW_MS,
+        max_batch_size: int = settings.ENCODER_MAX_BATCH_SIZE,
+        max_batch_tokens: int = settings.ENCODER_MAX_BATCH_TOKENS,
+        int8: bool = settings.ENCODER_INT8,
+    ):
+        self.model = quantize_int8(model) if int8 else model
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self._queue: queue.Queue[tuple[list[str], Future]] = queue.Queue()
+        self._thread: threading.Thread | None = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._reset_counts()
+
+    def _reset_counts(self):
+        self.sentences = 0
+        self.requests = 0
+        self.batches = 0
+        self.dispatches = 0
+        self.coalesced_requests = 0
+        self.max_seen_batch = 0
+        self.encode_seconds = 0.0
+        self.real_tokens = 0
+        self.padded_tokens = 0
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.model.get_sentence_embedding_dimension()
+
+    def encode(self, sentences: str | list[str], convert_to_numpy: bool = True, show_progress_bar: bool = False) -> np.ndarray:
+        """Encodes one text into a (d,) array or a list of texts into an (n, d) float32 array."""
+        if isinstance(sentences, str):
+            return self.encode([sentences])[0]
+        texts = list(sentences)
+        if not texts:
+            return np.empty((0, self.get_sentence_embedding_dimension()), dtype='float32')
+        # Requests that fill a micro-batch on their own (ingestion) gain nothing from waiting,
+        # and would hold up the queries queued behind them; encode those on the caller's thread.
+        if self.window <= 0 or len(texts) >= self.max_batch_size:
+            return self._encode_bucketed(texts, requests=1)
+        self._ensure_dispatcher()
+        future = Future()
+        self._queue.put((texts, future))
+        return future.result()
+
+    def _ensure_dispatcher(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._dispatch, name="encoder-dispatcher", daemon=True)
+                self._thread.start()
+
+    def _dispatch(self):
+        """Collects requests for up to one window (or until a micro-batch is full) and encodes them together."""
+        while True:
+            pending = [self._queue.get()]
+            count = len(pending[0][0])
+            deadline = time.perf_counter() + self.window
+            while count < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                pending.append(request)
+                count += len(request[0])
+
+            texts = [text for request_texts, _ in pending for text in request_texts]
+            try:
+                vectors = self._encode_bucketed(texts, requests=len(pending))
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            offset = 0
+            for request_texts, future in pending:
+                future.set_result(vectors[offset:offset + len(request_texts)])
+                offset += len(request_texts)
+
+    def token_lengths(self, texts: list[str]) -> list[int]:
+        """Token count of each text as the model will see it (truncated to its max_seq_length)."""
+        tokenizer = getattr(self.model, 'tokenizer', None)
+        max_length = getattr(self.model, 'max_seq_length', None) or 512
+        if tokenizer is None:
+            return [min(estimate_tokens(text) + 2, max_length) for text in texts]
+        encoded = tokenizer(texts, add_special_tokens=True, truncation=True, max_length=max_length)
+        return [len(ids) for ids in encoded['input_ids']]
+
+    def _buckets(self, lengths: list[int]) -> list[list[int]]:
+        """Groups text indices, shortest first, into batches whose padded size stays under the token budget."""
+        batches, current = [], []
+        for index in sorted(range(len(lengths)), key=lengths.__getitem__):
+            # Sorted ascending, so this text is the longest of the batch and sets its padded length.
+            if current and (len(current) >= self.max_batch_size or (len(current) + 1) * lengths[index] > self.max_batch_tokens):
+                batches.append(current)
+                current = []
+            current.append(index)
+        if current:
+            batches.append(current)
+        return batches
+
+    def _encode_bucketed(self, texts: list[str], requests: int) -> np.ndarray:
+        lengths = self.token_lengths(texts)
+        vectors = None
+        metrics = get_metrics()
+        start = time.perf_counter()
+        for batch in self._buckets(lengths):
+            batch_vectors = self.model.encode([texts[i] for i in batch], batch_size=len(batch), convert_to_numpy=True, show_progress_bar=False)
+            if vectors is None:
+                vectors = np.empty((len(texts), batch_vectors.shape[1]), dtype='float32')
+            vectors[batch] = batch_vectors
+            with self._stats_lock:
+                self.batches += 1
+                self.max_seen_batch = max(self.max_seen_batch, len(batch))
+                self.real_tokens += sum(lengths[i] for i in batch)
+                self.padded_tokens += len(batch) * lengths[batch[-1]]
+            metrics.observe("encoder.batch_size", len(batch))
+        elapsed = time.perf_counter() - start
+        with self._stats_lock:
+            self.sentences += len(texts)
+            self.requests += requests
+            self.dispatches += 1
+            self.coalesced_requests += requests - 1
+            self.encode_seconds += elapsed
+        metrics.observe("encoder.encode", elapsed)
+        if elapsed > 0:
+            metrics.observe("encoder.sentences_per_second", len(texts) / elapsed)
+        return vectors
+
+    def stats(self) -> dict:
+        """Returns throughput (sentences/sec of model time) and micro-batch statistics."""
+        with self._stats_lock:
+            return {
+                'sentences': self.sentences,
+                'requests': self.requests,
+                'batches': self.batches,
+                'sentences_per_second': self.sentences / self.encode_seconds if self.encode_seconds else 0.0,
+                'mean_batch_size': self.sentences / self.batches if self.batches else 0.0,
+                'max_batch_size': self.max_seen_batch,
+                'requests_per_dispatch': self.requests / self.dispatches if self.dispatches else 0.0,
+                'coalesced_requests': self.coalesced_requests,
+                'padding_efficiency': self.real_tokens / self.padded_tokens if self.padded_tokens else 1.0,
+            }
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._reset_counts()
+
+_encoder_lock = threading.Lock()
+_encoders: dict[str, BatchingEncoder] = {}
+
+def get_encoder(model_name: str = settings.EMBEDDING_MODEL_NAME) -> BatchingEncoder:
+    """Returns the process-wide batching encoder around the embedding model, loading it on first use."""
+    from rag_utils import get_embedding_model
+    model = get_embedding_model(model_name)
+    with _encoder_lock:
+        if model_name not in _encoders:
+            _encoders[model_name] = BatchingEncoder(model)
+        return _encoders[model_name]
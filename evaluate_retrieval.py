@@ -0,0 +1,87 @@
+# evaluate_retrieval.py
+
+import argparse
+import json
+import logging
+import time
+import numpy as np
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+def load_questions(path: str) -> list[dict]:
+    """
+    Reads a JSONL question set. Each line needs a "question" and the "expected_sources"
+    (list of document names) that should be retrieved for it.
+    """
+    questions = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if not item.get('question') or not item.get('expected_sources'):
+                raise ValueError(f"{path}:{line_number}: each line needs 'question' and 'expected_sources'.")
+            questions.append(item)
+    return questions
+
+def score(retrieved_sources: list[str], expected_sources: list[str]) -> tuple[float, float]:
+    """Returns (recall, reciprocal rank) of one result list against the expected sources."""
+    expected = set(expected_sources)
+    recall = len(expected & set(retrieved_sources)) / len(expected)
+    reciprocal_rank = next((1.0 / rank for rank, source in enumerate(retrieved_sources, start=1) if source in expected), 0.0)
+    return recall, reciprocal_rank
+
+def evaluate(rag_store, questions: list[dict], k: int = settings.TOP_K, batch_size: int = 64) -> dict:
+    """
+    Runs the question set through rag_store.query_batch() in batches and reports recall@k, MRR,
+    throughput and per-query latency percentiles. Every query in a batch is charged the latency
+    of its whole batch, since that is when its results become available.
+    """
+    recalls, reciprocal_ranks, latencies = [], [], []
+    start = time.perf_counter()
+    for offset in range(0, len(questions), batch_size):
+        batch = questions[offset:offset + batch_size]
+        batch_start = time.perf_counter()
+        results = rag_store.query_batch([item['question'] for item in batch], top_k=k)
+        batch_elapsed = time.perf_counter() - batch_start
+        latencies.extend([batch_elapsed] * len(batch))
+        for item, docs in zip(batch, results):
+            recall, reciprocal_rank = score([doc['source'] for doc in docs], item['expected_sources'])
+            recalls.append(recall)
+            reciprocal_ranks.append(reciprocal_rank)
+    elapsed = time.perf_counter() - start
+
+    if not questions:
+        return {'questions': 0, 'k': k, 'batch_size': batch_size}
+    return {
+        'questions': len(questions),
+        'k': k,
+        'batch_size': batch_size,
+        f'recall@{k}': float(np.mean(recalls)),
+        'mrr': float(np.mean(reciprocal_ranks)),
+        'queries_per_second': len(questions) / elapsed if elapsed else float('inf'),
+        'latency_p50_ms': 1000 * float(np.percentile(latencies, 50)),
+        'latency_p95_ms': 1000 * float(np.percentile(latencies, 95)),
+    }
+
+if __name__ == "__main__":
+    from rag_utils import RAGVectorStore
+
+    parser = argparse.ArgumentParser(description="Evaluate retrieval quality and speed of the saved index on a JSONL question set.")
+    parser.add_argument("questions", help="JSONL file with 'question' and 'expected_sources' per line.")
+    parser.add_argument("--index-dir", default=settings.INDEX_DIR)
+    parser.add_argument("--k", type=int, default=settings.TOP_K)
+    parser.add_argument("--batch-size", type=int, default=64, help="Queries encoded and searched together.")
+    parser.add_argument("--output", help="Also write the report to this JSON file.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    store = RAGVectorStore()
+    if not store.load(args.index_dir):
+        raise SystemExit(f"No usable saved index in '{args.index_dir}'.")
+    report = evaluate(store, load_questions(args.questions), k=args.k, batch_size=args.batch_size)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,196 @@
+# index_backends.py
+
+import argparse
+import logging
+import time
+import faiss
+import numpy as np
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("flat_l2", "flat_ip", "flat_fp16", "flat_sq8", "ivf_flat", "ivf_pq", "hnsw")
+IVF_BACKENDS = ("ivf_flat", "ivf_pq")
+LOSSY_BACKENDS = ("flat_sq8", "ivf_pq")  # stored codes only reconstruct approximately
+
+class IndexBackendError(Exception):
+    """Custom exception for invalid index backend configuration."""
+    pass
+
+def uses_inner_product(backend: str) -> bool:
+    """Every backend except the legacy flat_l2 searches normalized vectors by inner product (cosine)."""
+    return backend != "flat_l2"
+
+def train_size(backend: str) -> int:
+    """Number of vectors an index must accumulate before it can be trained (0 if no training is needed)."""
+    if backend == "ivf_flat":
+        return settings.IVF_NLIST * 39
+    if backend == "ivf_pq":
+        # Both the coarse quantizer and the PQ codebooks want ~39 points per centroid.
+        return max(settings.IVF_NLIST, 2 ** settings.IVF_PQ_NBITS) * 39
+    if backend == "flat_sq8":
+        return settings.SQ8_TRAIN_SIZE
+    return 0
+
+def create_index(backend: str, d: int) -> faiss.Index:
+    """
+    Creates an empty (and, for IVF backends, untrained) FAISS index for the backend.
+    Every index takes caller-assigned chunk ids through add_with_ids() and can reconstruct by id.
+    """
+    if backend not in BACKENDS:
+        raise IndexBackendError(f"Unknown index backend '{backend}'. Choose one of: {', '.join(BACKENDS)}.")
+
+    if backend == "flat_l2":
+        return faiss.IndexIDMap2(faiss.IndexFlatL2(d))
+    if backend == "flat_ip":
+        return faiss.IndexIDMap2(faiss.IndexFlatIP(d))
+    if backend == "hnsw":
+        index = faiss.IndexHNSWFlat(d, settings.HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = settings.HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = settings.HNSW_EF_SEARCH
+        return faiss.IndexIDMap2(index)
+    if backend in ("flat_fp16", "flat_sq8"):
+        # Scalar quantization: 2 (fp16) or 1 (int8) bytes per dimension instead of 4.
+        quantizer_type = faiss.ScalarQuantizer.QT_fp16 if backend == "flat_fp16" else faiss.ScalarQuantizer.QT_8bit
+        return faiss.IndexIDMap2(faiss.IndexScalarQuantizer(d, quantizer_type, faiss.METRIC_INNER_PRODUCT))
+
+    quantizer = faiss.IndexFlatIP(d)
+    if backend == "ivf_flat":
+        index = faiss.IndexIVFFlat(quantizer, d, settings.IVF_NLIST, faiss.METRIC_INNER_PRODUCT)
+    else:
+        if d % settings.IVF_PQ_M != 0:
+            raise IndexBackendError(f"IVF_PQ_M={settings.IVF_PQ_M} must divide the embedding dimension {d}.")
+        index = faiss.IndexIVFPQ(quantizer, d, settings.IVF_NLIST, settings.IVF_PQ_M, settings.IVF_PQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+    index.nprobe = settings.IVF_NPROBE
+    # IVF takes arbitrary ids natively; a hashtable direct map makes reconstruct/remove by id cheap.
+    index.set_direct_map_type(faiss.DirectMap.Hashtable)
+    return index
+
+def create_staging_index(d: int) -> faiss.Index:
+    """Exact index that holds vectors of a store that needs training until there are enough to train on."""
+    return faiss.IndexIDMap2(faiss.IndexFlatIP(d))
+
+def unwrap(index: faiss.Index) -> faiss.Index:
+    """Returns the index inside an IndexIDMap2 wrapper, or the index itself."""
+    if isinstance(index, faiss.IndexIDMap2):
+        return faiss.downcast_index(index.index)
+    return index
+
+# Approximate size of one entry of a C++ hash map from id to id (node, allocation and bucket).
+HASH_ENTRY_BYTES = 40
+
+def index_nbytes(index: faiss.Index) -> int:
+    """
+    Estimates the memory an index holds from its sizes (ntotal * code_size plus the id maps,
+    IVF lists and centroids, HNSW graph), without serializing a copy of it.
+    """
+    nbytes = 0
+    if isinstance(index, faiss.IndexIDMap2):
+        nbytes += index.ntotal * (8 + HASH_ENTRY_BYTES)  # the id array and the reverse map
+        index = faiss.downcast_index(index.index)
+    if isinstance(index, faiss.IndexHNSW):
+        hnsw = index.hnsw
+        nbytes += 4 * hnsw.neighbors.size() + 4 * hnsw.levels.size() + 8 * hnsw.offsets.size()
+        index = faiss.downcast_index(index.storage)
+    if isinstance(index, faiss.IndexIVF):
+        nbytes += index.invlists.compute_ntotal() * (index.code_size + 8)  # codes and their ids
+        nbytes += index_nbytes(faiss.downcast_index(index.quantizer))
+        if index.direct_map.type == faiss.DirectMap.Hashtable:
+            nbytes += index.ntotal * HASH_ENTRY_BYTES
+        if isinstance(index, faiss.IndexIVFPQ):
+            nbytes += 4 * (index.pq.centroids.size() + index.precomputed_table.size())
+        return nbytes
+    if isinstance(index, faiss.IndexScalarQuantizer):
+        nbytes += 4 * index.sq.trained.size()
+    return nbytes + index.ntotal * index.code_size
+
+def is_staging(index: faiss.Index, backend: str) -> bool:
+    """True while an IVF or int8 store is still on its untrained staging flat index."""
+    return train_size(backend) > 0 and isinstance(unwrap(index), faiss.IndexFlat)
+
+def set_search_param(index: faiss.Index, backend: str, value: int):
+    """Sets the recall/latency knob of the backend: nprobe for IVF, efSearch for HNSW."""
+    # IVF stores that have not been trained yet are still exact flat indexes with nothing to tune.
+    if backend in IVF_BACKENDS and not is_staging(index, backend):
+        faiss.extract_index_ivf(index).nprobe = value
+    elif backend == "hnsw":
+        unwrap(index).hnsw.efSearch = value
+
+def search_parameters(index: faiss.Index, backend: str, selector: faiss.IDSelector | None, value: int | None = None) -> faiss.SearchParameters:
+    """
+    Search parameters that filter ids with selector, with nprobe/efSearch set to value or kept as
+    the index has them. Unlike set_search_param(), they leave the (shared) index untouched.
+    """
+    if backend in IVF_BACKENDS and not is_staging(index, backend):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=value or faiss.extract_index_ivf(index).nprobe)
+    if backend == "hnsw":
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=value or unwrap(index).hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+def search_param_name(backend: str) -> str | None:
+    """Name of the tunable search parameter of the backend, if it has one."""
+    return {"ivf_flat": "nprobe", "ivf_pq": "nprobe", "hnsw": "efSearch"}.get(backend)
+
+def train_index(backend: str, vectors: np.ndarray, ids: np.ndarray, train_vectors: np.ndarray | None = None) -> faiss.Index:
+    """
+    Creates an index for the backend, trains it if needed (on train_vectors if given, else on
+    vectors), and adds vectors under ids.
+    """
+    index = create_index(backend, vectors.shape[1])
+    if not index.is_trained:
+        train_vectors = vectors if train_vectors is None else train_vectors
+        logger.info(f"Training {backend} index on {len(train_vectors)} vectors.")
+        index.train(train_vectors)
+    index.add_with_ids(vectors, ids)
+    return index
+
+def recall_at_k(index: faiss.Index, ids: np.ndarray, exact_vectors: np.ndarray, query_vectors: np.ndarray, k: int, backend: str, param_values: list[int] | None = None, selector: faiss.IDSelector | None = None) -> list[dict]:
+    """
+    Measures recall@k of index against an exact flat index (same metric) over the same vectors.
+    The index is searched within selector if given (e.g. one excluding removed ids), otherwise
+    within ids when they are only a sample of it.
+    Returns one row per search parameter value with recall and mean per-query latency.
+    """
+    exact = create_index("flat_ip" if uses_inner_product(backend) else "flat_l2", exact_vectors.shape[1])
+    exact.add_with_ids(exact_vectors, ids)
+    _, truth = exact.search(query_vectors, k)
+    if selector is None and len(ids) < index.ntotal:
+        selector = faiss.IDSelectorBatch(ids)
+
+    if not search_param_name(backend):
+        param_values = None  # exact backends have nothing to sweep
+    rows = []
+    for value in param_values or [None]:
+        params = search_parameters(index, backend, selector, value) if selector is not None or value is not None else None
+        start = time.perf_counter()
+        _, found = index.search(query_vectors, k, params=params)
+        elapsed = time.perf_counter() - start
+        hits = sum(len(set(t[t >= 0]) & set(f[f >= 0])) for t, f in zip(truth, found))
+        rows.append({
+            'backend': backend,
+            'param': search_param_name(backend),
+            'value': value,
+            'recall': hits / float(truth.size),
+            'latency_ms': 1000 * elapsed / len(query_vectors),
+        })
+    return rows
+
+if __name__ == "__main__":
+    from rag_utils import RAGVectorStore
+
+    parser = argparse.ArgumentParser(description="Report recall@k of the saved index against an exact flat index.")
+    parser.add_argument("--index-dir", default=settings.INDEX_DIR)
+    parser.add_argument("--k", type=int, default=settings.TOP_K)
+    parser.add_argument("--queries", type=int, default=200, help="Number of stored chunks sampled as queries.")
+    parser.add_argument("--vectors", type=int, default=settings.RECALL_SAMPLE_SIZE, help="Number of stored chunks recall is measured over.")
+    parser.add_argument("--values", type=int, nargs="*", help="nprobe / efSearch values to try.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    store = RAGVectorStore()
+    if not store.load(args.index_dir):
+        raise SystemExit(f"No usable saved index in '{args.index_dir}'.")
+    memory = store.memory_usage()
+    print(f"{memory['chunks']} chunks: vectors {memory['vector_bytes']} B, documents {memory['document_bytes']} B, {memory['bytes_per_chunk']:.0f} B/chunk")
+    for row in store.recall_at_k(k=args.k, sample_queries=args.queries, sample_vectors=args.vectors, param_values=args.values):
+        print(f"{row['backend']:>8} {row['param'] or '-':>8}={row['value']!s:<6} recall@{args.k}={row['recall']:.3f} latency={row['latency_ms']:.3f} ms")
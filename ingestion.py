@@ -0,0 +1,425 @@
+# ingestion.py
+
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from collections.abc import Callable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from dataclasses import dataclass
+import numpy as np
+from config import settings
+from embedding_cache import get_embedding_cache
+from metrics import get_metrics, span
+from pdf_utils import PDFParsingError, fingerprint_pdf, get_page_cache, iter_pages
+from process_pool import spawn_pool
+
+# Kept free of torch/faiss imports: this module is re-imported by every extraction worker process.
+
+logger = logging.getLogger(__name__)
+
+_segmenter = None
+
+@dataclass
+class IngestJob:
+    """One file to ingest: the name it is indexed under, its path or in-memory bytes, and its content hash."""
+    source: str
+    path: str | None = None
+    source_hash: str | None = None
+    data: bytes | None = None
+
+    @property
+    def content(self) -> str | bytes:
+        return self.data if self.data is not None else self.path
+
+    @property
+    def is_pdf(self) -> bool:
+        return (self.path or self.source).lower().endswith(".pdf")
+
+def _extract_and_segment(content: str | bytes, is_pdf: bool, page_count: int = 0, cached_pages: dict[int, str] | None = None, page_workers: int = 1) -> tuple[list[str], dict[str, float], dict[int, str]]:
+    """
+    Stage 1 (runs in a worker process): extracts the text of a file and splits it into sentences.
+    Text with fewer than 3 sentences comes back whole, as SemanticChunker.chunk() would keep it.
+    PDF pages in cached_pages are not extracted again. Also returns the stage timings and the newly
+    extracted pages, since the worker cannot record them in the parent's metrics and page cache.
+    """
+    global _segmenter
+    if _segmenter is None:
+        import pysbd
+        _segmenter = pysbd.Segmenter(language="en", clean=False)
+
+    start = time.perf_counter()
+    new_pages = {}
+    if is_pdf:
+        text = "\n\n".join(filter(None, iter_pages(content, page_count, cached_pages or {}, new_pages, page_workers)))
+        if not text.strip():
+            raise PDFParsingError("No text could be extracted. The PDF might be image-based or contain no selectable text.")
+    elif isinstance(content, bytes):
+        text = content.decode('utf-8')
+    else: # For .txt and .md
+        with open(content, 'r', encoding='utf-8') as f:
+            text = f.read()
+    timings = {'ingest.extract': time.perf_counter() - start}
+    if not text.strip():
+        return [], timings, new_pages
+    start = time.perf_counter()
+    sentences = _segmenter.segment(text)
+    timings['ingest.segment'] = time.perf_counter() - start
+    return (sentences if len(sentences) >= 3 else [text]), timings, new_pages
+
+def _fingerprint(content: str | bytes, file_hash: str | None) -> tuple[str, list[str], float]:
+    """Runs in a worker process: fingerprints the pages of a PDF for the parent's page-cache lookup."""
+    start = time.perf_counter()
+    file_hash, fingerprints = fingerprint_pdf(content, file_hash)
+    return file_hash, fingerprints, time.perf_counter() - start
+
+def _streamed_pages(content: str | bytes, page_count: int, cache_key: tuple | None, cached: dict[int, str], page_workers: int) -> Iterator[str]:
+    """Yields the pages of a large PDF for streaming; the newly extracted ones are cached once it is done."""
+    page_cache = get_page_cache()
+    new_pages = {}
+    try:
+        yield from iter_pages(content, page_count, cached, new_pages, page_workers)
+    finally:
+        if cache_key is not None and new_pages:
+            page_cache.store(*cache_key, new_pages)
+
+@dataclass
+class _InFlight:
+    """A file in the extraction pool: first being fingerprinted (PDFs not wholly cached), then extracted."""
+    job: IngestJob
+    future: Future
+    cache_key: tuple | None = None
+    fingerprinting: bool = False
+
+def _segmented(jobs: list[IngestJob], workers: int, max_in_flight: int):
+    """
+    Yields (job, sentences, pages, error) in job order, keeping at most max_in_flight files in flight.
+    A PDF of at least INGEST_STREAM_MIN_PAGES pages is not segmented: `pages` is then an iterator
+    over its page texts, extracted as it is consumed, and `sentences` is None.
+    """
+    metrics = get_metrics()
+    page_cache = get_page_cache()
+    # A lone file has the worker processes to itself: a large PDF is then split by page ranges.
+    page_workers = workers if len(jobs) == 1 else 1
+
+    def stage(job: IngestJob, page_count: int, cache_key: tuple | None, cached: dict[int, str]) -> tuple[tuple | None, tuple | None, Iterator[str] | None]:
+        """
+        Arguments for _extract_and_segment and the page-cache key of a PDF, or the pages of a PDF to
+        stream instead.
+        """
+        if page_count >= settings.INGEST_STREAM_MIN_PAGES:
+            return None, None, _streamed_pages(job.content, page_count, cache_key, cached, page_workers)
+        return (job.content, True, page_count, cached), cache_key, None
+
+    def stage_cached(job: IngestJob) -> tuple[tuple | None, tuple | None, Iterator[str] | None] | None:
+        """Stages a non-PDF, or a PDF whose every page is cached under its hash; None if it must be fingerprinted."""
+        if not job.is_pdf:
+            return (job.content, False), None, None
+        with span("ingest.page_lookup"):
+            cached = page_cache.lookup_file(job.source_hash) if job.source_hash else None
+        return None if cached is None else stage(job, len(cached), None, cached)
+
+    def stage_fingerprinted(job: IngestJob, file_hash: str, fingerprints: list[str]) -> tuple[tuple | None, tuple | None, Iterator[str] | None]:
+        with span("ingest.page_lookup"):
+            cached = page_cache.lookup(file_hash, fingerprints)
+        return stage(job, len(fingerprints), (file_hash, fingerprints), cached)
+
+    def finished(result, cache_key):
+        sentences, timings, new_pages = result
+        for name, seconds in timings.items():
+            metrics.observe(name, seconds)
+        if cache_key is not None and new_pages:
+            page_cache.store(*cache_key, new_pages)
+        return sentences
+
+    if workers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            try:
+                staged = stage_cached(job)
+                if staged is None:
+                    file_hash, fingerprints, seconds = _fingerprint(job.content, job.source_hash)
+                    metrics.observe("ingest.fingerprint", seconds)
+                    staged = stage_fingerprinted(job, file_hash, fingerprints)
+                args, cache_key, pages = staged
+                if pages is not None:
+                    yield job, None, pages, None
+                    continue
+                yield job, finished(_extract_and_segment(*args, page_workers=page_workers), cache_key), None, None
+            except Exception as e:
+                yield job, None, None, e
+        return
+
+    with spawn_pool(workers) as pool:
+        def extract(entry: _InFlight, staged: tuple):
+            args, entry.cache_key, pages = staged
+            if pages is None:
+                entry.future = pool.submit(_extract_and_segment, *args)
+            else:
+                entry.future = Future()
+                entry.future.set_result(pages)
+
+        def submit(job: IngestJob) -> _InFlight:
+            entry = _InFlight(job, Future())
+            try:
+                staged = stage_cached(job)
+            except Exception as e:
+                entry.future.set_exception(e)
+                return entry
+            if staged is None:
+                # Fingerprinting costs a fair share of extraction, so it runs in the pool too.
+                entry.future = pool.submit(_fingerprint, job.content, job.source_hash)
+                entry.fingerprinting = True
+            else:
+                extract(entry, staged)
+            return entry
+
+        def fingerprinted(entry: _InFlight):
+            """Looks the fingerprinted pages up in the page cache and starts the extraction of the rest."""
+            entry.fingerprinting = False
+            try:
+                file_hash, fingerprints, seconds = entry.future.result()
+                metrics.observe("ingest.fingerprint", seconds)
+                extract(entry, stage_fingerprinted(entry.job, file_hash, fingerprints))
+            except Exception as e:
+                entry.future = Future()
+                entry.future.set_exception(e)
+
+        in_flight: deque[_InFlight] = deque()
+        remaining = iter(jobs)
+        for job in remaining:
+            in_flight.append(submit(job))
+            if len(in_flight) >= max_in_flight:
+                break
+        while in_flight:
+            head = in_flight[0]
+            # Start extracting every file whose fingerprints are in before waiting for the next one in order.
+            while head.fingerprinting or not head.future.done():
+                waiting = [entry.future for entry in in_flight if entry.fingerprinting or entry is head]
+                done, _ = wait(waiting, return_when=FIRST_COMPLETED)
+                for entry in in_flight:
+                    if entry.fingerprinting and entry.future in done:
+                        fingerprinted(entry)
+            in_flight.popleft()
+            try:
+                result = head.future.result()
+                if isinstance(result, Iterator):
+                    yield head.job, None, result, None
+                else:
+                    yield head.job, finished(result, head.cache_key), None, None
+            except Exception as e:
+                yield head.job, None, None, e
+            next_job = next(remaining, None)
+            if next_job is not None:
+                in_flight.append(submit(next_job))
+
+def _index_writer(rag_store, index_queue: queue.Queue, processed: list[str], errors: dict[str, str], file_done: Callable[[], None]):
+    """
+    Stage 3 (runs in a thread): adds encoded chunks to the store one file at a time. A streamed
+    file arrives in several parts; the first replaces the source and the others are appended.
+    """
+    chunk_counts = {}
+    while True:
+        item = index_queue.get()
+        if item is None:
+            return
+        job, chunks, vectors, first, last = item
+        if first:
+            chunk_counts[job.source] = 0
+        try:
+            with span("ingest.index"):
+                if first:
+                    # replace_source() also drops an older version indexed under the same name.
+                    rag_store.replace_source(job.source, chunks, source_hash=job.source_hash, embeddings=vectors)
+                elif chunks and job.source not in errors:
+                    rag_store.add_texts(chunks, source=job.source, source_hash=job.source_hash, embeddings=vectors)
+            chunk_counts[job.source] += len(chunks)
+        except Exception as e:
+            logger.error(f"Failed to index '{job.source}': {e}")
+            errors[job.source] = str(e)
+        if not last:
+            continue
+        chunk_count = chunk_counts.pop(job.source, 0)
+        if job.source in errors:
+            if not first:
+                rag_store.remove_source(job.source)  # drop the parts of a streamed file that failed midway
+        elif chunk_count:
+            logger.info(f"Successfully processed and chunked '{job.source}' into {chunk_count} semantic chunks.")
+            processed.append(job.source)
+        else:
+            logger.warning(f"Could not generate any chunks from '{job.source}'. It may be too short.")
+        file_done()
+
+def _encode_and_chunk(chunker, batch: list[tuple[IngestJob, list[str]]], index_queue: queue.Queue, errors: dict[str, str]):
+    """
+    Stage 2: encodes the sentences of every file in the batch with one encoder call, finds the
+    chunks of each file, then encodes all chunks (unless pooled) with one more call.
+    """
+    cache = get_embedding_cache()
+    splittable = [(job, sentences) for job, sentences in batch if len(sentences) >= 3]
+    with span("ingest.encode"):
+        sentence_vectors = cache.encode(chunker.model, [s for _, sentences in splittable for s in sentences])
+
+    results = []
+    offset = 0
+    pooled = settings.REUSE_SENTENCE_EMBEDDINGS
+    for job, sentences in batch:
+        if len(sentences) < 3:
+            results.append((job, sentences, None))
+            continue
+        embeddings = sentence_vectors[offset:offset + len(sentences)]
+        offset += len(sentences)
+        try:
+            with span("ingest.chunk"):
+                chunks, vectors = chunker.chunk_sentences(sentences, embeddings, pool=pooled)
+            results.append((job, chunks, vectors))
+        except Exception as e:
+            logger.error(f"Failed to chunk '{job.source}': {e}")
+            errors[job.source] = str(e)
+
+    # Short unsplit texts are never pooled; they are encoded with the chunks below.
+    to_encode = [(job, chunks) for job, chunks, vectors in results if vectors is None and chunks]
+    with span("ingest.encode"):
+        chunk_vectors = cache.encode(chunker.model, [c for _, chunks in to_encode for c in chunks])
+    offset = 0
+    encoded = {}
+    for job, chunks in to_encode:
+        encoded[job.source] = chunk_vectors[offset:offset + len(chunks)]
+        offset += len(chunks)
+
+    for job, chunks, vectors in results:
+        index_queue.put((job, chunks, vectors if vectors is not None else encoded.get(job.source), True, True))
+
+def _stream_chunks(chunker, job: IngestJob, pages: Iterator[str], index_queue: queue.Queue, errors: dict[str, str]) -> bool:
+    """
+    Stages 1 and 2 for a large PDF: chunks its pages as they are extracted and hands the chunks
+    to the writer in parts of INGEST_STREAM_GROUP_CHUNKS, so neither the document's text nor its
+    sentence embeddings are ever held whole. Returns whether the writer was told about the file.
+    """
+    cache = get_embedding_cache()
+    pooled = settings.REUSE_SENTENCE_EMBEDDINGS
+    group: list[tuple[str, np.ndarray | None]] = []
+    sent = False
+    extracted = False  # whether any page had text
+
+    def tracked(pages: Iterator[str]) -> Iterator[str]:
+        nonlocal extracted
+        for page in pages:
+            extracted = extracted or bool(page.strip())
+            yield page
+
+    def send(last: bool):
+        nonlocal group, sent
+        chunks = [chunk for chunk, _ in group]
+        if not chunks:
+            vectors = None
+        elif pooled and all(vector is not None for _, vector in group):
+            vectors = np.vstack([vector for _, vector in group])
+        else:
+            # Short unsplit text has no pooled vector; it is encoded like any chunk.
+            with span("ingest.encode"):
+                vectors = cache.encode(chunker.model, chunks)
+        index_queue.put((job, chunks, vectors, not sent, last))
+        group = []
+        sent = True
+
+    try:
+        stream = chunker.chunk_stream_with_embeddings(tracked(pages), max_chunk_sentences=settings.INGEST_STREAM_MAX_CHUNK_SENTENCES)
+        for chunk, vector in stream:
+            group.append((chunk, vector))
+            if len(group) >= settings.INGEST_STREAM_GROUP_CHUNKS:
+                send(last=False)
+        if not extracted:
+            raise PDFParsingError("No text could be extracted. The PDF might be image-based or contain no selectable text.")
+        # Text that yields no chunks reaches the writer empty, which reports it as for a whole document.
+        send(last=True)
+    except Exception as e:
+        logger.error(f"Failed to process file {job.path or job.source}: {e}")
+        errors[job.source] = str(e)
+        if sent:
+            index_queue.put((job, [], None, False, True))
+    return sent
+
+def ingest_files(
+    rag_store,
+    jobs: list[IngestJob],
+    chunker=None,
+    workers: int = settings.INGEST_WORKERS,
+    encode_batch_sentences: int = settings.INGEST_ENCODE_BATCH,
+    queue_size: int = settings.INGEST_QUEUE_SIZE,
+    errors: dict[str, str] | None = None,
+    progress: Callable[[int, int], None] | None = None,
+) -> list[str]:
+    """
+    Ingests files through a three-stage pipeline: a process pool extracts and segments files,
+    one encoding stage batches sentences and chunks across files, and a writer thread adds
+    the results to rag_store. A failing file is logged (and recorded in `errors` if given)
+    without affecting the others. progress(files_done, files_total) is called as files finish.
+    Returns the sources that were indexed, in job order.
+    """
+    if chunker is None:
+        from chunking import SemanticChunker
+        chunker = SemanticChunker(rag_store.embedding_model)
+    errors = errors if errors is not None else {}
+    processed = []
+    progress_lock = threading.Lock()
+    files_done = 0
+
+    def file_done():
+        nonlocal files_done
+        with progress_lock:
+            files_done += 1
+            done = files_done
+        if progress is not None:
+            progress(done, len(jobs))
+
+    index_queue = queue.Queue(maxsize=queue_size)
+    writer = threading.Thread(target=_index_writer, args=(rag_store, index_queue, processed, errors, file_done), daemon=True)
+    writer.start()
+
+    def flush(batch):
+        try:
+            _encode_and_chunk(chunker, batch, index_queue, errors)
+        except Exception as e:
+            if len(batch) == 1:
+                logger.error(f"Failed to encode '{batch[0][0].source}': {e}")
+                errors[batch[0][0].source] = str(e)
+                return
+            # Isolate the failing file by retrying the batch one file at a time.
+            logger.warning(f"Batched encoding failed ({e}); retrying {len(batch)} files individually.")
+            for item in batch:
+                flush([item])
+
+    try:
+        batch, batch_sentences = [], 0
+        for job, sentences, pages, error in _segmented(jobs, workers, max_in_flight=workers + queue_size):
+            if error is not None:
+                logger.error(f"Failed to process file {job.path or job.source}: {error}")
+                errors[job.source] = str(error)
+                file_done()
+                continue
+            if pages is not None:
+                logger.info(f"Streaming '{job.source}' page by page.")
+                with span("ingest.stream"):
+                    if not _stream_chunks(chunker, job, pages, index_queue, errors):
+                        file_done()
+                continue
+            if not sentences:
+                logger.warning(f"No content extracted from '{job.source}'.")
+                file_done()
+                continue
+            batch.append((job, sentences))
+            batch_sentences += len(sentences)
+            if batch_sentences >= encode_batch_sentences:
+                flush(batch)
+                batch, batch_sentences = [], 0
+        if batch:
+            flush(batch)
+    finally:
+        index_queue.put(None)
+        writer.join()
+    if progress is not None:
+        progress(len(jobs), len(jobs))  # files that failed while encoding never reach the writer
+
+    order = {job.source: i for i, job in enumerate(jobs)}
+    return sorted(processed, key=order.get)
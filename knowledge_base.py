@@ -0,0 +1,82 @@
+# knowledge_base.py
+
+import logging
+import threading
+import time
+from config import settings
+from metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+class KnowledgeBaseLoader:
+    """
+    Builds the shared knowledge base on a background thread so the app can render immediately.
+    The heavy imports (torch, sentence-transformers, faiss, scipy) happen here, not in app.py.
+    The store is published as soon as the embedding model is loaded; it is searchable (and
+    answers from whatever is indexed so far) while the saved index loads and DATA_DIR ingests.
+    """
+    def __init__(self, index_dir: str | None = settings.INDEX_DIR):
+        self.index_dir = index_dir
+        self.stage = "Starting up..."
+        self.files_done = 0
+        self.files_total = 0
+        self.base_store = None
+        self.embedding_model = None
+        self.filenames: list[str] = []
+        self.ready = False
+        self.error: str | None = None
+        self._thread = threading.Thread(target=self._run, name="knowledge-base-warmup", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        start = time.perf_counter()
+        try:
+            self.stage = "Loading embedding model..."
+            from encoder_service import get_encoder
+            from rag_utils import RAGVectorStore
+            from preloaded_data import preload_data_to_store
+            import chunking  # noqa: F401 -- warms the chunker's imports for the first upload
+            import scipy.signal  # noqa: F401
+            self.embedding_model = get_encoder()
+            self.base_store = RAGVectorStore(self.embedding_model)
+            logger.info(f"Embedding model ready after {time.perf_counter() - start:.2f} seconds.")
+
+            self.stage = "Indexing documents..."
+            self.filenames = preload_data_to_store(self.base_store, index_dir=self.index_dir, progress=self._on_progress)
+            self.stage = "Ready"
+            self.ready = True
+            logger.info(f"Knowledge base ready after {time.perf_counter() - start:.2f} seconds.")
+        except Exception as e:
+            logger.error(f"Failed to build the knowledge base: {e}", exc_info=True)
+            self.error = str(e)
+            self.stage = "Failed"
+        finally:
+            get_metrics().observe("app.warmup", time.perf_counter() - start)
+
+    def _on_progress(self, files_done: int, files_total: int):
+        self.files_done, self.files_total = files_done, files_total
+        self.stage = f"Indexing documents ({files_done}/{files_total})..."
+
+    def progress(self) -> float:
+        """Fraction of warm-up done: the model load counts as the first 20%, ingestion as the rest."""
+        if self.ready:
+            return 1.0
+        if self.base_store is None:
+            return 0.0
+        if not self.files_total:
+            return 0.2
+        return 0.2 + 0.8 * self.files_done / self.files_total
+
+_loader_lock = threading.Lock()
+_loader: KnowledgeBaseLoader | None = None
+
+def get_knowledge_base() -> KnowledgeBaseLoader:
+    """Returns the process-wide knowledge base loader, starting its warm-up on the first call."""
+    global _loader
+    with _loader_lock:
+        if _loader is None:
+            _loader = KnowledgeBaseLoader()
+            _loader.start()
+        return _loader
@@ -1,34 +1,32 @@
 # llm_utils.py
 
-from groq import Groq, GroqError
-from config import settings
+import asyncio
+import json
 import logging
+import random
+import threading
 import time
+import weakref
+from collections.abc import AsyncIterator, Callable, Iterator
+import httpx
+from config import settings
+from metrics import get_metrics
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-try:
-    client = Groq(api_key=settings.GROQ_API_KEY)
-except Exception as e:
-    logger.error(f"Failed to initialize Groq client: {e}")
-    client = None
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
 
 class LLMAnalysisError(Exception):
     """Custom exception for LLM analysis errors."""
     pass
 
-def get_rag_response_stream(query: str, context: str, model_name: str = settings.LLM_MODEL):
-    """
-    Generates a response for a RAG query using the Groq API with streaming.
-    """
-    if not client:
-        raise LLMAnalysisError("Groq API client is not initialized. Check API key.")
-    if not context.strip():
-        logger.warning("RAG query attempted with empty context.")
-        yield "I could not find any relevant information in the provided documents to answer this question."
-        return
+class _RetryableLLMError(Exception):
+    """A failure worth retrying: connection problems, rate limits, 5xx or a missed TTFT deadline."""
+    pass
 
+def build_rag_messages(query: str, context: str) -> list[dict]:
+    """Builds the chat messages for a RAG query over the given context excerpts."""
     # --- UPDATED ADVANCED PROMPT ---
     prompt = f"""
     You are AquaQuery, an expert AI oceanographic research assistant. Your primary goal is to provide accurate, helpful, and concise answers based *exclusively* on the provided document excerpts.
@@ -56,35 +54,214 @@ def get_rag_response_stream(query: str, context: str, model_name: str = settings
     **Your Answer:**
     """
 
-    messages = [{"role": "user", "content": prompt}]
-    max_retries = 2
-    retry_delay = 5
+    return [{"role": "user", "content": prompt}]
 
-    for attempt in range(max_retries):
+class AsyncLLMClient:
+    """
+    Streaming client for an OpenAI-compatible chat completions endpoint (Groq by default).
+    One pooled HTTP connection set serves every request, so many questions can be in flight at once.
+    Its connections belong to the event loop they were opened on: use a client on one loop only
+    (get_async_llm_client() keeps one per loop).
+    Retries use non-blocking exponential backoff with full jitter. If no token arrives within the
+    TTFT deadline, a hedged duplicate request is sent and whichever answers first is streamed.
+    """
+    def __init__(
+        self,
+        api_key: str | None = settings.GROQ_API_KEY,
+        base_url: str = settings.LLM_BASE_URL,
+        max_connections: int = settings.LLM_MAX_CONNECTIONS,
+        ttft_deadline: float = settings.LLM_TTFT_DEADLINE_SECONDS,
+        hedge: bool = settings.LLM_HEDGE_REQUESTS,
+        max_retries: int = settings.LLM_MAX_RETRIES,
+        backoff_base: float = settings.LLM_BACKOFF_BASE_SECONDS,
+        backoff_max: float = settings.LLM_BACKOFF_MAX_SECONDS,
+        timeout: float = settings.LLM_REQUEST_TIMEOUT_SECONDS,
+    ):
+        self.ttft_deadline = ttft_deadline
+        self.hedge = hedge
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._client = httpx.AsyncClient(
+            base_url=base_url.rstrip("/"),
+            headers={"Authorization": f"Bearer {api_key}"} if api_key else {},
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=httpx.Timeout(timeout, connect=10.0),
+        )
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    async def _stream_once(self, payload: dict) -> AsyncIterator[str]:
+        """Sends one streaming request and yields content deltas from its server-sent events."""
+        try:
+            async with self._client.stream("POST", "/chat/completions", json=payload) as response:
+                if response.status_code >= 400:
+                    body = (await response.aread()).decode('utf-8', errors='replace')[:500]
+                    message = f"HTTP {response.status_code} from LLM API: {body}"
+                    if response.status_code in RETRYABLE_STATUS_CODES:
+                        raise _RetryableLLMError(message)
+                    raise LLMAnalysisError(message)
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        return
+                    choices = json.loads(data).get("choices") or []
+                    content = (choices[0].get("delta") or {}).get("content") if choices else None
+                    if content:
+                        yield content
+        except httpx.TransportError as e:
+            raise _RetryableLLMError(f"Connection error talking to LLM API: {e}") from e
+
+    @staticmethod
+    async def _first_token(stream: AsyncIterator[str]) -> tuple[AsyncIterator[str], str | None]:
         try:
-            logger.info(f"Requesting streaming completion from Groq for query: '{query[:50]}...'. Attempt {attempt + 1}")
-            start_time = time.time()
-            stream = client.chat.completions.create(
-                messages=messages,
-                model=model_name,
-                temperature=0.1,
-                max_tokens=2048,
-                top_p=0.9,
-                stream=True,
-            )
-            for chunk in stream:
-                content = chunk.choices[0].delta.content
-                if content:
-                    yield content
-            end_time = time.time()
-            logger.info(f"Groq stream completed in {end_time - start_time:.2f} seconds.")
-            return
-
-        except GroqError as e:
-            logger.error(f"Groq API error on attempt {attempt + 1}: {e}")
-            if attempt == max_retries - 1:
-                raise LLMAnalysisError(f"Groq API Error after multiple retries: {e}")
-            time.sleep(retry_delay * (attempt + 1))
+            return stream, await stream.__anext__()
+        except StopAsyncIteration:
+            return stream, None
+
+    @staticmethod
+    async def _abandon(task: asyncio.Task, stream: AsyncIterator[str]):
+        """Cancels a request that lost the race (or missed its deadline) and releases its connection."""
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await stream.aclose()
+
+    async def _open(self, payload: dict) -> tuple[AsyncIterator[str], str | None]:
+        """Starts a request and returns (stream, first token), hedging once the TTFT deadline passes."""
+        primary = self._stream_once(payload)
+        primary_task = asyncio.ensure_future(self._first_token(primary))
+        done, _ = await asyncio.wait({primary_task}, timeout=self.ttft_deadline)
+        if done:
+            return primary_task.result()
+
+        if not self.hedge:
+            await self._abandon(primary_task, primary)
+            raise _RetryableLLMError(f"No token within the {self.ttft_deadline:.1f}s TTFT deadline.")
+
+        logger.warning(f"No token within {self.ttft_deadline:.1f}s; sending a hedged request.")
+        hedged = self._stream_once(payload)
+        streams = {primary_task: primary, asyncio.ensure_future(self._first_token(hedged)): hedged}
+        pending = set(streams)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for loser in pending:
+                        await self._abandon(loser, streams[loser])
+                    return task.result()
+                error = task.exception()
+        raise error
+
+    def _backoff(self, attempt: int) -> float:
+        # Full jitter: spreads retries from concurrent sessions instead of synchronizing them.
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def stream_chat(self, messages: list[dict], model: str = settings.LLM_MODEL, **params) -> AsyncIterator[str]:
+        """Streams the completion for messages. Failures before the first token are retried."""
+        payload = {"model": model, "messages": messages, "stream": True, **params}
+        request_start = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            start_time = time.perf_counter()
+            try:
+                logger.info(f"Requesting streaming completion from {model}. Attempt {attempt + 1}")
+                stream, first = await self._open(payload)
+                break
+            except _RetryableLLMError as e:
+                logger.error(f"LLM API error on attempt {attempt + 1}: {e}")
+                if attempt == self.max_retries:
+                    raise LLMAnalysisError(f"LLM API error after multiple retries: {e}")
+                await asyncio.sleep(self._backoff(attempt))
+
+        first_token_time = time.perf_counter()
+        logger.info(f"First token after {first_token_time - start_time:.2f} seconds.")
+        metrics = get_metrics()
+        # Retries count towards the time to first token the user actually waits.
+        metrics.observe("llm.ttft", first_token_time - request_start)
+        deltas = 0
+        try:
+            if first is not None:
+                yield first
+            async for content in stream:
+                deltas += 1
+                yield content
+        except _RetryableLLMError as e:
+            raise LLMAnalysisError(f"The response stream was interrupted: {e}")
+        except LLMAnalysisError:
+            raise
         except Exception as e:
             logger.error(f"An unexpected error occurred during LLM request: {e}", exc_info=True)
-            raise LLMAnalysisError(f"An unexpected error occurred: {e}")
\ No newline at end of file
+            raise LLMAnalysisError(f"An unexpected error occurred: {e}")
+        finally:
+            await stream.aclose()
+        generation_seconds = time.perf_counter() - first_token_time
+        metrics.observe("llm.generation", generation_seconds)
+        if deltas and generation_seconds > 0:
+            metrics.observe("llm.tokens_per_second", deltas / generation_seconds)
+        logger.info(f"LLM stream completed in {time.perf_counter() - start_time:.2f} seconds.")
+
+class _EventLoopThread:
+    """A background event loop shared by every Streamlit script thread, so pooled connections outlive a run."""
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="llm-event-loop", daemon=True).start()
+
+    def iterate(self, make_stream: Callable[[], AsyncIterator[str]]) -> Iterator[str]:
+        """Drives an async stream on the loop and yields its items to a synchronous caller."""
+        stream = make_stream()
+        try:
+            while True:
+                try:
+                    yield asyncio.run_coroutine_threadsafe(stream.__anext__(), self.loop).result()
+                except StopAsyncIteration:
+                    return
+        finally:
+            asyncio.run_coroutine_threadsafe(stream.aclose(), self.loop).result()
+
+_client_lock = threading.Lock()
+_event_loop: _EventLoopThread | None = None
+# An httpx.AsyncClient cannot be shared across event loops, so each loop gets its own client.
+_async_clients: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncLLMClient] = weakref.WeakKeyDictionary()
+
+def get_async_llm_client() -> AsyncLLMClient:
+    """Returns the async LLM client of the running event loop, creating it on first use on that loop."""
+    loop = asyncio.get_running_loop()
+    with _client_lock:
+        client = _async_clients.get(loop)
+        if client is None:
+            client = _async_clients[loop] = AsyncLLMClient()
+        return client
+
+def _get_event_loop() -> _EventLoopThread:
+    global _event_loop
+    with _client_lock:
+        if _event_loop is None:
+            _event_loop = _EventLoopThread()
+        return _event_loop
+
+GENERATION_PARAMS = {"temperature": 0.1, "max_tokens": 2048, "top_p": 0.9}
+
+async def get_rag_response_stream_async(query: str, context: str, model_name: str = settings.LLM_MODEL) -> AsyncIterator[str]:
+    """
+    Generates a response for a RAG query as an async stream. Several of these can run
+    concurrently on one event loop, sharing that loop's client and connection pool.
+    """
+    if not settings.GROQ_API_KEY:
+        raise LLMAnalysisError("Groq API client is not initialized. Check API key.")
+    if not context.strip():
+        logger.warning("RAG query attempted with empty context.")
+        yield "I could not find any relevant information in the provided documents to answer this question."
+        return
+
+    async for content in get_async_llm_client().stream_chat(build_rag_messages(query, context), model_name, **GENERATION_PARAMS):
+        yield content
+
+def get_rag_response_stream(query: str, context: str, model_name: str = settings.LLM_MODEL):
+    """
+    Generates a response for a RAG query using the Groq API with streaming.
+    The request runs on a shared background event loop; this generator just relays its tokens.
+    """
+    yield from _get_event_loop().iterate(lambda: get_rag_response_stream_async(query, context, model_name))
@@ -0,0 +1,200 @@
+# metrics.py
+
+import bisect
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from config import settings
+
+# Upper bounds (seconds) of the latency histogram buckets; the last bucket is +Inf.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RATE_BUCKETS = (1, 5, 10, 25, 50, 100, 200, 400, 800, 1600)
+THROUGHPUT_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+# Metrics that are not durations, with their own buckets, Prometheus names and display units.
+VALUE_METRICS = {
+    'llm.tokens_per_second': (RATE_BUCKETS, "rag_llm_tokens_per_second", "Streamed completion deltas (about one token each) per second.", "/s"),
+    'encoder.sentences_per_second': (THROUGHPUT_BUCKETS, "rag_encoder_sentences_per_second", "Texts encoded per second of model time, per request.", "/s"),
+    'encoder.batch_size': (BATCH_SIZE_BUCKETS, "rag_encoder_batch_size", "Texts per embedding model call.", ""),
+}
+# Gauges: current values (e.g. memory held), exported with labels rather than as histograms.
+GAUGE_METRICS = {
+    'session.memory_bytes': ("rag_session_memory_bytes", "Memory held by each session's private index and documents (0 while spilled to disk)."),
+    'sessions.resident_bytes': ("rag_sessions_resident_bytes", "Memory held by all sessions' private stores."),
+    'sessions.resident': ("rag_sessions_resident", "Sessions whose private store is in memory."),
+    'sessions.spilled': ("rag_sessions_spilled", "Sessions whose private store is spilled to disk."),
+}
+_NOOP_SPAN = nullcontext()
+
+class Histogram:
+    """A fixed-bucket histogram, as Prometheus keeps it, plus min/max for display."""
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Estimates a quantile by interpolating linearly inside the bucket that contains it."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                estimate = lower + (upper - lower) * (rank - cumulative) / count
+                return min(max(estimate, self.min), self.max)
+            cumulative += count
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'min': self.min if self.count else 0.0,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+        }
+
+class MetricsRegistry:
+    """
+    Aggregates per-stage timings of ingestion and querying into histograms, plus a few gauges.
+    When disabled, span() hands out a shared no-op context manager and observe() and
+    set_gauge() return immediately.
+    """
+    def __init__(self, enabled: bool = settings.METRICS_ENABLED):
+        self.enabled = enabled
+        self._histograms: dict[str, Histogram] = {}
+        self._gauges: dict[str, dict[tuple, float]] = {}  # name -> label values -> value
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float):
+        """Records one observation: a duration in seconds, or a value of one of VALUE_METRICS."""
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                buckets = VALUE_METRICS[name][0] if name in VALUE_METRICS else LATENCY_BUCKETS
+                histogram = self._histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+
+    def set_gauge(self, name: str, value: float, **labels: str):
+        """Sets the current value of one of GAUGE_METRICS, optionally for a label set (e.g. session="...")."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._gauges.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    def remove_gauge(self, name: str, **labels: str):
+        """Drops a labelled gauge value, e.g. for a session that has ended."""
+        with self._lock:
+            self._gauges.get(name, {}).pop(tuple(sorted(labels.items())), None)
+
+    def gauges(self) -> dict[str, list[dict]]:
+        """Returns every gauge value with its labels, by gauge name."""
+        with self._lock:
+            return {
+                name: [{'labels': dict(labels), 'value': value} for labels, value in sorted(values.items())]
+                for name, values in sorted(self._gauges.items())
+            }
+
+    def span(self, name: str):
+        """Context manager that records the duration of its block under the stage name."""
+        if not self.enabled:
+            return _NOOP_SPAN
+        return self._timed(name)
+
+    @contextmanager
+    def _timed(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self) -> dict[str, dict]:
+        """Returns a summary (count, mean, p50, p95, ...) of every metric, by name."""
+        with self._lock:
+            return {name: histogram.summary() for name, histogram in sorted(self._histograms.items())}
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._gauges.clear()
+
+    def to_json(self) -> str:
+        return json.dumps({'timestamp': time.time(), 'metrics': self.snapshot(), 'gauges': self.gauges()}, indent=2)
+
+    def to_prometheus(self) -> str:
+        """Renders every histogram and gauge in the Prometheus text exposition format."""
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+        lines = []
+        stages = [(name, histogram) for name, histogram in histograms if name not in VALUE_METRICS]
+        if stages:
+            lines += ["# HELP rag_stage_duration_seconds Duration of each RAG pipeline stage.", "# TYPE rag_stage_duration_seconds histogram"]
+            for name, histogram in stages:
+                lines += _prometheus_histogram("rag_stage_duration_seconds", f'stage="{name}"', histogram)
+        for name, histogram in histograms:
+            if name in VALUE_METRICS:
+                _, metric, description, _ = VALUE_METRICS[name]
+                lines += [f"# HELP {metric} {description}", f"# TYPE {metric} histogram"]
+                lines += _prometheus_histogram(metric, "", histogram)
+        for name, values in self.gauges().items():
+            metric, description = GAUGE_METRICS[name]
+            lines += [f"# HELP {metric} {description}", f"# TYPE {metric} gauge"]
+            for value in values:
+                labels = ",".join(f'{key}="{label}"' for key, label in value['labels'].items())
+                lines.append(f"{metric}{{{labels}}} {value['value']}" if labels else f"{metric} {value['value']}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: str):
+        """Atomically writes the Prometheus text format to path, e.g. for node_exporter's textfile collector."""
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus())
+        os.replace(f"{path}.tmp", path)
+
+def _prometheus_histogram(metric: str, labels: str, histogram: Histogram) -> list[str]:
+    separator = "," if labels else ""
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+        cumulative += count
+        lines.append(f'{metric}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+    suffix = f"{{{labels}}}" if labels else ""
+    lines.append(f"{metric}_sum{suffix} {histogram.sum}")
+    lines.append(f"{metric}_count{suffix} {histogram.count}")
+    return lines
+
+_metrics_lock = threading.Lock()
+_metrics: MetricsRegistry | None = None
+
+def get_metrics() -> MetricsRegistry:
+    """Returns the process-wide metrics registry."""
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = MetricsRegistry()
+        return _metrics
+
+def span(name: str):
+    """Times a block as a pipeline stage in the process-wide registry: `with span("query.search"): ...`."""
+    return get_metrics().span(name)
@@ -1,42 +1,294 @@
 import fitz  # PyMuPDF
+import hashlib
 import os
 import logging
+import re
+import threading
+from collections import OrderedDict
+from collections.abc import Iterator
+from typing import BinaryIO
+from config import settings
+from process_pool import spawn_pool
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+PDFSource = str | bytes | BinaryIO  # a file path, the file's bytes, or a readable binary buffer
+
 class PDFParsingError(Exception):
     """Custom exception for PDF parsing errors."""
     pass
 
-def extract_text_from_pdf(pdf_path: str) -> str:
+class PageTextCache:
+    """
+    LRU cache of extracted page text. Pages are found by (file hash, page number), or, for an
+    edited copy of a file, by a fingerprint of the page's content stream and everything its
+    resources resolve to, so only the pages that actually changed are extracted again. Safe to
+    share between threads.
+    """
+    def __init__(self, max_pages: int = settings.PDF_PAGE_CACHE_SIZE):
+        self.max_pages = max_pages
+        self._pages: OrderedDict[tuple[str, int], tuple[str, str]] = OrderedDict()  # -> (fingerprint, text)
+        self._by_fingerprint: dict[str, tuple[str, int]] = {}
+        self._page_counts: dict[str, int] = {}  # file hash -> number of pages, for whole-file lookups
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, file_hash: str, fingerprints: list[str]) -> dict[int, str]:
+        """Returns the cached text of every page of the file that is cached, by page number."""
+        found = {}
+        with self._lock:
+            for page_number, fingerprint in enumerate(fingerprints):
+                key = (file_hash, page_number)
+                if key not in self._pages:
+                    key = self._by_fingerprint.get(fingerprint)
+                if key is not None and key in self._pages:
+                    self._pages.move_to_end(key)
+                    found[page_number] = self._pages[key][1]
+            self.hits += len(found)
+            self.misses += len(fingerprints) - len(found)
+        return found
+
+    def lookup_file(self, file_hash: str) -> dict[int, str] | None:
+        """
+        Returns the text of every page of the file if all of them are cached under its hash, else
+        None. Needs no fingerprints, so an unchanged file is found without opening it.
+        """
+        with self._lock:
+            page_count = self._page_counts.get(file_hash)
+            if page_count is None or any((file_hash, page_number) not in self._pages for page_number in range(page_count)):
+                return None
+            found = {}
+            for page_number in range(page_count):
+                self._pages.move_to_end((file_hash, page_number))
+                found[page_number] = self._pages[(file_hash, page_number)][1]
+            self.hits += page_count
+        return found
+
+    def store(self, file_hash: str, fingerprints: list[str], pages: dict[int, str]):
+        """Caches newly extracted pages of the file."""
+        with self._lock:
+            self._page_counts[file_hash] = len(fingerprints)
+            for page_number, text in pages.items():
+                key = (file_hash, page_number)
+                self._pages[key] = (fingerprints[page_number], text)
+                self._pages.move_to_end(key)
+                self._by_fingerprint[fingerprints[page_number]] = key
+            while len(self._pages) > self.max_pages:
+                evicted, (fingerprint, _) = self._pages.popitem(last=False)
+                if self._by_fingerprint.get(fingerprint) == evicted:
+                    del self._by_fingerprint[fingerprint]
+                self._page_counts.pop(evicted[0], None)
+
+    def clear(self):
+        """Drops every cached page and resets the hit/miss counts."""
+        with self._lock:
+            self._pages.clear()
+            self._by_fingerprint.clear()
+            self._page_counts.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        """Returns hit/miss counts (in pages) and the number of cached pages."""
+        return {'hits': self.hits, 'misses': self.misses, 'pages': len(self._pages)}
+
+_cache_lock = threading.Lock()
+_page_cache: PageTextCache | None = None
+
+def get_page_cache() -> PageTextCache:
+    """Returns the process-wide page text cache."""
+    global _page_cache
+    with _cache_lock:
+        if _page_cache is None:
+            _page_cache = PageTextCache()
+        return _page_cache
+
+def open_pdf(source: PDFSource) -> fitz.Document:
+    """Opens a PDF from a path, bytes or a binary buffer, without writing anything to disk."""
+    if isinstance(source, str):
+        if not os.path.exists(source):
+            logger.error(f"PDF file not found at specified path: {source}")
+            raise PDFParsingError(f"PDF file not found: {source}")
+        return fitz.open(source)
+    data = source if isinstance(source, bytes) else source.read()
+    return fitz.open(stream=data, filetype="pdf")
+
+def pdf_bytes(source: PDFSource) -> bytes:
+    """Returns the raw bytes of a PDF source."""
+    if isinstance(source, bytes):
+        return source
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            return f.read()
+    return source.read()
+
+_REFERENCE = re.compile(rb"(\d+) 0 R")
+
+def _object_digest(doc: fitz.Document, xref: int, memo: dict[int, bytes]) -> bytes:
+    """
+    Hashes a PDF object, its stream and, recursively, every object it references (fonts, Form
+    XObjects, images, encodings). References are replaced by the digest of their target, so equal
+    content hashes equally whatever its object numbers are in the file.
+    """
+    if xref in memo:
+        return memo[xref]
+    memo[xref] = b"cycle"  # placeholder while this object is being hashed
+    digest = hashlib.sha256(_resolve(doc, doc.xref_object(xref, compressed=True).encode('latin-1'), memo))
+    if doc.xref_is_stream(xref):
+        digest.update(doc.xref_stream_raw(xref) or b"")
+    memo[xref] = digest.digest()
+    return memo[xref]
+
+def _resolve(doc: fitz.Document, source: bytes, memo: dict[int, bytes]) -> bytes:
+    # /Parent would pull the whole page tree (and every other page) into the digest.
+    source = re.sub(rb"/Parent\s+\d+ 0 R", b"", source)
+    return _REFERENCE.sub(lambda match: _object_digest(doc, int(match.group(1)), memo).hex().encode('ascii'), source)
+
+def _page_resources(doc: fitz.Document, page: fitz.Page) -> bytes:
+    """Returns the source of a page's /Resources, following the page tree for inherited resources."""
+    xref = page.xref
+    while xref:
+        kind, value = doc.xref_get_key(xref, "Resources")
+        if kind != "null":
+            return value.encode('latin-1')
+        kind, parent = doc.xref_get_key(xref, "Parent")
+        xref = int(parent.split()[0]) if kind == "xref" else 0
+    return b""
+
+def page_fingerprints(doc: fitz.Document) -> list[str]:
+    """
+    Hashes each page's content stream, geometry and everything its resources resolve to: two pages
+    with the same fingerprint render, and so extract, identically. Much cheaper than extracting text.
+    """
+    memo: dict[int, bytes] = {}
+    fingerprints = []
+    for page in doc:
+        digest = hashlib.sha256(page.read_contents())
+        digest.update(f"{tuple(page.mediabox)} {tuple(page.cropbox)} {page.rotation}".encode('ascii'))
+        digest.update(_resolve(doc, _page_resources(doc, page), memo))
+        fingerprints.append(digest.hexdigest())
+    return fingerprints
+
+_worker_doc: fitz.Document | None = None
+
+def _open_worker_doc(source: str | bytes):
+    """Page-range worker initializer: opens the document once per process instead of once per range."""
+    global _worker_doc
+    _worker_doc = open_pdf(source)
+
+def _extract_range(page_numbers: list[int]) -> list[tuple[int, str]]:
+    return [(page_number, _worker_doc[page_number].get_text("text")) for page_number in page_numbers]
+
+def extract_pages(source: str | bytes, page_numbers: list[int], workers: int = 1) -> Iterator[tuple[int, str]]:
+    """
+    Yields (page number, text) for the given pages in order. Documents with at least
+    PDF_PARALLEL_MIN_PAGES pages to extract are split into page ranges across `workers` processes.
+    """
+    if workers <= 1 or len(page_numbers) < settings.PDF_PARALLEL_MIN_PAGES:
+        doc = open_pdf(source)
+        try:
+            for page_number in page_numbers:
+                yield page_number, doc[page_number].get_text("text")
+        finally:
+            doc.close()
+        return
+
+    ranges = [page_numbers[i:i + settings.PDF_PAGES_PER_TASK] for i in range(0, len(page_numbers), settings.PDF_PAGES_PER_TASK)]
+    logger.info(f"Extracting {len(page_numbers)} pages in {len(ranges)} ranges across {workers} processes.")
+    with spawn_pool(workers, initializer=_open_worker_doc, initargs=(source,)) as pool:
+        for pages in pool.map(_extract_range, ranges):
+            yield from pages
+
+def fingerprint_pdf(source: str | bytes, file_hash: str | None = None) -> tuple[str, list[str]]:
+    """Opens a PDF just far enough to fingerprint its pages and returns (file hash, page fingerprints)."""
+    try:
+        doc = open_pdf(source)
+    except PDFParsingError:
+        raise
+    except Exception as e:
+        raise PDFParsingError(f"Could not open PDF: {e}")
+    try:
+        fingerprints = page_fingerprints(doc)
+    finally:
+        doc.close()
+    if file_hash is None:
+        file_hash = hashlib.sha256(pdf_bytes(source)).hexdigest()
+    return file_hash, fingerprints
+
+def lookup_pages(source: str | bytes, file_hash: str | None = None, cache: PageTextCache | None = None) -> tuple[str, list[str], dict[int, str]]:
+    """Fingerprints the pages of a PDF and returns (file hash, page fingerprints, cached text by page number)."""
+    cache = cache or get_page_cache()
+    file_hash, fingerprints = fingerprint_pdf(source, file_hash)
+    return file_hash, fingerprints, cache.lookup(file_hash, fingerprints)
+
+def iter_pages(source: str | bytes, page_count: int, cached: dict[int, str], new_pages: dict[int, str], workers: int = 1) -> Iterator[str]:
+    """
+    Yields the text of every page in order: cached pages as they are, the others extracted
+    (across `workers` processes for large documents) and also recorded in new_pages.
     """
-    Extracts all text content from a PDF file using PyMuPDF.
+    missing = [page_number for page_number in range(page_count) if page_number not in cached]
+    if cached:
+        logger.info(f"Reusing {len(cached)} cached pages; extracting {len(missing)} of {page_count}.")
+    extracted = extract_pages(source, missing, workers) if missing else iter(())
+    try:
+        for page_number in range(page_count):
+            if page_number in cached:
+                yield cached[page_number]
+                continue
+            _, text = next(extracted)
+            new_pages[page_number] = text
+            yield text
+    finally:
+        if missing:
+            extracted.close()
+
+def iter_pdf_pages(source: PDFSource, file_hash: str | None = None, workers: int = 1, cache: PageTextCache | None = None) -> Iterator[str]:
+    """
+    Yields the text of every page of a PDF in order, so callers can process a document page by
+    page. Unchanged pages come from the page cache; file_hash is computed if not given.
+    """
+    cache = cache or get_page_cache()
+    if not isinstance(source, str):
+        source = pdf_bytes(source)  # a buffer can only be read once
+    cached = cache.lookup_file(file_hash) if file_hash else None
+    if cached is not None:
+        yield from (cached[page_number] for page_number in range(len(cached)))
+        return
+    file_hash, fingerprints, cached = lookup_pages(source, file_hash, cache)
+    new_pages = {}
+    try:
+        yield from iter_pages(source, len(fingerprints), cached, new_pages, workers)
+    finally:
+        cache.store(file_hash, fingerprints, new_pages)
+
+def extract_text_from_pdf(pdf_source: PDFSource, file_hash: str | None = None, workers: int = 1) -> str:
+    """
+    Extracts all text content from a PDF using PyMuPDF.
     Args:
-        pdf_path: The file path to the PDF.
+        pdf_source: The file path to the PDF, its bytes, or a binary buffer.
+        file_hash: Content hash of the file, if already known (used for the page cache).
+        workers: Processes to extract large documents with.
     Returns:
         The extracted text as a single string.
     Raises:
         PDFParsingError if the file doesn't exist or text extraction fails.
     """
-    if not os.path.exists(pdf_path):
-        logger.error(f"PDF file not found at specified path: {pdf_path}")
-        raise PDFParsingError(f"PDF file not found: {pdf_path}")
-
+    name = os.path.basename(pdf_source) if isinstance(pdf_source, str) else "in-memory PDF"
     try:
-        logger.info(f"Opening PDF for text extraction: {os.path.basename(pdf_path)}")
-        doc = fitz.open(pdf_path)
-        text_parts = [page.get_text("text") for page in doc]
-        doc.close()
-
+        logger.info(f"Opening PDF for text extraction: {name}")
+        text_parts = list(iter_pdf_pages(pdf_source, file_hash=file_hash, workers=workers))
         full_text = "\n\n".join(filter(None, text_parts))
+    except PDFParsingError:
+        raise
+    except Exception as e:
+        logger.error(f"Failed to parse PDF {name}: {e}", exc_info=True)
+        raise PDFParsingError(f"An error occurred while parsing '{name}': {str(e)}")
 
-        if not full_text.strip():
-            logger.warning(f"No text could be extracted from {os.path.basename(pdf_path)}. It might be image-based or empty.")
-            raise PDFParsingError(f"No text could be extracted from '{os.path.basename(pdf_path)}'. The PDF might be image-based or contain no selectable text.")
+    if not full_text.strip():
+        logger.warning(f"No text could be extracted from {name}. It might be image-based or empty.")
+        raise PDFParsingError(f"No text could be extracted from '{name}'. The PDF might be image-based or contain no selectable text.")
 
-        logger.info(f"Successfully extracted {len(full_text)} characters from {os.path.basename(pdf_path)}.")
-        return full_text
-    except Exception as e:
-        logger.error(f"Failed to parse PDF {os.path.basename(pdf_path)}: {e}", exc_info=True)
-        raise PDFParsingError(f"An error occurred while parsing '{os.path.basename(pdf_path)}': {str(e)}")
\ No newline at end of file
+    logger.info(f"Successfully extracted {len(full_text)} characters from {name}.")
+    return full_text
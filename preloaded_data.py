@@ -2,55 +2,78 @@
 
 import os
 import logging
-from pdf_utils import extract_text_from_pdf, PDFParsingError
-from chunking import SemanticChunker
-from rag_utils import RAGVectorStore
+from collections.abc import Callable
+from config import settings
+from ingestion import IngestJob, ingest_files
+from rag_utils import RAGVectorStore, file_content_hash
 
 logger = logging.getLogger(__name__)
 DATA_DIR = "data"
 
-def preload_data_to_store(rag_store: RAGVectorStore) -> list[str]:
+def preload_data_to_store(
+    rag_store: RAGVectorStore,
+    index_dir: str | None = settings.INDEX_DIR,
+    data_dir: str = DATA_DIR,
+    progress: Callable[[int, int], None] | None = None,
+) -> list[str]:
     """
-    Scans DATA_DIR, processes files, chunks them semantically, and adds them to the rag_store.
-    Returns a list of filenames that were successfully processed.
+    Scans data_dir (DATA_DIR by default), processes files through the ingestion pipeline, and adds them to the rag_store.
+    If index_dir is set, the saved index there is loaded first and only new or changed files
+    (by content hash) are ingested; the updated index is saved back afterwards.
+    progress(files_done, files_total) reports ingestion progress.
+    Returns a list of filenames that are indexed from data_dir.
     """
     processed_filenames = []
-    if not os.path.exists(DATA_DIR):
-        logger.warning(f"Preload data directory not found: '{DATA_DIR}'. Skipping preloading.")
-        return []
+    if index_dir:
+        rag_store.load(index_dir)
 
-    logger.info("--- Starting preloading process ---")
-    chunker = SemanticChunker(rag_store.embedding_model)
-    files_to_process = [f for f in os.listdir(DATA_DIR) if f.endswith((".pdf", ".txt", ".md"))]
+    files_to_process = []
+    if not os.path.exists(data_dir):
+        logger.warning(f"Preload data directory not found: '{data_dir}'. Skipping preloading.")
+    else:
+        files_to_process = sorted(f for f in os.listdir(data_dir) if f.endswith((".pdf", ".txt", ".md")))
+        if not files_to_process:
+            logger.info(f"No supported files (.pdf, .txt, .md) found in the '{data_dir}' directory.")
+    file_hashes = {f: file_content_hash(os.path.join(data_dir, f)) for f in files_to_process}
+
+    # Drop sources that were deleted from data_dir or whose content has changed since the last save,
+    # even when data_dir is now empty or gone. Sources merged in by build_index.py never came from
+    # data_dir and are kept.
+    index_changed = False
+    for source, saved_hash in list(rag_store.source_hashes.items()):
+        if source not in rag_store.offline_sources and file_hashes.get(source) != saved_hash:
+            rag_store.remove_source(source)
+            index_changed = True
 
     if not files_to_process:
-        logger.info("No supported files (.pdf, .txt, .md) found in the 'data' directory.")
+        if index_dir and index_changed:
+            rag_store.save(index_dir)
         return []
 
+    logger.info("--- Starting preloading process ---")
+    jobs = []
+    queued_hashes = set()
     for filename in files_to_process:
-        file_path = os.path.join(DATA_DIR, filename)
-        content = ""
-        try:
-            logger.info(f"Processing '{filename}'...")
-            if filename.endswith(".pdf"):
-                content = extract_text_from_pdf(file_path)
-            else: # For .txt and .md
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-
-            if content.strip():
-                chunks = chunker.chunk(content)
-                if chunks:
-                    rag_store.add_texts(chunks, source=filename)
-                    logger.info(f"Successfully processed and chunked '{filename}' into {len(chunks)} semantic chunks.")
-                    processed_filenames.append(filename)
-                else:
-                    logger.warning(f"Could not generate any chunks from '{filename}'. It may be too short.")
-            else:
-                logger.warning(f"No content extracted from '{filename}'.")
-
-        except (PDFParsingError, Exception) as e:
-            logger.error(f"Failed to process preloaded file {file_path}: {e}")
-            
-    logger.info(f"--- Preloading complete. Processed {len(processed_filenames)} files. ---")
-    return processed_filenames
\ No newline at end of file
+        file_hash = file_hashes[filename]
+        if rag_store.source_hashes.get(filename) == file_hash:
+            processed_filenames.append(filename)
+            continue
+        if rag_store.has_content(file_hash) or file_hash in queued_hashes:
+            logger.info(f"Skipping '{filename}': identical content is already indexed.")
+            continue
+        queued_hashes.add(file_hash)
+        jobs.append(IngestJob(source=filename, path=os.path.join(data_dir, filename), source_hash=file_hash))
+
+    if jobs:
+        logger.info(f"Ingesting {len(jobs)} new or changed files...")
+        ingested = ingest_files(rag_store, jobs, progress=progress)
+        processed_filenames = sorted(processed_filenames + ingested)
+        index_changed = True
+
+    if index_dir and index_changed:
+        rag_store.save(index_dir)
+
+    memory = rag_store.memory_usage()
+    logger.info(f"Index memory: {memory['vector_bytes'] + memory['document_bytes']} bytes ({memory['bytes_per_chunk']:.0f} bytes per chunk).")
+    logger.info(f"--- Preloading complete. {len(processed_filenames)} files indexed. ---")
+    return processed_filenames
@@ -0,0 +1,13 @@
+# process_pool.py
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+def spawn_pool(workers: int, initializer=None, initargs: tuple = ()) -> ProcessPoolExecutor:
+    """
+    Returns a process pool for CPU-bound work (PDF extraction, sentence segmentation).
+    Workers are spawned, not forked: the parent process may hold torch threads, which do not
+    survive a fork. Spawned workers re-import the modules they need, so keep those free of
+    torch/faiss imports.
+    """
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=initializer, initargs=initargs)
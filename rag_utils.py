@@ -1,55 +1,774 @@
 # rag_utils.py
 
+from __future__ import annotations
 import faiss
-from sentence_transformers import SentenceTransformer
+import functools
 import numpy as np
+import hashlib
+import json
 import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from array import array
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
 from config import settings
+from compact_storage import ColumnarDocuments, dict_documents_nbytes
+from embedding_cache import get_embedding_cache
+from encoder_service import embedding_model_id, get_encoder
+from metrics import get_metrics
+from index_backends import (
+    IVF_BACKENDS, LOSSY_BACKENDS, create_index, create_staging_index, index_nbytes, is_staging,
+    recall_at_k, search_parameters, set_search_param, train_index, train_size, unwrap, uses_inner_product,
+)
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+    from encoder_service import BatchingEncoder
 
 logger = logging.getLogger(__name__)
 
-class RAGVectorStore:
+INDEX_FILENAME = "index.faiss"
+DOCUMENTS_FILENAME = "documents.json"
+MANIFEST_FILENAME = "manifest.json"
+STORE_FORMAT = 2  # bumped when the on-disk layout changes; older saves are rebuilt
+OVERLAY_FIRST_ID = 1 << 48
+
+def content_hash(data: bytes) -> str:
+    """Returns the SHA-256 hex digest used to identify a source by its content."""
+    return hashlib.sha256(data).hexdigest()
+
+def file_content_hash(path: str, block_size: int = 1 << 20) -> str:
+    """Returns the content hash of a file without reading it into memory at once."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+_model_lock = threading.Lock()
+_embedding_models: dict[str, SentenceTransformer] = {}
+
+def get_embedding_model(model_name: str = settings.EMBEDDING_MODEL_NAME) -> SentenceTransformer:
+    """Returns the process-wide embedding model, loading it on first use."""
+    with _model_lock:
+        if model_name not in _embedding_models:
+            logger.info(f"Loading embedding model '{model_name}' for this process.")
+            # Imported here: torch and sentence-transformers take seconds to import.
+            from sentence_transformers import SentenceTransformer
+            _embedding_models[model_name] = SentenceTransformer(model_name)
+        return _embedding_models[model_name]
+
+def _write_atomic(path: str, data: str):
+    """Writes a text file via a temporary file so readers never see a partial write."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+class _ReadWriteLock:
+    """
+    Lets any number of readers hold the lock at once, or a single writer. A writer waits for the
+    readers inside to leave, and new readers wait behind a waiting writer so a steady stream of
+    searches cannot starve it. The writer may re-enter and read; a reader must not re-enter.
+    """
     def __init__(self):
-        """Initializes the RAG vector store."""
-        self.embedding_model = SentenceTransformer(settings.EMBEDDING_MODEL_NAME)
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._waiting_writers = 0
+        self._writer: int | None = None  # thread id of the writer
+        self._depth = 0
+
+    @contextmanager
+    def read(self):
+        if self._writer == threading.get_ident():
+            yield
+            return
+        with self._cond:
+            while self._writer is not None or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer != me:
+                self._waiting_writers += 1
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+                self._waiting_writers -= 1
+                self._writer = me
+            self._depth += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._depth -= 1
+                if not self._depth:
+                    self._writer = None
+                    self._cond.notify_all()
+
+def _reading(method):
+    """Runs a RAGVectorStore method under the store's shared lock: readers never wait for each other."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock.read():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+class RAGVectorStore:
+    def __init__(self, embedding_model: BatchingEncoder | SentenceTransformer | None = None, first_id: int = 0, backend: str | None = None):
+        """Initializes the RAG vector store, sharing the process-wide batching encoder and INDEX_BACKEND by default."""
+        self.embedding_model = embedding_model or get_encoder()
         self.d = self.embedding_model.get_sentence_embedding_dimension()
-        self.documents = []  # Will store {'text': chunk, 'source': filename}
-        self.index = faiss.IndexFlatL2(self.d)
-        logger.info(f"Initialized FAISS index with dimension {self.d}.")
+        self.first_id = first_id
+        self.documents = self._new_documents()  # chunk id -> {'id': chunk id, 'text': chunk, 'source': filename}
+        self.source_ids = {}  # source filename -> ids of its chunks
+        self.source_hashes = {}  # source filename -> content hash of the file it came from
+        self.offline_sources = set()  # sources merged in by build_index.py, which preloading leaves alone
+        self.deleted_ids = set()  # removed chunk ids still physically present in the index
+        self._deleted_selector = None
+        self.next_id = first_id
+        self.store_id = uuid.uuid4().hex
+        self.version = 0  # bumped whenever the set of indexed chunks changes
+        self.backend = backend or settings.INDEX_BACKEND
+        self.index = self._new_index()
+        self._lock = _ReadWriteLock()  # shared by searches, exclusive for (short) mutations
+        self._maintenance = threading.Lock()  # one index rebuild (training, compaction, save, load) at a time
+        logger.info(f"Initialized FAISS '{self.backend}' index with dimension {self.d}.")
+
+    def _new_documents(self) -> dict | ColumnarDocuments:
+        """Creates an empty document store: columnar in compact mode, a plain dict otherwise."""
+        return ColumnarDocuments(self.first_id) if settings.COMPACT_STORAGE else {}
+
+    def _new_index(self) -> faiss.Index:
+        """Creates an empty index. Backends that need training start on an exact flat index until there is enough data."""
+        if train_size(self.backend):
+            return create_staging_index(self.d)
+        return create_index(self.backend, self.d)
+
+    def _prepare(self, vectors: np.ndarray) -> np.ndarray:
+        """Returns float32 vectors, L2-normalized when the backend searches by inner product."""
+        vectors = np.array(vectors, dtype='float32')
+        if uses_inner_product(self.backend):
+            faiss.normalize_L2(vectors)
+        return vectors
+
+    def _maybe_train(self):
+        """
+        Swaps the staging flat index for a trained index once enough vectors have accumulated.
+        Training runs on a snapshot outside the exclusive lock, so searches go on meanwhile.
+        """
+        if not (is_staging(self.index, self.backend) and self.ntotal >= train_size(self.backend)):
+            return
+        with self._maintenance:
+            with self._lock.read():
+                if not is_staging(self.index, self.backend):
+                    return  # another thread trained it first
+                snapshot = self._snapshot()
+                ids, vectors = self._live_vectors()
+            index = train_index(self.backend, vectors, ids)
+            with self._lock.write():
+                self._swap_index(index, snapshot)
+
+    def _snapshot(self) -> tuple[int, frozenset]:
+        """Marks the state an index rebuild starts from; taken under the lock, passed to _swap_index()."""
+        return self.next_id, frozenset(self.deleted_ids)
+
+    def _swap_index(self, index: faiss.Index, snapshot: tuple[int, frozenset]):
+        """
+        Installs an index rebuilt outside the lock from the live chunks at snapshot, catching it up
+        with the chunks added and removed meanwhile. Called under the exclusive lock.
+        """
+        next_id, deleted = snapshot
+        added = np.fromiter((i for i in range(next_id, self.next_id) if i in self.documents), dtype='int64')
+        if len(added):
+            index.add_with_ids(self.index.reconstruct_batch(added), added)
+        self.index = index
+        # Chunks removed since the snapshot are still in the rebuilt index; keep them tombstoned.
+        self.deleted_ids = {i for i in self.deleted_ids - deleted if i < next_id}
+        self._deleted_selector = None
+        self._apply_search_params()
+
+    def _live_ids(self, sample: int | None = None) -> np.ndarray:
+        """Returns the ids of every live chunk in insertion order, or of a fixed random sample of them."""
+        ids = np.fromiter(self.documents.keys(), dtype='int64', count=len(self.documents))
+        if sample is not None and sample < len(ids):
+            ids = np.sort(np.random.default_rng(0).choice(ids, size=sample, replace=False))
+        return ids
 
-    def add_texts(self, texts: list[str], source: str):
-        """Adds a list of text chunks from a specific source to the vector store."""
-        valid_texts = [text for text in texts if text and not text.isspace()]
+    def _live_vectors(self, sample: int | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the ids and full-precision vectors of every live chunk (or of a sample of them)."""
+        ids = self._live_ids(sample)
+        if len(ids) == 0:
+            return ids, np.empty((0, self.d), dtype='float32')
+        if self.backend in LOSSY_BACKENDS and not is_staging(self.index, self.backend):
+            # PQ and int8 codes only reconstruct approximately; re-encode the texts (cheap when cached).
+            texts = [self.documents[chunk_id]['text'] for chunk_id in ids.tolist()]
+            return ids, self._prepare(get_embedding_cache().encode(self.embedding_model, texts))
+        return ids, self.index.reconstruct_batch(ids)
+
+    def retrain(self):
+        """
+        Retrains the IVF or int8 index on a sample of train_size() live vectors, e.g. after the corpus
+        has grown or drifted, and moves every vector into it. Only the sample is re-encoded on lossy
+        backends; the other vectors are moved as their stored codes reconstruct them.
+        """
+        if not train_size(self.backend):
+            logger.info(f"Index backend '{self.backend}' does not need training.")
+            return
+        with self._maintenance:
+            with self._lock.read():
+                if self.ntotal < train_size(self.backend):
+                    logger.warning(f"Only {self.ntotal} vectors; at least {train_size(self.backend)} are needed to train '{self.backend}'.")
+                    return
+                snapshot = self._snapshot()
+                _, train_vectors = self._live_vectors(sample=train_size(self.backend))
+                ids = self._live_ids()
+                vectors = self.index.reconstruct_batch(ids)
+            index = train_index(self.backend, vectors, ids, train_vectors=train_vectors)
+            with self._lock.write():
+                self._swap_index(index, snapshot)
+        logger.info(f"Retrained '{self.backend}' index on {len(train_vectors)} of {len(ids)} vectors.")
+
+    def recall_at_k(self, queries: list[str] | None = None, k: int = settings.TOP_K, sample_queries: int = 200, sample_vectors: int = settings.RECALL_SAMPLE_SIZE, param_values: list[int] | None = None) -> list[dict]:
+        """
+        Measures recall@k of the configured backend against an exact flat index for each nprobe/efSearch
+        value given, over a sample of sample_vectors stored chunks. Without queries, chunks of the
+        sample are used as queries. Removed chunks still in the index are filtered out, not compacted.
+        """
+        query_vectors = self._prepare(self.embedding_model.encode(queries, convert_to_numpy=True)) if queries else None
+        with self._lock.read():
+            ids, exact_vectors = self._live_vectors(sample=sample_vectors)
+            if len(exact_vectors) == 0:
+                return []
+            if query_vectors is None:
+                rng = np.random.default_rng(0)
+                sample = rng.choice(len(exact_vectors), size=min(sample_queries, len(exact_vectors)), replace=False)
+                query_vectors = exact_vectors[sample]
+            # A sample is searched within its ids; the whole store within the tombstone filter.
+            selector = self._selector(None) if len(ids) == self.ntotal else None
+            return recall_at_k(self.index, ids, exact_vectors, query_vectors, k, self.backend, param_values, selector)
+
+    def _apply_search_params(self):
+        set_search_param(self.index, self.backend, settings.HNSW_EF_SEARCH if self.backend == "hnsw" else settings.IVF_NPROBE)
+
+    def add_texts(self, texts: list[str], source: str, source_hash: str | None = None, embeddings: np.ndarray | None = None) -> list[int]:
+        """
+        Adds a list of text chunks from a specific source to the vector store and returns their ids.
+        Precomputed embeddings (one row per text) skip encoding; otherwise chunks are
+        encoded through the shared embedding cache.
+        """
+        valid_texts, embeddings = self._encode_texts(texts, source, embeddings)
+        if not valid_texts:
+            return []
+        with self._lock.write():
+            chunk_ids = self._add_encoded(valid_texts, embeddings, source, source_hash)
+        self._maybe_train()
+        logger.info(f"Index now contains {self.ntotal} total vectors.")
+        return chunk_ids
+
+    def _encode_texts(self, texts: list[str], source: str, embeddings: np.ndarray | None) -> tuple[list[str], np.ndarray | None]:
+        """Drops empty texts and encodes the rest (or selects their precomputed rows), outside the lock."""
+        valid_rows = [i for i, text in enumerate(texts) if text and not text.isspace()]
+        valid_texts = [texts[i] for i in valid_rows]
         if not valid_texts:
             logger.warning(f"add_texts called with no valid text content for source: {source}.")
-            return
+            return [], None
+
+        if embeddings is not None:
+            logger.info(f"Adding {len(valid_texts)} pre-encoded chunks from '{source}' to the index.")
+            embeddings = np.asarray(embeddings, dtype='float32')[valid_rows]
+        else:
+            logger.info(f"Encoding and adding {len(valid_texts)} new chunks from '{source}' to the index.")
+            embeddings = get_embedding_cache().encode(self.embedding_model, valid_texts)
+        return valid_texts, self._prepare(embeddings)
+
+    def _add_encoded(self, texts: list[str], vectors: np.ndarray, source: str, source_hash: str | None) -> list[int]:
+        """
+        Adds encoded chunks to the index and the document store, then records the source's content
+        hash: a source without chunks is never reported as indexed. Called under the exclusive lock.
+        """
+        ids = np.arange(self.next_id, self.next_id + len(texts), dtype='int64')
+        self.index.add_with_ids(vectors, ids)
+        self.next_id += len(texts)
+
+        chunk_ids = ids.tolist()
+        for chunk_id, text in zip(chunk_ids, texts):
+            self.documents[chunk_id] = {'id': chunk_id, 'text': text, 'source': source}
+        self.source_ids.setdefault(source, array('q')).extend(chunk_ids)
+        if source_hash:
+            self.source_hashes[source] = source_hash
+        self.version += 1
+        return chunk_ids
+
+    @_reading
+    def has_content(self, source_hash: str) -> bool:
+        """Returns True if a source with this content hash is already indexed."""
+        return source_hash in self.source_hashes.values()
+
+    def remove_source(self, source: str) -> int:
+        """
+        Removes every chunk of a source in time proportional to that source: its ids are
+        tombstoned and filtered out of searches until the next compaction.
+        Returns the number of chunks removed.
+        """
+        with self._lock.write():
+            removed = self._remove(source)
+        self._maybe_compact()
+        return removed
+
+    def _remove(self, source: str) -> int:
+        """Tombstones the chunks of a source. Called under the exclusive lock."""
+        chunk_ids = self.source_ids.pop(source, [])
+        self.source_hashes.pop(source, None)
+        self.offline_sources.discard(source)
+        if not chunk_ids:
+            return 0
+        for chunk_id in chunk_ids:
+            self.documents.pop(chunk_id, None)
+        self.deleted_ids.update(chunk_ids)
+        self._deleted_selector = None
+        self.version += 1
+        logger.info(f"Removed {len(chunk_ids)} chunks of '{source}' from the index.")
+        return len(chunk_ids)
+
+    def replace_source(self, source: str, texts: list[str], source_hash: str | None = None, embeddings: np.ndarray | None = None) -> list[int]:
+        """
+        Replaces the chunks of a source (e.g. a corrected upload) without touching other sources.
+        The new chunks are encoded first; searches never see the source half replaced.
+        """
+        valid_texts, embeddings = self._encode_texts(texts, source, embeddings)
+        with self._lock.write():
+            self._remove(source)
+            chunk_ids = self._add_encoded(valid_texts, embeddings, source, source_hash) if valid_texts else []
+        self._maybe_compact()
+        self._maybe_train()
+        return chunk_ids
+
+    def _maybe_compact(self):
+        """Compacts once tombstones make up more than COMPACT_DELETED_FRACTION of the index."""
+        if len(self.deleted_ids) > settings.COMPACT_DELETED_FRACTION * self.index.ntotal:
+            self.compact()
+
+    def compact(self):
+        """
+        Physically drops tombstoned vectors. The index is rebuilt on a copy while searches go on;
+        the exclusive lock is only held to swap it in.
+        """
+        with self._maintenance:
+            self._compact()
+
+    def _compact(self):
+        with self._lock.read():
+            if not self.deleted_ids:
+                return
+            snapshot = self._snapshot()
+            hnsw = isinstance(unwrap(self.index), faiss.IndexHNSWFlat)
+            if hnsw:
+                # HNSW graphs cannot delete nodes; rebuild from the live vectors under the same ids.
+                ids, vectors = self._live_vectors()
+            else:
+                index = faiss.clone_index(self.index)
+        if hnsw:
+            index = create_index(self.backend, self.d)
+            if len(ids):
+                index.add_with_ids(vectors, ids)
+        else:
+            _, deleted = snapshot
+            index.remove_ids(np.fromiter(deleted, dtype='int64', count=len(deleted)))
+        with self._lock.write():
+            self._swap_index(index, snapshot)
+            if isinstance(self.documents, ColumnarDocuments):
+                self.documents.compact()
+        logger.info(f"Compacted index: dropped {len(snapshot[1])} removed vectors.")
+
+    @property
+    def ntotal(self) -> int:
+        """Number of indexed (live) chunks."""
+        return len(self.documents)
+
+    def _selector(self, exclude_ids: set[int] | None) -> faiss.IDSelector | None:
+        """Builds an id filter for removed chunks plus any extra ids to exclude."""
+        if not exclude_ids:
+            if self.deleted_ids and self._deleted_selector is None:
+                deleted = np.fromiter(self.deleted_ids, dtype='int64', count=len(self.deleted_ids))
+                self._deleted_selector = faiss.IDSelectorNot(faiss.IDSelectorBatch(deleted))
+            return self._deleted_selector
+        excluded = self.deleted_ids | exclude_ids
+        return faiss.IDSelectorNot(faiss.IDSelectorBatch(np.fromiter(excluded, dtype='int64', count=len(excluded))))
 
-        logger.info(f"Encoding and adding {len(valid_texts)} new chunks from '{source}' to the index.")
-        # OPTIMIZATION: encode_multi_process is faster for large numbers of chunks
-        embeddings = self.embedding_model.encode(valid_texts, convert_to_numpy=True, show_progress_bar=False)
-        self.index.add(embeddings.astype('float32'))
-        
-        for text in valid_texts:
-            self.documents.append({'text': text, 'source': source})
-            
-        logger.info(f"Index now contains {self.index.ntotal} total vectors.")
-
-    def query(self, query_text: str, top_k: int = settings.TOP_K) -> list[dict]:
+    @_reading
+    def search_batch(self, query_embs: np.ndarray, top_k: int, exclude_ids: set[int] | None = None) -> list[list[tuple[float, dict]]]:
+        """Searches the index with a (n, d) batch of encoded queries in one call; one (distance, document) list per query."""
+        if not self.documents:
+            return [[] for _ in range(len(query_embs))]
+        selector = self._selector(exclude_ids)
+        params = search_parameters(self.index, self.backend, selector) if selector is not None else None
+        distances, indices = self.index.search(self._prepare(query_embs), top_k, params=params)
+        if uses_inner_product(self.backend):
+            distances = 1 - distances  # cosine similarity -> cosine distance, so lower is always better
+        # -1 marks an empty result slot
+        return [
+            [(float(dist), self.documents[i]) for dist, i in zip(row_distances, row_indices) if i in self.documents]
+            for row_distances, row_indices in zip(distances, indices)
+        ]
+
+    def search(self, query_emb: np.ndarray, top_k: int, exclude_ids: set[int] | None = None) -> list[tuple[float, dict]]:
+        """Searches the index with an already-encoded query, returning (distance, document) pairs."""
+        return self.search_batch(np.asarray(query_emb).reshape(1, -1), top_k, exclude_ids)[0]
+
+    @_reading
+    def get_vectors(self, chunk_ids: list[int]) -> np.ndarray:
+        """Returns the stored vectors of the given chunks (approximate for PQ codes)."""
+        if not chunk_ids:
+            return np.empty((0, self.d), dtype='float32')
+        return self.index.reconstruct_batch(np.asarray(chunk_ids, dtype='int64'))
+
+    @_reading
+    def memory_usage(self) -> dict:
+        """Reports the approximate memory held by the index vectors and the document store."""
+        vector_bytes = index_nbytes(self.index)
+        if isinstance(self.documents, ColumnarDocuments):
+            document_bytes = self.documents.nbytes()
+        else:
+            document_bytes = dict_documents_nbytes(self.documents)
+        return {
+            'chunks': self.ntotal,
+            'vector_bytes': vector_bytes,
+            'document_bytes': document_bytes,
+            'bytes_per_chunk': (vector_bytes + document_bytes) / self.ntotal if self.ntotal else 0.0,
+        }
+
+    def corpus_key(self) -> tuple:
+        """Identifies the current set of indexed chunks; changes whenever documents are added or removed."""
+        return (self.store_id, self.version)
+
+    def encode_query(self, query_text: str) -> np.ndarray:
+        """Encodes a query into the (1, d) float32 array search() expects."""
+        return self.embedding_model.encode([query_text], convert_to_numpy=True).astype('float32')
+
+    def encode_queries(self, query_texts: list[str]) -> np.ndarray:
+        """Encodes many queries in one batched encoder pass into an (n, d) float32 array."""
+        if not query_texts:
+            return np.empty((0, self.d), dtype='float32')
+        return self.embedding_model.encode(query_texts, convert_to_numpy=True).astype('float32')
+
+    def query(self, query_text: str, top_k: int = settings.TOP_K, query_emb: np.ndarray | None = None) -> list[dict]:
         """Queries the vector store to find the most relevant document chunks."""
-        if self.index.ntotal == 0:
+        if not self.documents:
             logger.warning("Query attempted on an empty index.")
             return []
 
         logger.info(f"Performing query for top {top_k} results.")
-        query_emb = self.embedding_model.encode([query_text], convert_to_numpy=True).astype('float32')
-        distances, indices = self.index.search(query_emb, top_k)
-        
-        # Ensure indices are within the valid range
-        results = [self.documents[i] for i in indices[0] if 0 <= i < len(self.documents)]
-        return results
+        if query_emb is None:
+            query_emb = self.encode_query(query_text)
+        return [doc for _, doc in self.search(query_emb, top_k)]
+
+    def query_batch(self, query_texts: list[str], top_k: int = settings.TOP_K, query_embs: np.ndarray | None = None) -> list[list[dict]]:
+        """Like query() for many queries at once: one batched encode and one index search."""
+        if not self.documents:
+            logger.warning("Batch query attempted on an empty index.")
+            return [[] for _ in query_texts]
+
+        logger.info(f"Performing batch query of {len(query_texts)} queries for top {top_k} results.")
+        if query_embs is None:
+            query_embs = self.encode_queries(query_texts)
+        return [[doc for _, doc in hits] for hits in self.search_batch(query_embs, top_k)]
+
+    def save(self, directory: str = settings.INDEX_DIR):
+        """
+        Persists the FAISS index, document store and source hashes to a directory. It is written
+        under the shared lock: searches go on, only additions and removals wait.
+        """
+        with self._maintenance:
+            self._compact()
+            os.makedirs(directory, exist_ok=True)
+            index_path = os.path.join(directory, INDEX_FILENAME)
+            with self._lock.read():
+                faiss.write_index(self.index, f"{index_path}.tmp")
+                documents = json.dumps(list(self.documents.values()))
+                # The manifest is written last: a directory without a matching manifest is never loaded.
+                manifest = {
+                    'format': STORE_FORMAT,
+                    'embedding_model': embedding_model_id(),
+                    'dimension': self.d,
+                    'backend': self.backend,
+                    'ntotal': self.index.ntotal,
+                    'next_id': self.next_id,
+                    'sources': dict(self.source_hashes),
+                    'offline_sources': sorted(self.offline_sources),
+                }
+            os.replace(f"{index_path}.tmp", index_path)
+            _write_atomic(os.path.join(directory, DOCUMENTS_FILENAME), documents)
+            _write_atomic(os.path.join(directory, MANIFEST_FILENAME), json.dumps(manifest, indent=2))
+        logger.info(f"Saved index with {manifest['ntotal']} vectors to '{directory}'.")
+
+    def load(self, directory: str = settings.INDEX_DIR) -> bool:
+        """
+        Loads a previously saved index from a directory, memory-mapping the vectors.
+        Returns False (leaving the store untouched) if nothing usable is saved there.
+        """
+        manifest_path = os.path.join(directory, MANIFEST_FILENAME)
+        if not os.path.exists(manifest_path):
+            return False
+
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get('embedding_model') != embedding_model_id() or manifest.get('dimension') != self.d:
+                logger.warning(f"Saved index in '{directory}' was built with a different embedding model. Ignoring it.")
+                return False
+            if manifest.get('format') != STORE_FORMAT:
+                logger.warning(f"Saved index in '{directory}' uses an older store format. Ignoring it.")
+                return False
+            if manifest.get('backend') != self.backend:
+                logger.warning(f"Saved index in '{directory}' uses backend '{manifest.get('backend')}', not '{self.backend}'. Ignoring it.")
+                return False
+
+            # Memory-mapped IVF inverted lists are read-only, so trained IVF indexes are read into memory.
+            io_flags = 0 if self.backend in IVF_BACKENDS else faiss.IO_FLAG_MMAP
+            index = faiss.read_index(os.path.join(directory, INDEX_FILENAME), io_flags)
+            with open(os.path.join(directory, DOCUMENTS_FILENAME), 'r', encoding='utf-8') as f:
+                documents = {doc['id']: doc for doc in json.load(f)}
+            if index.ntotal != len(documents) or index.ntotal != manifest.get('ntotal'):
+                logger.warning(f"Saved index in '{directory}' is inconsistent with its document store. Ignoring it.")
+                return False
+        except Exception as e:
+            logger.error(f"Failed to load saved index from '{directory}': {e}")
+            return False
+
+        # The new state is built first, then swapped in under the exclusive lock.
+        store_documents = self._new_documents()
+        source_ids = {}
+        for chunk_id in sorted(documents):
+            doc = documents[chunk_id]
+            store_documents[chunk_id] = doc
+            source_ids.setdefault(doc['source'], array('q')).append(chunk_id)
+        with self._maintenance, self._lock.write():
+            self.index = index
+            self.documents = store_documents
+            self.source_ids = source_ids
+            self.source_hashes = manifest.get('sources', {})
+            self.offline_sources = set(manifest.get('offline_sources', []))
+            self.deleted_ids = set()
+            self._deleted_selector = None
+            self.next_id = manifest['next_id']
+            self.version += 1
+            self._apply_search_params()
+        logger.info(f"Loaded index with {self.index.ntotal} vectors from '{directory}'.")
+        return True
 
     def clear(self):
         """Resets the vector store to its initial empty state."""
-        self.documents = []
-        self.index.reset() # Use reset() for a clean wipe
-        logger.info("RAG vector store has been cleared.")
\ No newline at end of file
+        with self._maintenance, self._lock.write():
+            self.documents = self._new_documents()
+            self.source_ids = {}
+            self.source_hashes = {}
+            self.offline_sources = set()
+            self.deleted_ids = set()
+            self._deleted_selector = None
+            self.next_id = self.first_id
+            self.version += 1
+            self.index = self._new_index() # A fresh index also drops any IVF training
+        logger.info("RAG vector store has been cleared.")
+
+class LayeredVectorStore:
+    """
+    A per-session view over a shared, read-only base store.
+    Documents added by the session go to a small private overlay; queries search both.
+    Knowledge-base documents the session removes are only hidden from its own queries.
+    The overlay can be spilled to disk while no operation is using it; it is reloaded on next use.
+    """
+    def __init__(self, base_store: RAGVectorStore):
+        self.base_store = base_store
+        self.embedding_model = base_store.embedding_model
+        # Overlay ids start far above any base id so chunk ids stay unique across both layers.
+        self._overlay = RAGVectorStore(embedding_model=self.embedding_model, first_id=OVERLAY_FIRST_ID)
+        self.hidden_sources = set()
+        self._hidden_ids = set()
+        self._spill_lock = threading.Lock()
+        self._users = 0  # operations currently using the overlay; a used overlay is never spilled
+        self._spilled_to: str | None = None
+        self._spilled_key: tuple | None = None  # the overlay's corpus key, kept so cached answers stay valid
+
+    @contextmanager
+    def in_use(self):
+        """
+        Holds the session's overlay in memory for the duration of the block (reloading it first if
+        it was spilled) and yields it. Wrap long operations, such as ingesting uploads, in it.
+        """
+        with self._spill_lock:
+            if self._spilled_to is not None:
+                self._restore()
+            self._users += 1
+            overlay = self._overlay
+        try:
+            yield overlay
+        finally:
+            with self._spill_lock:
+                self._users -= 1
+
+    @property
+    def is_spilled(self) -> bool:
+        return self._spilled_to is not None
+
+    def spill(self, directory: str) -> bool:
+        """
+        Saves the overlay to directory and drops it from memory until the session next uses it.
+        Returns False if there was nothing to spill or the overlay is in use.
+        """
+        with self._spill_lock:
+            overlay = self._overlay
+            if self._spilled_to is not None or self._users or not overlay.ntotal:
+                return False
+            overlay.save(directory)
+            self._spilled_key = (overlay.store_id, overlay.version)
+            self._overlay = None
+            self._spilled_to = directory
+        return True
+
+    def _restore(self):
+        start = time.perf_counter()
+        overlay = RAGVectorStore(embedding_model=self.embedding_model, first_id=OVERLAY_FIRST_ID)
+        if overlay.load(self._spilled_to):
+            overlay.store_id, overlay.version = self._spilled_key
+        else:
+            # The empty overlay keeps its own store id, so answers cached for the lost documents no longer match.
+            logger.error(f"Could not reload this session's documents from '{self._spilled_to}'; they are lost.")
+        shutil.rmtree(self._spilled_to, ignore_errors=True)
+        self._overlay = overlay
+        self._spilled_to = None
+        get_metrics().observe("session.restore", time.perf_counter() - start)
+        logger.info(f"Reloaded a spilled session overlay with {overlay.ntotal} chunks.")
+
+    @property
+    def ntotal(self) -> int:
+        """Number of indexed chunks across the base store and the overlay."""
+        with self.in_use() as overlay:
+            return self.base_store.ntotal - len(self._hidden_ids) + overlay.ntotal
+
+    def _hide(self, source: str) -> int:
+        chunk_ids = self.base_store.source_ids.get(source, [])
+        if source in self.base_store.source_ids and source not in self.hidden_sources:
+            self.hidden_sources.add(source)
+            self._hidden_ids.update(chunk_ids)
+            return len(chunk_ids)
+        return 0
+
+    def add_texts(self, texts: list[str], source: str, source_hash: str | None = None, embeddings: np.ndarray | None = None) -> list[int]:
+        """Adds chunks to the session's private overlay; the base store is never modified."""
+        with self.in_use() as overlay:
+            return overlay.add_texts(texts, source=source, source_hash=source_hash, embeddings=embeddings)
+
+    def remove_source(self, source: str) -> int:
+        """Removes an uploaded source from the overlay, or hides a knowledge-base source for this session."""
+        with self.in_use() as overlay:
+            return overlay.remove_source(source) + self._hide(source)
+
+    def replace_source(self, source: str, texts: list[str], source_hash: str | None = None, embeddings: np.ndarray | None = None) -> list[int]:
+        """Replaces a source in the overlay; a knowledge-base source of the same name is hidden."""
+        self._hide(source)
+        with self.in_use() as overlay:
+            return overlay.replace_source(source, texts, source_hash=source_hash, embeddings=embeddings)
+
+    def has_content(self, source_hash: str) -> bool:
+        """Returns True if the overlay or a visible base source already holds this content."""
+        with self.in_use() as overlay:
+            if overlay.has_content(source_hash):
+                return True
+        # Copied first: the base store may still be ingesting on the warm-up thread.
+        return any(h == source_hash and s not in self.hidden_sources for s, h in list(self.base_store.source_hashes.items()))
+
+    def upload_hash(self, source: str) -> str | None:
+        """Returns the content hash of a document this session uploaded, or None."""
+        with self.in_use() as overlay:
+            return overlay.source_hashes.get(source)
+
+    def sources(self) -> list[str]:
+        """Names of the documents this session can retrieve: visible knowledge-base sources and its uploads."""
+        with self.in_use() as overlay:
+            return sorted((set(self.base_store.source_ids) - self.hidden_sources) | set(overlay.source_ids))
+
+    def corpus_key(self) -> tuple:
+        """
+        Identifies what this session can retrieve. Sessions without uploads or hidden documents
+        share the base store's key, so their cached answers are shared too.
+        """
+        with self.in_use() as overlay:
+            if not overlay.ntotal and not self.hidden_sources:
+                return self.base_store.corpus_key()
+            return self.base_store.corpus_key() + overlay.corpus_key() + (frozenset(self.hidden_sources),)
+
+    def memory_usage(self) -> dict:
+        """Reports the memory owned by this session (its overlay); the base store is shared."""
+        with self.in_use() as overlay:
+            return overlay.memory_usage()
+
+    def encode_query(self, query_text: str) -> np.ndarray:
+        """Encodes a query into the (1, d) float32 array search() expects."""
+        return self.base_store.encode_query(query_text)
+
+    def get_vectors(self, chunk_ids: list[int]) -> np.ndarray:
+        """Returns the stored vectors of chunks from either layer, in the order given."""
+        vectors = np.empty((len(chunk_ids), self.base_store.d), dtype='float32')
+        in_overlay = np.asarray(chunk_ids, dtype='int64') >= OVERLAY_FIRST_ID
+        with self.in_use() as overlay:
+            for store, rows in ((self.base_store, np.flatnonzero(~in_overlay)), (overlay, np.flatnonzero(in_overlay))):
+                if len(rows):
+                    vectors[rows] = store.get_vectors([chunk_ids[row] for row in rows])
+        return vectors
+
+    def query(self, query_text: str, top_k: int = settings.TOP_K, query_emb: np.ndarray | None = None) -> list[dict]:
+        """Queries the base store and the overlay with one encoded query and merges by distance."""
+        if self.ntotal == 0:
+            logger.warning("Query attempted on an empty index.")
+            return []
+
+        logger.info(f"Performing layered query for top {top_k} results.")
+        if query_emb is None:
+            query_emb = self.encode_query(query_text)
+        with self.in_use() as overlay:
+            hits = self.base_store.search(query_emb, top_k, exclude_ids=self._hidden_ids) + overlay.search(query_emb, top_k)
+        hits.sort(key=lambda hit: hit[0])
+        return [doc for _, doc in hits[:top_k]]
+
+    def encode_queries(self, query_texts: list[str]) -> np.ndarray:
+        """Encodes many queries in one batched encoder pass into an (n, d) float32 array."""
+        return self.base_store.encode_queries(query_texts)
+
+    def query_batch(self, query_texts: list[str], top_k: int = settings.TOP_K, query_embs: np.ndarray | None = None) -> list[list[dict]]:
+        """Like query() for many queries at once: one batched encode and one search per layer."""
+        if self.ntotal == 0:
+            logger.warning("Batch query attempted on an empty index.")
+            return [[] for _ in query_texts]
+
+        logger.info(f"Performing layered batch query of {len(query_texts)} queries for top {top_k} results.")
+        if query_embs is None:
+            query_embs = self.encode_queries(query_texts)
+        base_hits = self.base_store.search_batch(query_embs, top_k, exclude_ids=self._hidden_ids)
+        with self.in_use() as overlay:
+            overlay_hits = overlay.search_batch(query_embs, top_k)
+        results = []
+        for hits in (base + overlay for base, overlay in zip(base_hits, overlay_hits)):
+            hits.sort(key=lambda hit: hit[0])
+            results.append([doc for _, doc in hits[:top_k]])
+        return results
+
+    def clear(self):
+        """Drops the session's own documents and unhides knowledge-base documents."""
+        with self.in_use() as overlay:
+            overlay.clear()
+        self.hidden_sources = set()
+        self._hidden_ids = set()
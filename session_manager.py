@@ -0,0 +1,149 @@
+# session_manager.py
+
+from __future__ import annotations
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+from config import settings
+from metrics import get_metrics
+
+if TYPE_CHECKING:
+    from rag_utils import LayeredVectorStore
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class _Session:
+    store: weakref.ref  # the session's LayeredVectorStore; the manager must not keep it alive
+    spill_dir: str
+    last_used: float
+    nbytes: int = 0
+    corpus_key: tuple | None = None  # memory is only measured again once the store changes
+
+    @property
+    def resident(self) -> bool:
+        store = self.store()
+        return store is not None and not store.is_spilled
+
+class SessionStoreManager:
+    """
+    Keeps the private stores (uploads) of all sessions under one memory budget. Every script run
+    touches its session; when the sessions together exceed the budget, the least recently used
+    idle ones are spilled to disk. A spilled store reloads itself the next time it is used.
+    Safe to share between threads.
+    """
+    def __init__(
+        self,
+        budget_bytes: int = settings.SESSION_MEMORY_BUDGET_MB * 2**20,
+        spill_dir: str = settings.SESSION_SPILL_DIR,
+        min_idle_seconds: float = settings.SESSION_MIN_IDLE_SECONDS,
+    ):
+        self.budget_bytes = budget_bytes
+        self.min_idle_seconds = min_idle_seconds
+        self._sessions: OrderedDict[str, _Session] = OrderedDict()  # least recently used first
+        self._lock = threading.Lock()
+        # A private directory per process: other processes may be spilling into spill_dir too.
+        os.makedirs(spill_dir, exist_ok=True)
+        self.spill_dir = tempfile.mkdtemp(prefix="sessions-", dir=spill_dir)
+        # Spilled sessions do not survive a restart; this process's spills are deleted when it exits.
+        weakref.finalize(self, shutil.rmtree, self.spill_dir, True)
+
+    def touch(self, session_id: str, store: LayeredVectorStore):
+        """
+        Marks the session as just used (reloading its store if it was spilled), records its memory,
+        and spills other idle sessions if the budget is exceeded.
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None or session.store() is not store:
+                spill_dir = os.path.join(self.spill_dir, f"{session_id}-{uuid.uuid4().hex[:8]}")
+                session = self._sessions[session_id] = _Session(weakref.ref(store), spill_dir, time.monotonic())
+                # Spill files of a session whose store is gone (the tab was closed) are deleted with it.
+                weakref.finalize(store, shutil.rmtree, spill_dir, True)
+            self._sessions.move_to_end(session_id)
+            session.last_used = time.monotonic()
+
+        corpus_key = store.corpus_key()  # reloads a spilled overlay
+        if corpus_key != session.corpus_key:
+            memory = store.memory_usage()
+            session.nbytes = memory['vector_bytes'] + memory['document_bytes']
+            session.corpus_key = corpus_key
+        self._enforce_budget()
+        self._publish()
+
+    def _enforce_budget(self):
+        """Spills the least recently used idle sessions until the resident ones fit in the budget."""
+        with self._lock:
+            self._prune()
+            resident = sum(s.nbytes for s in self._sessions.values() if s.resident)
+            if resident <= self.budget_bytes:
+                return
+            now = time.monotonic()
+            victims = []
+            for session_id, session in self._sessions.items():
+                if resident <= self.budget_bytes:
+                    break
+                if session.nbytes and session.resident and now - session.last_used >= self.min_idle_seconds:
+                    victims.append((session_id, session))
+                    resident -= session.nbytes
+            if resident > self.budget_bytes:
+                logger.warning(f"Sessions hold {resident} bytes, over the {self.budget_bytes} byte budget, but none is idle long enough to spill.")
+
+        for session_id, session in victims:
+            store = session.store()
+            if store is None:
+                continue
+            start = time.perf_counter()
+            if store.spill(session.spill_dir):
+                get_metrics().observe("session.spill", time.perf_counter() - start)
+                logger.info(f"Spilled idle session {session_id[:8]} ({session.nbytes} bytes) to disk.")
+
+    def _prune(self):
+        """Forgets sessions whose store has been garbage collected. Called with the lock held."""
+        for session_id in [session_id for session_id, session in self._sessions.items() if session.store() is None]:
+            del self._sessions[session_id]
+            get_metrics().remove_gauge("session.memory_bytes", session=session_id[:8])
+
+    def stats(self) -> dict:
+        """Returns the number of resident and spilled sessions and the bytes held by the resident ones."""
+        with self._lock:
+            self._prune()
+            sessions = {session_id[:8]: session.nbytes if session.resident else 0 for session_id, session in self._sessions.items()}
+            resident = sum(1 for session in self._sessions.values() if session.resident)
+        return {
+            'resident': resident,
+            'spilled': len(sessions) - resident,
+            'resident_bytes': sum(sessions.values()),
+            'budget_bytes': self.budget_bytes,
+            'sessions': sessions,
+        }
+
+    def _publish(self):
+        metrics = get_metrics()
+        if not metrics.enabled:
+            return
+        stats = self.stats()
+        for session, nbytes in stats['sessions'].items():
+            metrics.set_gauge("session.memory_bytes", nbytes, session=session)
+        metrics.set_gauge("sessions.resident_bytes", stats['resident_bytes'])
+        metrics.set_gauge("sessions.resident", stats['resident'])
+        metrics.set_gauge("sessions.spilled", stats['spilled'])
+
+_manager_lock = threading.Lock()
+_manager: SessionStoreManager | None = None
+
+def get_session_manager() -> SessionStoreManager:
+    """Returns the process-wide session store manager."""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = SessionStoreManager()
+        return _manager
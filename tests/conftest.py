@@ -0,0 +1,17 @@
+import os
+import sys
+import pytest
+
+# The modules live at the repository root rather than in a package.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import embedding_cache
+from benchmark import STUB_MODEL_NAME
+from config import settings
+
+@pytest.fixture(autouse=True)
+def stub_embedding_cache(monkeypatch):
+    """Keeps stub vectors out of the real embedding cache: a stub model id, no disk tier, fresh caches per test."""
+    monkeypatch.setattr(settings, "EMBEDDING_MODEL_NAME", STUB_MODEL_NAME)
+    monkeypatch.setattr(settings, "EMBEDDING_CACHE_DIR", None)
+    monkeypatch.setattr(embedding_cache, "_embedding_caches", {})
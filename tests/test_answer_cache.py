@@ -0,0 +1,50 @@
+import numpy as np
+from answer_cache import SemanticAnswerCache
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+def _cache(**options) -> tuple[SemanticAnswerCache, Clock]:
+    clock = Clock()
+    return SemanticAnswerCache(**{'similarity_threshold': 0.95, 'ttl_seconds': 60, 'max_entries': 10, 'clock': clock, **options}), clock
+
+def test_only_questions_within_the_similarity_threshold_hit():
+    cache, _ = _cache()
+    cache.store(np.array([1.0, 0.0]), [1, 2], "corpus", "answer")
+    assert cache.lookup(np.array([1.0, 0.1]), [2, 1], "corpus") == "answer"  # cosine 0.995
+    assert cache.lookup(np.array([1.0, 0.5]), [1, 2], "corpus") is None  # cosine 0.894
+    assert cache.lookup(np.array([1.0, 0.0]), [1, 3], "corpus") is None  # other chunks retrieved
+    assert (cache.hits, cache.misses) == (1, 2)
+
+def test_entries_expire_after_the_ttl():
+    cache, clock = _cache()
+    cache.store(np.array([1.0, 0.0]), [1], "corpus", "answer")
+    clock.now += 59
+    assert cache.lookup(np.array([1.0, 0.0]), [1], "corpus") == "answer"
+    clock.now += 2
+    assert cache.lookup(np.array([1.0, 0.0]), [1], "corpus") is None
+    assert cache.stats()['entries'] == 0
+
+def test_least_recently_used_entry_is_evicted():
+    cache, _ = _cache(max_entries=2)
+    vectors = {name: np.array(vector) for name, vector in (("a", [1.0, 0.0, 0.0]), ("b", [0.0, 1.0, 0.0]), ("c", [0.0, 0.0, 1.0]))}
+    cache.store(vectors["a"], [1], "corpus", "A")
+    cache.store(vectors["b"], [1], "corpus", "B")
+    assert cache.lookup(vectors["a"], [1], "corpus") == "A"  # a is now the most recently used
+    cache.store(vectors["c"], [1], "corpus", "C")
+    assert cache.lookup(vectors["b"], [1], "corpus") is None
+    assert cache.lookup(vectors["a"], [1], "corpus") == "A"
+    assert cache.lookup(vectors["c"], [1], "corpus") == "C"
+
+def test_answers_are_tied_to_the_corpus_key():
+    cache, _ = _cache()
+    cache.store(np.array([1.0, 0.0]), [1], ("store", 1), "old answer")
+    cache.store(np.array([0.0, 1.0]), [1], ("store", 2), "new answer")
+    assert cache.lookup(np.array([1.0, 0.0]), [1], ("store", 2)) is None  # the documents changed
+    cache.invalidate(("store", 1))
+    assert cache.stats()['entries'] == 1
+    assert cache.lookup(np.array([0.0, 1.0]), [1], ("store", 2)) == "new answer"
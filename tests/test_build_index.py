@@ -0,0 +1,17 @@
+import json
+from build_index import ATTEMPTED_FILENAME, attempted_sources
+
+def _part(tmp_path, name: str, sources: list[str], errors: dict[str, str]) -> str:
+    part_dir = tmp_path / name
+    part_dir.mkdir()
+    (part_dir / ATTEMPTED_FILENAME).write_text(json.dumps({'sources': sources, 'errors': errors}))
+    return str(part_dir)
+
+def test_a_retried_source_is_no_longer_failed(tmp_path):
+    parts = [
+        _part(tmp_path, "part-00000", ["a.pdf", "b.pdf", "c.pdf"], {"b.pdf": "corrupt", "c.pdf": "unreadable"}),
+        _part(tmp_path, "part-00001", ["b.pdf", "c.pdf"], {"c.pdf": "still unreadable"}),
+    ]
+    attempted, errors = attempted_sources(parts)
+    assert attempted == {"a.pdf", "b.pdf", "c.pdf"}
+    assert errors == {"c.pdf": "still unreadable"}
@@ -0,0 +1,45 @@
+import pytest
+from benchmark import StubEmbeddingModel, make_sentences
+from compact_storage import ColumnarDocuments
+from config import settings
+from rag_utils import RAGVectorStore
+
+def test_columnar_documents_behave_like_a_dict():
+    documents = ColumnarDocuments(first_id=100)
+    for chunk_id, text in zip(range(100, 105), ["zero", "één", "two", "", "four"]):
+        documents[chunk_id] = {'id': chunk_id, 'text': text, 'source': "a.txt" if chunk_id % 2 else "b.txt"}
+    assert documents[101] == {'id': 101, 'text': "één", 'source': "a.txt"}
+
+    del documents[102]
+    documents.pop(103)
+    assert 102 not in documents and len(documents) == 3
+    with pytest.raises(KeyError):
+        documents[102]
+    documents[107] = {'id': 107, 'text': "seven", 'source': "c.txt"}  # skips the ids of removed chunks
+    with pytest.raises(ValueError):
+        documents[106] = {'id': 106, 'text': "late", 'source': "c.txt"}
+
+    documents.compact()
+    assert list(documents) == [100, 101, 104, 107]
+    assert [doc['text'] for doc in documents.values()] == ["zero", "één", "four", "seven"]
+
+def _store(model, compact: bool, monkeypatch) -> RAGVectorStore:
+    monkeypatch.setattr(settings, "COMPACT_STORAGE", compact)
+    store = RAGVectorStore(embedding_model=model, backend="flat_ip")
+    for seed in range(3):
+        store.add_texts(make_sentences(40, seed), source=f"{seed}.txt")
+    store.remove_source("1.txt")
+    return store
+
+def test_compact_store_round_trips_and_answers_like_the_dict_store(tmp_path, monkeypatch):
+    model = StubEmbeddingModel(64)
+    plain = _store(model, False, monkeypatch)
+    compact = _store(model, True, monkeypatch)
+    compact.save(str(tmp_path))
+    reloaded = RAGVectorStore(embedding_model=model, backend="flat_ip")
+    assert reloaded.load(str(tmp_path))
+
+    assert isinstance(reloaded.documents, ColumnarDocuments) and not isinstance(plain.documents, ColumnarDocuments)
+    assert dict(reloaded.documents) == plain.documents
+    queries = make_sentences(10, 2) + make_sentences(5, 7)
+    assert reloaded.query_batch(queries, top_k=5) == plain.query_batch(queries, top_k=5)
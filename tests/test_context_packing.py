@@ -0,0 +1,16 @@
+import numpy as np
+from context_packing import estimate_tokens, format_context, pack_context
+
+def test_tokens_saved_compares_against_the_unpacked_top_k():
+    candidates = [
+        {'id': 0, 'source': "a.pdf", 'text': "Short note on salinity."},
+        {'id': 1, 'source': "a.pdf", 'text': "Short note on salinity!"},
+        {'id': 2, 'source': "b.pdf", 'text': "A long excerpt about thermohaline circulation. " * 20},
+    ]
+    vectors = np.array([[1.0, 0.0], [1.0, 0.001], [0.6, 0.8]], dtype='float32')
+    packed = pack_context(np.array([1.0, 0.2]), candidates, vectors, top_k=2, token_budget=10_000)
+
+    assert [doc['id'] for doc in packed.docs] == [0, 2]
+    assert packed.dropped_duplicates == 1
+    assert packed.tokens_saved == estimate_tokens(format_context(candidates[:2])) - packed.tokens_used
+    assert packed.tokens_saved < 0  # the long excerpt took the dropped duplicate's place
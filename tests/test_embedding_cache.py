@@ -0,0 +1,63 @@
+import sqlite3
+import threading
+import numpy as np
+from benchmark import StubEmbeddingModel
+from embedding_cache import EmbeddingCache
+
+class CountingModel(StubEmbeddingModel):
+    def __init__(self):
+        super().__init__(16)
+        self.encoded = []
+
+    def encode(self, sentences, **kwargs) -> np.ndarray:
+        self.encoded.extend(sentences)
+        return super().encode(sentences, **kwargs)
+
+def _rows(disk_dir) -> set[str]:
+    with sqlite3.connect(disk_dir / "embeddings.sqlite3") as db:
+        return {key for key, in db.execute("SELECT key FROM embeddings")}
+
+def test_disk_tier_evicts_least_recently_accessed_rows(tmp_path):
+    model = CountingModel()
+    cache = EmbeddingCache("m", max_entries=4, disk_dir=str(tmp_path), max_disk_entries=10)
+    old = [f"old text {i}" for i in range(10)]
+    cache.encode(model, old)
+    cache.encode(model, old[:3])  # recently used again
+    cache.encode(model, [f"new text {i}" for i in range(5)])
+
+    assert cache.stats()['disk_entries'] <= 10
+    kept = _rows(tmp_path)
+    assert {cache._key(text) for text in old[:3]} <= kept
+    assert cache._key(old[3]) not in kept  # the oldest untouched rows went first
+
+    model.encoded.clear()
+    reopened = EmbeddingCache("m", max_entries=4, disk_dir=str(tmp_path), max_disk_entries=10)
+    reopened.encode(model, old[:3])
+    assert model.encoded == []
+
+def test_caches_without_access_times_are_upgraded(tmp_path):
+    with sqlite3.connect(tmp_path / "embeddings.sqlite3") as db:
+        db.execute("CREATE TABLE embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+    cache = EmbeddingCache("m", disk_dir=str(tmp_path), max_disk_entries=10)
+    model = CountingModel()
+    cache.encode(model, ["some text"])
+    cache.clear()
+    cache.encode(model, ["some text"])
+    assert model.encoded == ["some text"]
+
+def test_hit_and_miss_counts_add_up_across_threads():
+    cache = EmbeddingCache("m")
+    model = StubEmbeddingModel(16)
+    texts = [f"text {i}" for i in range(50)]
+
+    def work():
+        for _ in range(20):
+            cache.encode(model, texts)
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = cache.stats()
+    assert stats['hits'] + stats['misses'] == 8 * 20 * len(texts)
@@ -0,0 +1,40 @@
+import threading
+import numpy as np
+from benchmark import StubEmbeddingModel, make_sentences
+from encoder_service import BatchingEncoder
+
+def _mixed_lengths(count: int, seed: int) -> list[str]:
+    sentences = make_sentences(count, seed)
+    return [" ".join(sentences[i:i + 1 + i % 4]) for i in range(count)]  # one to four sentences each
+
+def test_bucketed_encode_matches_the_model_row_for_row():
+    model = StubEmbeddingModel(32)
+    encoder = BatchingEncoder(model, window_ms=0, max_batch_size=8, max_batch_tokens=300, int8=False)
+    texts = _mixed_lengths(40, 0)
+    np.testing.assert_allclose(encoder.encode(texts), model.encode(texts), atol=1e-6)
+    stats = encoder.stats()
+    assert stats['sentences'] == 40 and stats['batches'] > 40 / 8  # long texts ran in smaller batches
+
+def test_concurrent_callers_are_coalesced_and_get_their_own_rows():
+    model = StubEmbeddingModel(32)
+    encoder = BatchingEncoder(model, window_ms=200, max_batch_size=64, max_batch_tokens=10_000, int8=False)
+    requests = [_mixed_lengths(3, seed) for seed in range(8)]
+    results = [None] * len(requests)
+    start = threading.Barrier(len(requests))
+
+    def call(i: int):
+        start.wait()
+        results[i] = encoder.encode(requests[i])
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(len(requests))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for texts, vectors in zip(requests, results):
+        np.testing.assert_allclose(vectors, model.encode(texts), atol=1e-6)
+    stats = encoder.stats()
+    assert stats['requests'] == len(requests) and stats['sentences'] == 3 * len(requests)
+    assert stats['coalesced_requests'] > 0 and stats['requests_per_dispatch'] > 1
+    assert stats['batches'] < len(requests)
@@ -0,0 +1,72 @@
+import fitz  # PyMuPDF
+import pytest
+import ingestion
+from benchmark import StubEmbeddingModel, make_sentences
+from chunking import SemanticChunker
+from config import settings
+from ingestion import IngestJob, ingest_files
+from rag_utils import RAGVectorStore
+
+def _pdf(pages: int, seed: int) -> bytes:
+    sentences = make_sentences(pages * 6, seed)
+    doc = fitz.open()
+    for page in range(pages):
+        doc.new_page().insert_textbox(fitz.Rect(50, 50, 550, 800), " ".join(sentences[page * 6:(page + 1) * 6]), fontsize=9)
+    return doc.tobytes()
+
+@pytest.fixture
+def model():
+    return StubEmbeddingModel(64)
+
+@pytest.fixture
+def streaming(monkeypatch):
+    monkeypatch.setattr(settings, "INGEST_STREAM_MIN_PAGES", 20)
+    monkeypatch.setattr(settings, "INGEST_STREAM_GROUP_CHUNKS", 4)
+
+def _ingest(store, model, jobs, errors):
+    return ingest_files(store, jobs, chunker=SemanticChunker(model), workers=1, errors=errors)
+
+def test_large_pdf_is_streamed_page_by_page(model, streaming, monkeypatch):
+    joined = []
+    monkeypatch.setattr(ingestion, "_extract_and_segment", lambda *args, **kwargs: joined.append(args) or ([], {}, {}))
+    store, errors = RAGVectorStore(embedding_model=model), {}
+    assert _ingest(store, model, [IngestJob("big.pdf", data=_pdf(30, 1), source_hash="b")], errors) == ["big.pdf"]
+    assert not errors and not joined  # never extracted and segmented as a whole
+    assert len(store.source_ids["big.pdf"]) > settings.INGEST_STREAM_GROUP_CHUNKS  # written in several parts
+
+def test_streamed_pdf_failing_midway_leaves_no_partial_source(model, streaming, monkeypatch):
+    store, errors = RAGVectorStore(embedding_model=model), {}
+    _ingest(store, model, [IngestJob("small.pdf", data=_pdf(3, 2), source_hash="s")], errors)
+    iter_pages = ingestion.iter_pages
+
+    def failing_pages(*args, **kwargs):
+        for page_number, text in enumerate(iter_pages(*args, **kwargs)):
+            if page_number == 25:
+                raise RuntimeError("page 25 is corrupt")
+            yield text
+
+    monkeypatch.setattr(ingestion, "iter_pages", failing_pages)
+    assert _ingest(store, model, [IngestJob("big.pdf", data=_pdf(30, 1), source_hash="b")], errors) == []
+    assert errors == {"big.pdf": "page 25 is corrupt"}
+    assert list(store.source_ids) == ["small.pdf"]
+
+def test_streamed_pdf_without_chunks_is_not_reported_as_unreadable(model, streaming, monkeypatch, caplog):
+    chunker = SemanticChunker(model)
+    monkeypatch.setattr(chunker, "chunk_stream_with_embeddings", lambda pages, **kwargs: iter([page for page in pages if False]))
+    store, errors = RAGVectorStore(embedding_model=model), {}
+    jobs = [IngestJob("big.pdf", data=_pdf(30, 1), source_hash="b")]
+    assert ingest_files(store, jobs, chunker=chunker, workers=1, errors=errors) == []
+    assert not errors
+    assert "Could not generate any chunks from 'big.pdf'" in caplog.text
+
+def test_streamed_pdf_without_text_is_reported_as_unreadable(model, streaming):
+    blank = fitz.open()
+    for _ in range(30):
+        blank.new_page()
+    store, errors = RAGVectorStore(embedding_model=model), {}
+    assert _ingest(store, model, [IngestJob("scan.pdf", data=blank.tobytes(), source_hash="i")], errors) == []
+    assert errors["scan.pdf"].startswith("No text could be extracted")
+
+def test_chunk_stream_rejects_max_chunk_sentences_below_two(model):
+    with pytest.raises(ValueError):
+        list(SemanticChunker(model).chunk_stream(["One. Two. Three."], max_chunk_sentences=1))
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from llm_utils import AsyncLLMClient, LLMAnalysisError, get_async_llm_client
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        status, delay, tokens = self.server.next_reply()
+        self.send_response(status)
+        if status != 200:
+            body = b'{"error": "scripted failure"}'
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        time.sleep(delay)  # the response has started; only the first token is late
+        try:
+            for token in tokens:
+                self.wfile.write(f"data: {json.dumps({'choices': [{'delta': {'content': token}}]})}\n\n".encode())
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client abandoned this request (a lost hedge or a missed deadline)
+
+class StandInLLMServer(ThreadingHTTPServer):
+    """
+    Local OpenAI-compatible chat completions endpoint that plays back one scripted reply per
+    request: (status, seconds before the first token, streamed tokens).
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _StandInHandler)
+        self.replies: deque[tuple[int, float, list[str]]] = deque()
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def next_reply(self) -> tuple[int, float, list[str]]:
+        with self._lock:
+            self.requests += 1
+            return self.replies.popleft() if self.replies else (200, 0.0, ["default"])
+
+@pytest.fixture
+def server():
+    server = StandInLLMServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def _answer(server: StandInLLMServer, **options) -> str:
+    async def run():
+        client = AsyncLLMClient(api_key="test", base_url=server.url, backoff_base=0.01, **options)
+        try:
+            return "".join([token async for token in client.stream_chat([{"role": "user", "content": "hi"}])])
+        finally:
+            await client.aclose()
+    return asyncio.run(run())
+
+def test_rate_limited_request_is_retried(server):
+    server.replies.extend([(429, 0.0, []), (200, 0.0, ["Hel", "lo"])])
+    assert _answer(server, max_retries=2) == "Hello"
+    assert server.requests == 2
+
+def test_rate_limits_beyond_max_retries_raise(server):
+    server.replies.extend([(429, 0.0, [])] * 2)
+    with pytest.raises(LLMAnalysisError):
+        _answer(server, max_retries=1)
+    assert server.requests == 2
+
+def test_client_errors_are_not_retried(server):
+    server.replies.append((400, 0.0, []))
+    with pytest.raises(LLMAnalysisError, match="HTTP 400"):
+        _answer(server, max_retries=3)
+    assert server.requests == 1
+
+def test_slow_first_token_is_hedged(server):
+    server.replies.extend([(200, 2.0, ["slow"]), (200, 0.0, ["fast"])])
+    start = time.perf_counter()
+    assert _answer(server, ttft_deadline=0.2, hedge=True, max_retries=0) == "fast"
+    assert server.requests == 2
+    assert time.perf_counter() - start < 2.0  # did not wait for the slow request
+
+def test_missed_deadline_without_hedging_is_retried(server):
+    server.replies.extend([(200, 2.0, ["slow"]), (200, 0.0, ["retried"])])
+    assert _answer(server, ttft_deadline=0.2, hedge=False, max_retries=1) == "retried"
+    assert server.requests == 2
+
+def test_missed_deadlines_without_hedging_raise(server):
+    server.replies.extend([(200, 2.0, ["slow"])] * 2)
+    start = time.perf_counter()
+    with pytest.raises(LLMAnalysisError, match="TTFT deadline"):
+        _answer(server, ttft_deadline=0.2, hedge=False, max_retries=1)
+    assert time.perf_counter() - start < 2.0
+
+def test_each_event_loop_gets_its_own_client():
+    async def clients():
+        return get_async_llm_client(), get_async_llm_client()
+
+    first, again = asyncio.run(clients())
+    other, _ = asyncio.run(clients())
+    assert first is again
+    assert other is not first
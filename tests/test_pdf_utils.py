@@ -0,0 +1,51 @@
+import fitz  # PyMuPDF
+import pytest
+import pdf_utils
+from pdf_utils import PageTextCache, extract_text_from_pdf, iter_pdf_pages, open_pdf, page_fingerprints
+
+def _text_pdf(pages: list[str]) -> fitz.Document:
+    doc = fitz.open()
+    for text in pages:
+        doc.new_page().insert_text((72, 72), text)
+    return doc
+
+def _placed_pdf(text: str) -> bytes:
+    """A page that only draws another PDF's page as a Form XObject: its content stream names the XObject, nothing else."""
+    out = fitz.open()
+    out.new_page().show_pdf_page(fitz.Rect(0, 0, 595, 842), _text_pdf([text]), 0)
+    return out.tobytes()
+
+@pytest.fixture
+def cache():
+    return PageTextCache()
+
+def test_pages_drawing_different_xobjects_have_different_fingerprints():
+    a = _placed_pdf("Alpha document secret text")
+    b = _placed_pdf("Bravo document other text")
+    assert page_fingerprints(open_pdf(a)) != page_fingerprints(open_pdf(b))
+
+def test_cached_xobject_page_is_not_reused_for_another_document(cache):
+    a = _placed_pdf("Alpha document secret text")
+    b = _placed_pdf("Bravo document other text")
+    assert "Alpha" in "".join(iter_pdf_pages(a, cache=cache))
+    text_b = "".join(iter_pdf_pages(b, cache=cache))
+    assert "Bravo" in text_b and "Alpha" not in text_b
+
+def test_edited_copy_reuses_unchanged_pages(cache):
+    original = _text_pdf(["First page", "Second page", "Third page"])
+    list(iter_pdf_pages(original.tobytes(), cache=cache))
+    original[1].insert_text((72, 144), "An added line")
+    edited = original.tobytes(garbage=4)  # renumbers objects, as a rewritten file would
+    pages = list(iter_pdf_pages(edited, cache=cache))
+    assert "An added line" in pages[1]
+    assert cache.stats()['hits'] == 2
+
+def test_unchanged_file_is_found_by_its_hash_alone(cache, monkeypatch):
+    data = _text_pdf(["First page", "Second page"]).tobytes()
+    first = list(iter_pdf_pages(data, file_hash="h", cache=cache))
+    monkeypatch.setattr(pdf_utils, "page_fingerprints", lambda doc: pytest.fail("fingerprinted a cached file"))
+    assert list(iter_pdf_pages(data, file_hash="h", cache=cache)) == first
+    assert cache.lookup_file("other") is None
+
+def test_extract_text_from_pdf_reads_bytes():
+    assert "Hello" in extract_text_from_pdf(_text_pdf(["Hello from memory"]).tobytes())
@@ -0,0 +1,19 @@
+from benchmark import StubEmbeddingModel, make_sentences
+from preloaded_data import preload_data_to_store
+from rag_utils import RAGVectorStore
+
+def test_sources_deleted_from_an_emptied_data_dir_are_pruned(tmp_path):
+    model = StubEmbeddingModel(64)
+    data_dir, index_dir = tmp_path / "data", str(tmp_path / "index")
+    data_dir.mkdir()
+    (data_dir / "a.txt").write_text(" ".join(make_sentences(40, 1)))
+    assert preload_data_to_store(RAGVectorStore(embedding_model=model), index_dir, str(data_dir)) == ["a.txt"]
+
+    (data_dir / "a.txt").unlink()
+    store = RAGVectorStore(embedding_model=model)
+    assert preload_data_to_store(store, index_dir, str(data_dir)) == []
+    assert not store.source_ids
+
+    reloaded = RAGVectorStore(embedding_model=model)
+    reloaded.load(index_dir)
+    assert not reloaded.source_ids  # the pruned index was saved
@@ -0,0 +1,65 @@
+import pytest
+from benchmark import StubEmbeddingModel, make_sentences
+from config import settings
+from index_backends import is_staging
+from rag_utils import RAGVectorStore
+
+@pytest.fixture
+def model():
+    return StubEmbeddingModel(64)
+
+@pytest.fixture(params=["flat_ip", "ivf_flat", "hnsw"])
+def store(request, model, monkeypatch):
+    monkeypatch.setattr(settings, "IVF_NLIST", 4)
+    monkeypatch.setattr(settings, "IVF_NPROBE", 4)
+    monkeypatch.setattr(settings, "COMPACT_DELETED_FRACTION", 10.0)  # compact only when asked to
+    store = RAGVectorStore(embedding_model=model, backend=request.param)
+    for seed, source in enumerate("abc"):
+        store.add_texts(make_sentences(80, seed), source=f"{source}.txt", source_hash=source)
+    assert not is_staging(store.index, store.backend)  # ivf_flat trained once 4 * 39 vectors were in
+    return store
+
+def _sources(store: RAGVectorStore, text: str) -> set[str]:
+    return {doc['source'] for doc in store.query(text, top_k=store.ntotal)}
+
+def test_removed_source_is_filtered_before_and_after_compaction(store):
+    assert store.remove_source("b.txt") == 80
+    assert len(store.deleted_ids) == 80 and store.index.ntotal == 240
+    assert _sources(store, make_sentences(80, 1)[0]) == {"a.txt", "c.txt"}
+    assert not store.has_content("b")
+
+    store.compact()
+    assert not store.deleted_ids and store.index.ntotal == store.ntotal == 160
+    assert _sources(store, make_sentences(80, 1)[0]) == {"a.txt", "c.txt"}
+    sentence = make_sentences(80, 2)[5]
+    assert store.query(sentence, top_k=1)[0]['text'] == sentence
+
+def test_replace_source_swaps_its_chunks(store):
+    old, new = make_sentences(80, 0), make_sentences(40, 9)
+    store.replace_source("a.txt", new, source_hash="a2")
+    assert len(store.source_ids["a.txt"]) == 40
+    assert {store.documents[chunk_id]['text'] for chunk_id in store.source_ids["a.txt"]} == set(new)
+    found = {doc['text'] for doc in store.query(old[0], top_k=store.ntotal)}
+    assert not found & set(old)
+    assert store.has_content("a2") and not store.has_content("a")
+
+def test_saved_store_drops_tombstones(store, model, tmp_path):
+    store.remove_source("c.txt")
+    store.save(str(tmp_path))
+    reloaded = RAGVectorStore(embedding_model=model, backend=store.backend)
+    assert reloaded.load(str(tmp_path))
+    assert reloaded.index.ntotal == reloaded.ntotal == 160
+    assert _sources(reloaded, make_sentences(80, 2)[0]) == {"a.txt", "b.txt"}
+
+def test_source_without_chunks_is_not_recorded_as_indexed(model):
+    store = RAGVectorStore(embedding_model=model)
+    assert store.add_texts(["", "   "], source="empty.txt", source_hash="e") == []
+    assert not store.has_content("e")
+
+def test_recall_is_measured_over_live_chunks_without_compacting(store):
+    store.remove_source("b.txt")
+    rows = store.recall_at_k(k=5, sample_queries=20, sample_vectors=None)
+    assert len(store.deleted_ids) == 80 and store.index.ntotal == 240  # left for remove_source()/save()
+    assert rows and all(0 < row['recall'] <= 1 for row in rows)
+    if store.backend == "flat_ip":
+        assert rows[0]['recall'] == 1.0  # removed chunks never displace live ones
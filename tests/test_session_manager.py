@@ -0,0 +1,47 @@
+import json
+import os
+from benchmark import StubEmbeddingModel, make_sentences
+from rag_utils import MANIFEST_FILENAME, LayeredVectorStore, RAGVectorStore
+from session_manager import SessionStoreManager
+
+def _sessions(tmp_path):
+    model = StubEmbeddingModel(64)
+    base = RAGVectorStore(embedding_model=model)
+    base.add_texts(make_sentences(20, 0), source="kb.txt")
+    first, second = LayeredVectorStore(base), LayeredVectorStore(base)
+    first.add_texts(make_sentences(30, 1), source="first.txt")
+    second.add_texts(make_sentences(30, 2), source="second.txt")
+    usage = first.memory_usage()
+    # Room for one session's uploads, not for both.
+    manager = SessionStoreManager(budget_bytes=int(1.5 * (usage['vector_bytes'] + usage['document_bytes'])), spill_dir=str(tmp_path), min_idle_seconds=0)
+    return manager, first, second
+
+def test_least_recently_used_session_is_spilled_and_restored_intact(tmp_path):
+    manager, first, second = _sessions(tmp_path)
+    query = make_sentences(30, 1)[4]
+    before = (first.query(query, top_k=5), first.sources(), first.corpus_key())
+
+    manager.touch("first", first)
+    assert manager.stats()['spilled'] == 0
+    manager.touch("second", second)
+    assert first.is_spilled and not second.is_spilled
+    stats = manager.stats()
+    assert (stats['resident'], stats['spilled']) == (1, 1)
+    assert stats['resident_bytes'] <= stats['budget_bytes']
+
+    assert (first.query(query, top_k=5), first.sources(), first.corpus_key()) == before
+    assert not first.is_spilled
+
+def test_failed_restore_changes_the_corpus_key(tmp_path):
+    manager, first, second = _sessions(tmp_path)
+    first.remove_source("kb.txt")  # with a hidden source the key still includes the overlay's
+    key = first.corpus_key()
+    manager.touch("first", first)
+    manager.touch("second", second)
+    assert first.is_spilled
+    spill_dir = next(os.scandir(manager.spill_dir)).path
+    with open(os.path.join(spill_dir, MANIFEST_FILENAME), 'w') as f:
+        json.dump({'format': -1}, f)
+
+    assert first.corpus_key() != key  # answers cached for the lost uploads no longer match
+    assert first.sources() == []